@@ -0,0 +1,148 @@
+#!/usr/bin/env python
+
+"""Counts of tasks grouped by status, priority, +project and @context, taken from a columnar snapshot of a set of tasks,
+and a log of the counts taken over time
+
+A TaskColumns keeps each task's status and priority as a code in an array, and its tags of each kind as codes in a flat array
+with the offset at which each task's tags start, so that grouping needs neither the tasks nor their summaries once it is built"""
+
+import itertools
+import json
+import time
+from array import array
+from collections import Counter
+from search import CONTEXT, PROJECT
+from todo import CONTEXT_RE, PROJ_RE, PRIORITY_BY_VALUE
+
+DIMENSIONS = ("status", "priority", "project", "context")
+TAG_KINDS = {"project": PROJECT, "context": CONTEXT}
+TAG_RES = ((CONTEXT, CONTEXT_RE), (PROJECT, PROJ_RE))
+
+# the value grouped under for a task without a status, or without any tags of a kind
+NONE = "-"
+
+def parse_dimensions(by):
+    """returns the list of dimensions in the comma-separated by, raising ValueError for one not in DIMENSIONS"""
+    dimensions = [d.strip().lower() for d in by.split(",") if d.strip()]
+    for dimension in dimensions:
+        if dimension not in DIMENSIONS:
+            raise ValueError("Cannot group by %s: choose from %s" % (dimension, ", ".join(DIMENSIONS)))
+    return dimensions
+
+class Codes(object):
+    """Assigns consecutive integer codes to distinct values"""
+    def __init__(self):
+        self.values = []
+        self.codes = {}
+
+    def code(self, value):
+        code = self.codes.get(value)
+        if code is None:
+            code = self.codes[value] = len(self.values)
+            self.values.append(value)
+        return code
+
+class TaskColumns(object):
+    """The status, priority and tags of a set of tasks, kept column by column in arrays of codes"""
+    def __init__(self):
+        self.statuses = Codes()
+        self.status = array('H')
+        self.priority = array('B')
+        self.tag_names = {CONTEXT: Codes(), PROJECT: Codes()}
+        # the tags of task n of each kind are tags[kind][tag_starts[kind][n]:tag_starts[kind][n+1]]
+        self.tags = {CONTEXT: array('I'), PROJECT: array('I')}
+        self.tag_starts = {CONTEXT: array('I', [0]), PROJECT: array('I', [0])}
+
+    @classmethod
+    def from_rows(cls, rows):
+        """builds the columns from (status, priority value, summary) rows"""
+        columns = cls()
+        status_code, status_column, priority_column = columns.statuses.code, columns.status, columns.priority
+        tag_columns = [(kind, tag_re, columns.tag_names[kind].code, columns.tags[kind], columns.tag_starts[kind]) for kind, tag_re in TAG_RES]
+        for status, priority, summary in rows:
+            status_column.append(status_code(status or NONE))
+            priority_column.append(priority)
+            summary = summary or ""
+            for kind, tag_re, tag_code, tags, starts in tag_columns:
+                # most summaries have no tags of a kind, which is quicker to check for than to search for
+                if kind in summary:
+                    tags.extend(sorted({tag_code(tag) for tag in tag_re.findall(summary)}))
+                starts.append(len(tags))
+        return columns
+
+    @classmethod
+    def from_tasks(cls, tasks):
+        """builds the columns from tasks, or anything else with priority, status and summary attributes"""
+        return cls.from_rows((task.status, task.priority.value, task.summary) for task in tasks)
+
+    def __len__(self):
+        return len(self.status)
+
+    def _tag_column(self, kind):
+        """returns a list of the tuple of tag codes of the given kind for each task, with -1 standing for none"""
+        tags, starts = self.tags[kind], self.tag_starts[kind]
+        return [tuple(tags[start:end]) or (-1,) for start, end in itertools.izip(starts, itertools.islice(starts, 1, None))]
+
+    def _decode(self, dimension, code):
+        if dimension == "status":
+            return self.statuses.values[code]
+        if dimension == "priority":
+            return PRIORITY_BY_VALUE[code].name
+        return self.tag_names[TAG_KINDS[dimension]].values[code] if code >= 0 else NONE
+
+    def counts(self, dimensions):
+        """
+        Counts the tasks in each group of the given dimensions. A task with several tags of a kind is counted in the group of each of them.
+
+        Returns:
+         * {(value of each dimension, ...): number of tasks, ...}
+        """
+        columns = [self.status if d == "status" else self.priority if d == "priority" else self._tag_column(TAG_KINDS[d]) for d in dimensions]
+        tag_dimensions = [n for n, d in enumerate(dimensions) if d in TAG_KINDS]
+        if not tag_dimensions:
+            coded = Counter(itertools.izip(*columns))
+        elif len(dimensions) == 1:
+            coded = Counter((code,) for codes in columns[0] for code in codes)
+        else:
+            # wrap the other columns' codes so that every row can be expanded into the product of its tags
+            columns = [column if n in tag_dimensions else [(code,) for code in column] for n, column in enumerate(columns)]
+            coded = Counter(key for row in itertools.izip(*columns) for key in itertools.product(*row))
+        return {tuple(self._decode(d, code) for d, code in zip(dimensions, key)): count for key, count in coded.items()}
+
+class SnapshotLog(object):
+    """The counts of each calendar's tasks by status and priority each time they were reported on, appended to a file
+    of JSON lines so that trends can be shown without fetching anything from the server. Calendars are identified by their url,
+    so that the snapshots of a calendar and of the cache store synced with it are kept together"""
+    def __init__(self, filename):
+        self.filename = filename
+
+    def record(self, calendar_url, columns, when=None):
+        """appends the counts of the given TaskColumns by status and priority as a journal entry is, ending any line
+        left unfinished by an interrupted write first, and syncing the file to disk"""
+        # store imports this module, so this is imported when it's needed
+        from store import append_lines
+        counts = columns.counts(["status", "priority"])
+        entry = {"time": when or time.time(), "calendar": calendar_url,
+                 "counts": [[status, priority, count] for (status, priority), count in sorted(counts.items())]}
+        append_lines(self.filename, [json.dumps(entry) + "\n"])
+
+    def history(self, calendar_url):
+        """returns [(time, {status: count, ...}), ...] for each snapshot of the calendar with the given url, oldest first"""
+        snapshots = []
+        try:
+            with open(self.filename) as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # a line left unfinished by an interrupted write
+                        continue
+                    if entry["calendar"] != calendar_url:
+                        continue
+                    status_counts = {}
+                    for status, priority, count in entry["counts"]:
+                        status_counts[status] = status_counts.get(status, 0) + count
+                    snapshots.append((entry["time"], status_counts))
+        except IOError:
+            pass
+        return sorted(snapshots)
@@ -0,0 +1,160 @@
+#!/usr/bin/env python
+
+"""A non-blocking counterpart of TaskDAVClient, for services that keep requests to many users' calendars in flight from one process
+
+Each call is run by the synchronous client in one of the worker threads of an Executor, and returns a Future straight away,
+so the requests are built and their responses parsed by exactly the same code as the synchronous ones. An Executor can be shared
+by the clients of any number of users, and bounds how many of their calls are in flight at once; each client's connection pool
+still bounds how many connections it has open to its server."""
+
+import sys
+import threading
+import Queue
+from multiprocessing.pool import ThreadPool
+from task import BatchWriter
+
+DEFAULT_WORKERS = 32
+
+class TimeoutError(Exception):
+    pass
+
+class Future(object):
+    """The eventual result of a call run by an Executor"""
+    def __init__(self):
+        self._done = threading.Event()
+        self._lock = threading.Lock()
+        self._callbacks = []
+        self._result = None
+        self._exc_info = None
+
+    def _set(self, result=None, exc_info=None):
+        with self._lock:
+            self._result = result
+            self._exc_info = exc_info
+            self._done.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            callback(self)
+
+    def done(self):
+        return self._done.is_set()
+
+    def result(self, timeout=None):
+        """waits for the call to finish and returns its result, or raises the exception it raised; raises TimeoutError
+        if it hasn't finished within timeout seconds"""
+        if not self._done.wait(timeout):
+            raise TimeoutError("call did not finish within %s seconds" % timeout)
+        if self._exc_info is not None:
+            raise self._exc_info[0], self._exc_info[1], self._exc_info[2]
+        return self._result
+
+    def exception(self, timeout=None):
+        """waits for the call to finish and returns the exception it raised, or None"""
+        if not self._done.wait(timeout):
+            raise TimeoutError("call did not finish within %s seconds" % timeout)
+        return self._exc_info[1] if self._exc_info is not None else None
+
+    def add_done_callback(self, callback):
+        """arranges for callback to be called with the future once it is done, straight away if it already is"""
+        with self._lock:
+            if not self._done.is_set():
+                self._callbacks.append(callback)
+                return
+        callback(self)
+
+def as_completed(futures, timeout=None):
+    """yields the given futures as each of them is done, in the order they finish; raises TimeoutError if none finishes
+    within timeout seconds of the last"""
+    futures = list(futures)
+    finished = Queue.Queue()
+    for future in futures:
+        future.add_done_callback(finished.put)
+    for n in range(len(futures)):
+        try:
+            # a timeout makes Queue.get interruptible, so one is always given
+            yield finished.get(True, timeout if timeout is not None else sys.maxint)
+        except Queue.Empty:
+            raise TimeoutError("no call finished within %s seconds" % timeout)
+
+class Executor(object):
+    """A bounded pool of worker threads that runs calls and returns a Future for each, with at most workers of them running at once"""
+    def __init__(self, workers=DEFAULT_WORKERS):
+        self.workers = workers
+        self.pool = ThreadPool(workers)
+
+    def submit(self, func, *args, **kwargs):
+        """queues func(*args, **kwargs) to be called by a worker, and returns the Future of its result"""
+        future = Future()
+        def call():
+            try:
+                result = func(*args, **kwargs)
+            except Exception:
+                future._set(exc_info=sys.exc_info())
+            else:
+                future._set(result)
+        self.pool.apply_async(call)
+        return future
+
+    def close(self):
+        """waits for the calls already submitted to finish, and stops the workers"""
+        self.pool.close()
+        self.pool.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+class AsyncTaskDAVClient(object):
+    """
+    Makes the calls of a TaskDAVClient in the worker threads of an Executor, each returning a Future rather than blocking.
+
+    Calendars are named as in TaskDAVClient.get_calendar, and are looked up by the worker, so a call can be made before the calendars
+    have been discovered; the tasks returned are ordinary Tasks of the synchronous client.
+    """
+    def __init__(self, client, executor):
+        self.client = client
+        self.executor = executor
+
+    def _calendar_call(self, calendar_name, method, *args, **kwargs):
+        return self.executor.submit(lambda: getattr(self.client.get_calendar(calendar_name), method)(*args, **kwargs))
+
+    def load_calendars(self):
+        """discovers the calendars on the server; the Future is of {calendar name: TaskList(), ...}"""
+        def load():
+            self.client.load_calendars()
+            return dict(self.client.calendar_lookup)
+        return self.executor.submit(load)
+
+    def tasks(self, calendar_name, task_filter=None, props=None):
+        """searches the tasks in the named calendar as TaskList.tasks() does; the Future is of [Task(), ...]"""
+        return self._calendar_call(calendar_name, "tasks", task_filter, props)
+
+    def iter_tasks(self, calendar_names=None, task_filter=None, props=None, timeout=None):
+        """searches the tasks in each of the named calendars (by default every calendar) at once, and yields (calendar name, [Task(), ...])
+        for each calendar as soon as its tasks arrive; a calendar whose search fails raises its exception when it is reached"""
+        if calendar_names is None:
+            calendar_names = sorted(self.load_calendars().result(timeout))
+        names = {}
+        for calendar_name in calendar_names:
+            names[self.tasks(calendar_name, task_filter, props)] = calendar_name
+        for future in as_completed(names, timeout):
+            yield names[future], future.result()
+
+    def get_task(self, calendar_name, task_id, load=True):
+        """finds a task by id or unique id prefix in the named calendar as TaskList.get_task() does; the Future is of the Task"""
+        return self._calendar_call(calendar_name, "get_task", task_id, load)
+
+    def sync_changes(self, calendar_name, state):
+        """brings the SyncState up to date with the named calendar as TaskList.sync_changes() does;
+        the Future is of ([Task(), ...] added or changed, [href, ...] deleted)"""
+        return self._calendar_call(calendar_name, "sync_changes", state)
+
+    def save(self, task):
+        """saves the task, creating it if it has no url yet, conditionally on its etag as a BatchWriter does; the Future is of its WriteResult"""
+        return self.executor.submit(lambda: BatchWriter(self.client).send(BatchWriter.save_request(task)))
+
+    def delete(self, task):
+        """deletes the task, conditionally on its etag as a BatchWriter does; the Future is of its WriteResult"""
+        return self.executor.submit(lambda: BatchWriter(self.client).send(BatchWriter.delete_request(task)))
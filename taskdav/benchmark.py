@@ -0,0 +1,296 @@
+#!/usr/bin/env python
+
+"""Times the main paths of taskdav against synthetic calendars served by the in-process CalDAV stand-in, writing the results as JSON
+
+Run it with python -m taskdav.benchmark; each calendar size is benchmarked in its own interpreter, with its own home directory,
+as tdtc reads its config when it is first imported. The same seed always generates the same calendar, so results from different
+releases can be compared."""
+
+import json
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+PACKAGE_PARENT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+DEFAULT_SIZES = (1000, 10000)
+DEFAULT_REPEAT = 3
+DEFAULT_LATENCY = 0.001
+DEFAULT_SEED = 1
+
+VERBS = ["call", "email", "buy", "fix", "review", "write", "book", "pay", "clean", "plan", "read", "update", "send", "check", "order"]
+OBJECTS = ["the dentist", "quarterly report", "milk and eggs", "the garden fence", "pull request", "slides for the meeting",
+           "train tickets", "electricity bill", "the garage", "holiday itinerary", "release notes", "invoice", "birthday present",
+           "car insurance", "team offsite", "tax return", "backup drive", "kitchen tap", "conference talk", "library books"]
+QUALIFIERS = ["", "", "", "before Friday", "again", "for Sam", "tomorrow", "next week", "if time allows", "asap"]
+CONTEXTS = ["@home", "@work", "@phone", "@errands", "@computer", "@shop", "@garden", "@office"]
+PROJECTS = ["+%s" % name for name in ["house", "garden", "release", "taxes", "holiday", "car", "website", "hiring", "budget",
+                                       "wedding", "move", "training", "conference", "backups", "cleanup"]]
+# (priority value, weight): mostly unspecified, then A-C, with a few low priorities
+PRIORITIES = [(0, 55), (1, 10), (2, 15), (3, 12), (4, 3), (6, 2), (7, 1), (8, 1), (9, 1)]
+STATUSES = [("NEEDS-ACTION", 70), ("IN-PROCESS", 5), ("COMPLETED", 25)]
+DESCRIPTION = "Some notes on what needs doing\\, gathered from the last few emails about it. Check the details before starting."
+
+TODO_TEMPLATE = ("BEGIN:VCALENDAR\r\nVERSION:2.0\r\nPRODID:-//taskdav//benchmark//EN\r\nBEGIN:VTODO\r\n"
+                 "CREATED:%(created)s\r\nDTSTAMP:%(created)s\r\nLAST-MODIFIED:%(modified)s\r\n%(extra)s"
+                 "SUMMARY:%(summary)s\r\nUID:%(uid)s\r\nEND:VTODO\r\nEND:VCALENDAR\r\n")
+
+def weighted_choice(rng, choices):
+    total = sum(weight for value, weight in choices)
+    point = rng.uniform(0, total)
+    for value, weight in choices:
+        point -= weight
+        if point <= 0:
+            return value
+    return choices[-1][0]
+
+def synthetic_tasks(count, seed=DEFAULT_SEED):
+    """generates count (uid, iCalendar data) pairs of VTODOs with realistic summaries, tags, priorities and statuses;
+    the same seed always generates the same tasks"""
+    rng = random.Random(seed)
+    start = datetime(2025, 1, 1)
+    for n in range(count):
+        words = [rng.choice(VERBS), rng.choice(OBJECTS), rng.choice(QUALIFIERS)]
+        if rng.random() < 0.6:
+            words.append(rng.choice(CONTEXTS))
+        if rng.random() < 0.4:
+            words.append(rng.choice(PROJECTS))
+        if rng.random() < 0.05:
+            words.append(rng.choice(CONTEXTS))
+        created = start + timedelta(minutes=rng.randint(0, 500000))
+        modified = created + timedelta(minutes=rng.randint(0, 50000))
+        extra = []
+        priority = weighted_choice(rng, PRIORITIES)
+        if priority:
+            extra.append("PRIORITY:%d\r\n" % priority)
+        status = weighted_choice(rng, STATUSES)
+        extra.append("STATUS:%s\r\n" % status)
+        if status == "COMPLETED":
+            extra.append("COMPLETED:%s\r\n" % modified.strftime("%Y%m%dT%H%M%SZ"))
+        if rng.random() < 0.2:
+            extra.append("DESCRIPTION:%s\r\n" % DESCRIPTION)
+        uid = "%08x-%d" % (rng.getrandbits(32), n)
+        yield uid, TODO_TEMPLATE % {"created": created.strftime("%Y%m%dT%H%M%SZ"), "modified": modified.strftime("%Y%m%dT%H%M%SZ"),
+                                    "extra": "".join(extra), "summary": " ".join(word for word in words if word), "uid": uid}
+
+def populate(dav_calendar, count, seed=DEFAULT_SEED):
+    """adds count synthetic tasks to a calendar of the stand-in server, returning their uids"""
+    uids = []
+    for uid, data in synthetic_tasks(count, seed):
+        dav_calendar.put(uid + ".ics", data)
+        uids.append(uid)
+    return uids
+
+class NullOutput(object):
+    """Discards what commands print while they are timed"""
+    closed = False
+
+    def write(self, s):
+        pass
+
+    def flush(self):
+        pass
+
+    def isatty(self):
+        return False
+
+class Benchmarks(object):
+    """A stand-in server with a synthetic calendar of size tasks, a home directory configured to use it with a synced cache store,
+    and the benchmarks to time against them. This sets HOME, so it must be created before tdtc is imported"""
+    def __init__(self, size, latency=DEFAULT_LATENCY, seed=DEFAULT_SEED):
+        from taskdav import davserver
+        self.size = size
+        self.server = davserver.CalDAVServer(latency=latency).start()
+        # every client made, so that their connections can be closed before the server stops
+        self.clients = []
+        self.uids = populate(self.server.add_calendar("Tasks"), size, seed)
+        self.home = tempfile.mkdtemp()
+        self.cache_dir = os.path.join(self.home, "cache")
+        os.mkdir(self.cache_dir)
+        host, port = self.server.httpd.server_address
+        with open(os.path.join(self.home, ".taskdav"), "w") as f:
+            f.write("[server]\nurl = http://%s:%d/\nusername = %s\npassword = %s\n[cache]\ndir = %s\ndefault = false\n"
+                    % (host, port, self.server.username, self.server.password, self.cache_dir))
+        os.environ["HOME"] = self.home
+        from taskdav import tdtc
+        self.tdtc = tdtc
+        self.run_command("ls", "-s")
+        self.rng = random.Random(seed)
+
+    def close(self):
+        for client in self.clients:
+            client.pool.close()
+        self.server.stop()
+        shutil.rmtree(self.home)
+
+    def new_calendar(self):
+        """returns the calendar as a new client finds it"""
+        from taskdav.task import TaskDAVClient
+        client = TaskDAVClient(self.server.url)
+        self.clients.append(client)
+        return client.get_calendar("Tasks")
+
+    def run_command(self, *args):
+        """runs a tdtc command as a new process would, with a new client, discarding what it prints"""
+        self.tdtc._client = None
+        saved = sys.stdout
+        sys.stdout = NullOutput()
+        try:
+            self.tdtc.app.run(["-m"] + list(args))
+        finally:
+            sys.stdout = saved
+            if self.tdtc._client is not None:
+                self.clients.append(self.tdtc._client)
+
+    # each benchmark does any setup, and returns the function to time
+
+    def bench_tasks(self):
+        calendar = self.new_calendar()
+        return calendar.tasks
+
+    def bench_tasks_listed(self):
+        from taskdav.task import Task
+        calendar = self.new_calendar()
+        return lambda: calendar.tasks(props=Task.LIST_PROPS)
+
+    def bench_get_tasks_cache(self):
+        from taskdav import cache
+        def get_tasks():
+            task_store = cache.open_store(self.cache_dir)
+            task_store.get_tasks()
+            task_store.close()
+        return get_tasks
+
+    def bench_sorted_tasks(self):
+        task_lookup = self.new_calendar().get_tasks()
+        return lambda: self.tdtc.sorted_tasks(task_lookup)
+
+    def bench_shortest_all(self):
+        from taskdav import short_id
+        ids = short_id.prefix_dict((uid, None) for uid in self.uids)
+        return ids.shortest_all
+
+    def bench_shortest(self):
+        from taskdav import short_id
+        ids = short_id.prefix_dict((uid, None) for uid in self.uids)
+        sample = self.rng.sample(self.uids, min(1000, len(self.uids)))
+        return lambda: [ids.shortest(uid) for uid in sample]
+
+    def bench_list(self):
+        return lambda: self.run_command("ls")
+
+    def bench_list_cache(self):
+        return lambda: self.run_command("ls", "-C")
+
+    def bench_list_cache_process(self):
+        # a new interpreter, so that the time includes starting up and importing, with the cache store and the modules' files warmed first
+        def list_cache():
+            with open(os.devnull, "w") as devnull:
+                subprocess.check_call([sys.executable, "-m", "taskdav.tdtc", "-m", "ls", "-C"], env=dict(os.environ, HOME=self.home),
+                                      cwd=PACKAGE_PARENT, stdout=devnull)
+        list_cache()
+        return list_cache
+
+    def bench_report(self):
+        return lambda: self.run_command("report")
+
+    def bench_report_cache(self):
+        return lambda: self.run_command("report", "-C")
+
+    def bench_batch_save(self):
+        from taskdav.task import BatchWriter
+        calendar = self.new_calendar()
+        writer = BatchWriter(calendar.client)
+        for uid in self.rng.sample(self.uids, min(20, len(self.uids))):
+            task = calendar.get_task(uid)
+            task.summary += " again"
+            writer.save(task)
+        return writer.run
+
+    def bench_do(self):
+        task_id = self.uids.pop(self.rng.randrange(len(self.uids)))
+        return lambda: self.run_command("do", task_id)
+
+    @classmethod
+    def names(cls):
+        return [name[len("bench_"):] for name in sorted(vars(cls)) if name.startswith("bench_")]
+
+    def time(self, name, repeat=DEFAULT_REPEAT):
+        """returns the times taken by repeat runs of the named benchmark, each after its own setup"""
+        times = []
+        for n in range(repeat):
+            run = getattr(self, "bench_" + name)()
+            start = time.time()
+            run()
+            times.append(time.time() - start)
+        return times
+
+def median(values):
+    values = sorted(values)
+    middle = len(values) // 2
+    return values[middle] if len(values) % 2 else (values[middle - 1] + values[middle]) / 2.0
+
+def run_size(size, names=None, repeat=DEFAULT_REPEAT, latency=DEFAULT_LATENCY, seed=DEFAULT_SEED):
+    """runs the named benchmarks (by default all of them) against a calendar of size tasks, returning a result for each"""
+    benchmarks = Benchmarks(size, latency, seed)
+    try:
+        results = []
+        for name in names or Benchmarks.names():
+            times = benchmarks.time(name, repeat)
+            results.append({"benchmark": name, "size": size, "times": times, "best": min(times), "median": median(times)})
+        return results
+    finally:
+        benchmarks.close()
+
+def run(sizes=DEFAULT_SIZES, names=None, repeat=DEFAULT_REPEAT, latency=DEFAULT_LATENCY, seed=DEFAULT_SEED, label=None):
+    """runs the benchmarks for each size in a new interpreter, returning the results with details of the run"""
+    results = []
+    temp_dir = tempfile.mkdtemp()
+    try:
+        for size in sizes:
+            filename = os.path.join(temp_dir, "%d.json" % size)
+            args = [sys.executable, "-m", "taskdav.benchmark", "--size-only", "--sizes", str(size), "--repeat", str(repeat),
+                    "--latency", str(latency), "--seed", str(seed), "--output", filename]
+            if names:
+                args += ["--only", ",".join(names)]
+            subprocess.check_call(args, cwd=PACKAGE_PARENT)
+            with open(filename) as f:
+                results.extend(json.load(f))
+    finally:
+        shutil.rmtree(temp_dir)
+    return {"label": label, "started": datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%SZ"), "python": platform.python_version(),
+            "platform": platform.platform(), "repeat": repeat, "latency": latency, "seed": seed, "results": results}
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Times the main paths of taskdav against synthetic calendars, writing the results as JSON")
+    parser.add_argument('--sizes', default=",".join(str(size) for size in DEFAULT_SIZES), help="Comma-separated numbers of tasks to generate (default: %(default)s)")
+    parser.add_argument('--only', default=None, help="Comma-separated benchmarks to run, from %s (default: all)" % ", ".join(Benchmarks.names()))
+    parser.add_argument('-r', '--repeat', type=int, default=DEFAULT_REPEAT, help="Times to run each benchmark (default: %(default)s)")
+    parser.add_argument('-l', '--latency', type=float, default=DEFAULT_LATENCY, help="Seconds the server waits before each response (default: %(default)s)")
+    parser.add_argument('--seed', type=int, default=DEFAULT_SEED, help="Seed for generating the calendars (default: %(default)s)")
+    parser.add_argument('--label', default=None, help="Label for the results, such as the release being benchmarked")
+    parser.add_argument('-o', '--output', default=None, help="File to write the results to (default: standard output)")
+    parser.add_argument('--size-only', action='store_true', help=argparse.SUPPRESS)
+    options = parser.parse_args()
+    sizes = [int(size) for size in options.sizes.split(",")]
+    names = options.only.split(",") if options.only else None
+    for name in names or ():
+        if name not in Benchmarks.names():
+            parser.error("unknown benchmark %s" % name)
+    if options.size_only:
+        results = run_size(sizes[0], names, options.repeat, options.latency, options.seed)
+    else:
+        results = run(sizes, names, options.repeat, options.latency, options.seed, options.label)
+    output = json.dumps(results, indent=2, sort_keys=True)
+    if options.output:
+        with open(options.output, "w") as f:
+            f.write(output + "\n")
+    else:
+        print output
@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+
+"""Opens the local task store kept in the cache directory, and keeps the calendars found on the server, and the ids of their tasks,
+between runs"""
+
+import json
+import os
+import time
+from taskdav import parallel
+from taskdav.store import TaskStore, write_atomically
+
+STORE_DIRNAME = ".taskdav"
+STORE_FILENAME = "tasks.sqlite"
+CALENDARS_FILENAME = "calendars.json"
+IDS_FILENAME = "ids.json"
+SNAPSHOTS_FILENAME = "snapshots.jsonl"
+JOURNAL_FILENAME = "journal.jsonl"
+
+def open_store(cache_dir, parse_workers=1, parse_threshold=parallel.DEFAULT_THRESHOLD):
+    """opens the TaskStore for cache_dir, first importing any .ics files in the directory that have changed,
+    with the given parse_workers and parse_threshold
+
+    The store is kept in a subdirectory so that its own files aren't mistaken for tasks"""
+    store_dir = os.path.join(cache_dir, STORE_DIRNAME)
+    if not os.path.isdir(store_dir):
+        os.makedirs(store_dir)
+    task_store = TaskStore(os.path.join(store_dir, STORE_FILENAME))
+    task_store.import_dir(cache_dir, parse_workers, parse_threshold)
+    return task_store
+
+def calendars_filename(cache_dir=None):
+    """returns the file to keep the calendars found on the server in: alongside the store if there is a cache_dir, or else in the home directory"""
+    if cache_dir is None:
+        return os.path.expanduser("~/.taskdav-calendars.json")
+    return os.path.join(cache_dir, STORE_DIRNAME, CALENDARS_FILENAME)
+
+def ids_filename(cache_dir=None):
+    """returns the file to keep the ids of the tasks in each calendar in, alongside the calendars"""
+    if cache_dir is None:
+        return os.path.expanduser("~/.taskdav-ids.json")
+    return os.path.join(cache_dir, STORE_DIRNAME, IDS_FILENAME)
+
+def snapshots_filename(cache_dir):
+    """returns the file to keep the snapshots taken by report in, alongside the store"""
+    return os.path.join(cache_dir, STORE_DIRNAME, SNAPSHOTS_FILENAME)
+
+def journal_filename(cache_dir):
+    """returns the file to keep the journal of writes made in write-behind mode in, alongside the store"""
+    return os.path.join(cache_dir, STORE_DIRNAME, JOURNAL_FILENAME)
+
+class JSONCache(object):
+    """A dict kept in a JSON file between runs, which is read when first needed"""
+    def __init__(self, filename):
+        self.filename = filename
+        self._contents = None
+
+    def _load(self):
+        if self._contents is None:
+            try:
+                with open(self.filename) as f:
+                    self._contents = json.load(f)
+            except (IOError, ValueError):
+                self._contents = {}
+        return self._contents
+
+    def save(self):
+        """writes the file by renaming a new one over it, so that other processes never read it half written"""
+        dirname = os.path.dirname(self.filename)
+        if dirname and not os.path.isdir(dirname):
+            os.makedirs(dirname)
+        write_atomically(self.filename, json.dumps(self._load()))
+
+class CalendarCache(JSONCache):
+    """The calendars found for each principal url by TaskDAVClient.load_calendars, kept in a JSON file between runs
+
+    Each calendar's url and ctag are kept with the time they were last checked; entries checked more than ttl seconds ago are stale"""
+    def __init__(self, filename, ttl=3600):
+        JSONCache.__init__(self, filename)
+        self.ttl = ttl
+
+    def get(self, principal_url, name):
+        """returns (url, ctag, fresh) for the named calendar, or None if it isn't known"""
+        entry = self._load().get(principal_url, {}).get(name)
+        if entry is None:
+            return None
+        return entry["url"], entry["ctag"], time.time() - entry["checked"] < self.ttl
+
+    def set_calendars(self, principal_url, calendars):
+        """replaces all the calendars known for principal_url with the given dict mapping name to (url, ctag)"""
+        checked = time.time()
+        self._load()[principal_url] = {name: {"url": url, "ctag": ctag, "checked": checked} for name, (url, ctag) in calendars.items()}
+        self.save()
+
+    def set_calendar(self, principal_url, name, url, ctag):
+        """records that the named calendar has just been checked"""
+        self._load().setdefault(principal_url, {})[name] = {"url": url, "ctag": ctag, "checked": time.time()}
+        self.save()
+
+class IdCache(JSONCache):
+    """The ids of the tasks in each calendar found by TaskList.get_id_index, with the href and etag of each, kept in a JSON file between runs
+    along with the calendar's ctag at the time, so that they can be used for as long as the calendar hasn't changed"""
+    def get(self, calendar_url):
+        """returns (ctag, {id: (href, etag), ...}) for the calendar with the given url, or None if its ids aren't known"""
+        entry = self._load().get(calendar_url)
+        if entry is None:
+            return None
+        return entry["ctag"], {task_id: tuple(value) for task_id, value in entry["ids"].items()}
+
+    def set(self, calendar_url, ctag, ids):
+        """records the ids of the tasks in the calendar with the given url, as a dict mapping id to (href, etag), at the given ctag"""
+        self._load()[calendar_url] = {"ctag": ctag, "ids": ids}
+        self.save()
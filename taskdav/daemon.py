@@ -0,0 +1,217 @@
+#!/usr/bin/env python
+
+"""A long-running daemon that keeps the client, the calendars and their tasks in memory, syncing them in the background,
+and runs the tdtc commands sent to it over a Unix domain socket
+
+Run it with python -m taskdav.daemon; tdtc sends its commands to it whenever it is running, and runs them itself otherwise.
+Only the light modules needed to forward a command are imported here; tdtc itself is imported when the daemon starts."""
+
+import json
+import os
+import signal
+import socket
+import sys
+import threading
+import traceback
+import SocketServer
+from taskdav import config
+
+DEFAULT_SOCKET = "~/.taskdav-daemon.sock"
+DEFAULT_SYNC_INTERVAL = 60
+
+def socket_path(cfg=None):
+    """returns the path of the daemon's socket: daemon.socket in the config, or else in the home directory"""
+    cfg = cfg or config.get_config()
+    path = cfg.get('daemon', 'socket') if cfg.has_option('daemon', 'socket') else DEFAULT_SOCKET
+    return os.path.expanduser(path)
+
+def forward(args, path=None):
+    """sends the tdtc command line args to the daemon, and writes out what the command printed.
+    Returns the command's exit status, or None if no daemon is running or the command has to be run directly"""
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        try:
+            sock.connect(path or socket_path())
+        except socket.error:
+            return None
+        sock.sendall(json.dumps({"args": args, "tty": sys.stdout.isatty()}) + "\n")
+        sock.shutdown(socket.SHUT_WR)
+        chunks = []
+        chunk = sock.recv(65536)
+        while chunk:
+            chunks.append(chunk)
+            chunk = sock.recv(65536)
+    finally:
+        sock.close()
+    if not chunks:
+        # the daemon stopped before the command could be run
+        return None
+    response = json.loads("".join(chunks))
+    if response.get("direct"):
+        return None
+    sys.stdout.write(response["stdout"].encode("utf-8"))
+    sys.stderr.write(response["stderr"].encode("utf-8"))
+    return response["status"]
+
+class NeedsTerminal(Exception):
+    """Raised when a command run by the daemon tries to read input, which only a direct run can do"""
+
+class NoInput(object):
+    """Stands in for stdin while the daemon runs a command"""
+    def readline(self, *args):
+        raise NeedsTerminal()
+    read = readline
+
+class CommandOutput(object):
+    """Collects what a command prints, to send back to tdtc. Unicode is encoded as utf-8, and isatty reports
+    whether tdtc's own output is a terminal, so that colorama only strips the colors when it would have done so there"""
+    closed = False
+
+    def __init__(self, tty=False):
+        self.tty = tty
+        self.parts = []
+
+    def write(self, s):
+        self.parts.append(s.encode("utf-8") if isinstance(s, unicode) else s)
+
+    def flush(self):
+        pass
+
+    def isatty(self):
+        return self.tty
+
+    def getvalue(self):
+        return "".join(self.parts)
+
+class TaskDaemon(object):
+    """Runs tdtc commands one at a time against a client, calendars and tasks that are kept in memory between them.
+    The tasks of every calendar are synced every sync_interval seconds, and straight after each command that writes;
+    after a command whose writes fail, they are all loaded afresh, as the tasks it changed in memory no longer match the server"""
+    def __init__(self, sync_interval=DEFAULT_SYNC_INTERVAL):
+        from taskdav import tdtc
+        self.tdtc = tdtc
+        self.sync_interval = sync_interval
+        self.lock = threading.Lock()
+        self.written = False
+        self.failed = False
+        self.stopped = threading.Event()
+        tdtc.write_listeners.append(self.mark_written)
+        tdtc.write_failure_listeners.append(self.mark_failed)
+
+    def mark_written(self):
+        self.written = True
+
+    def mark_failed(self):
+        self.written = self.failed = True
+
+    def sync(self):
+        """loads, or brings up to date, the tasks of every calendar on the server"""
+        with self.lock:
+            self.written = False
+            failed, self.failed = self.failed, False
+            def sync_tasks(calendar):
+                if failed:
+                    calendar.forget_tasks()
+                return calendar.sync_tasks()
+            try:
+                self.tdtc.get_client().map_calendars(sync_tasks)
+            except Exception:
+                traceback.print_exc()
+
+    def sync_if_written(self):
+        if self.written:
+            self.sync()
+
+    def sync_periodically(self):
+        while not self.stopped.wait(self.sync_interval):
+            self.sync()
+
+    def run_command(self, args, tty=False):
+        """runs the tdtc command line args as tdtc would, returning a response with what it printed and its exit status,
+        or with direct set if the command tried to read input"""
+        stdout, stderr = CommandOutput(tty), CommandOutput()
+        with self.lock:
+            saved = sys.stdin, sys.stdout, sys.stderr
+            sys.stdin, sys.stdout, sys.stderr = NoInput(), stdout, stderr
+            try:
+                self.tdtc.run(args)
+                status = 0
+            except NeedsTerminal:
+                return {"direct": True}
+            except SystemExit, e:
+                if e.code is None or isinstance(e.code, int):
+                    status = e.code or 0
+                else:
+                    print >>stderr, e.code
+                    status = 1
+            except Exception:
+                traceback.print_exc()
+                status = 1
+            finally:
+                sys.stdin, sys.stdout, sys.stderr = saved
+        return {"stdout": stdout.getvalue(), "stderr": stderr.getvalue(), "status": status}
+
+class CommandHandler(SocketServer.StreamRequestHandler):
+    def handle(self):
+        request = json.loads(self.rfile.readline())
+        response = self.server.task_daemon.run_command(request["args"], request.get("tty", False))
+        self.wfile.write(json.dumps(response))
+        self.wfile.flush()
+        # let tdtc finish before syncing any changes the command made
+        self.request.shutdown(socket.SHUT_WR)
+        self.server.task_daemon.sync_if_written()
+
+class DaemonServer(SocketServer.UnixStreamServer):
+    def __init__(self, path, task_daemon):
+        self.task_daemon = task_daemon
+        # the daemon acts with the user's credentials, so only the user may connect to it
+        umask = os.umask(0077)
+        try:
+            SocketServer.UnixStreamServer.__init__(self, path, CommandHandler)
+        finally:
+            os.umask(umask)
+
+def remove_stale_socket(path):
+    """removes the socket left behind by a daemon that is no longer running, raising ValueError if one is still running"""
+    if not os.path.exists(path):
+        return
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+    except socket.error:
+        os.remove(path)
+    else:
+        raise ValueError("A daemon is already running on %s" % path)
+    finally:
+        sock.close()
+
+def serve(path=None, sync_interval=None):
+    """loads the tasks of every calendar, then serves commands on the socket at path until interrupted"""
+    cfg = config.get_config()
+    path = path or socket_path(cfg)
+    if sync_interval is None:
+        sync_interval = cfg.getint('daemon', 'sync_interval') if cfg.has_option('daemon', 'sync_interval') else DEFAULT_SYNC_INTERVAL
+    task_daemon = TaskDaemon(sync_interval)
+    task_daemon.sync()
+    remove_stale_socket(path)
+    server = DaemonServer(path, task_daemon)
+    syncer = threading.Thread(target=task_daemon.sync_periodically)
+    syncer.daemon = True
+    syncer.start()
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        task_daemon.stopped.set()
+        server.server_close()
+        os.remove(path)
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Keeps tasks in memory and runs tdtc commands sent to it over a Unix domain socket")
+    parser.add_argument('-s', '--socket', dest='path', default=None, help="Path of the socket (default: daemon.socket in config, or %s)" % DEFAULT_SOCKET)
+    parser.add_argument('-i', '--sync-interval', type=int, default=None, help="Seconds between syncs with the server (default: %d)" % DEFAULT_SYNC_INTERVAL)
+    options = parser.parse_args()
+    serve(options.path, options.sync_interval)
@@ -0,0 +1,460 @@
+#!/usr/bin/env python
+
+"""A small in-process CalDAV stand-in server, for testing and benchmarking the client against"""
+
+import BaseHTTPServer
+import SocketServer
+import hashlib
+import threading
+import time
+import urllib2
+import urlparse
+from lxml import etree
+import ical
+
+DAV_NS = "DAV:"
+CALDAV_NS = "urn:ietf:params:xml:ns:caldav"
+CS_NS = "http://calendarserver.org/ns/"
+NSMAP = {"D": DAV_NS, "C": CALDAV_NS, "CS": CS_NS}
+SYNC_TOKEN_PREFIX = "http://taskdav.invalid/sync/"
+
+def dav(tag):
+    return "{%s}%s" % (DAV_NS, tag)
+
+def caldav(tag):
+    return "{%s}%s" % (CALDAV_NS, tag)
+
+def cs(tag):
+    return "{%s}%s" % (CS_NS, tag)
+
+def make_etag(data):
+    return '"%s"' % hashlib.md5(data).hexdigest()
+
+class DAVCalendar(object):
+    """A calendar collection held by the server: maps resource names to (etag, data)"""
+    def __init__(self, server, path, name):
+        self.server = server
+        self.path = path
+        self.name = name
+        self.resources = {}
+        self.ctag = 0
+        # list of (change number, resource name), for sync-collection
+        self.changes = []
+
+    def href(self, resource_name):
+        return self.path + urllib2.quote(resource_name)
+
+    def changed(self, resource_name):
+        self.ctag = self.server.next_change()
+        self.changes.append((self.ctag, resource_name))
+
+    def put(self, resource_name, data):
+        etag = make_etag(data)
+        self.resources[resource_name] = (etag, data)
+        self.changed(resource_name)
+        return etag
+
+    def delete(self, resource_name):
+        del self.resources[resource_name]
+        self.changed(resource_name)
+
+    @property
+    def sync_token(self):
+        return "%s%d" % (SYNC_TOKEN_PREFIX, self.ctag)
+
+    def changed_since(self, change_number):
+        """returns the set of resource names changed after the given change number"""
+        return {name for number, name in self.changes if number > change_number}
+
+def text_matches(text_match, value):
+    """checks a CalDAV text-match element against a property value"""
+    text = text_match.text or ""
+    if text_match.get("collation", "i;ascii-casemap") != "i;octet":
+        text, value = text.lower(), value.lower()
+    matched = text in value
+    return not matched if text_match.get("negate-condition") == "yes" else matched
+
+def filter_matches(comp_filter, data):
+    """checks the prop-filters of a VTODO comp-filter against a resource's data"""
+    prop_filters = comp_filter.findall(caldav("prop-filter"))
+    fields = ical.extract_fields(data, {f.get("name").upper() for f in prop_filters}, comp_filter.get("name").upper())
+    for prop_filter in prop_filters:
+        value = fields.get(prop_filter.get("name").upper())
+        if prop_filter.find(caldav("is-not-defined")) is not None:
+            if value is not None:
+                return False
+        elif value is None:
+            return False
+        else:
+            text_match = prop_filter.find(caldav("text-match"))
+            if text_match is not None and not text_matches(text_match, value.decode("utf-8")):
+                return False
+    return True
+
+def content_lines(data):
+    """splits iCalendar data into content lines, each keeping its folded continuation lines"""
+    lines = []
+    for line in data.splitlines(True):
+        if lines and line[:1] in (" ", "\t"):
+            lines[-1] += line
+        else:
+            lines.append(line)
+    return lines
+
+ALL = "all"
+
+def child_comp(comp, name):
+    """returns the comp element for a sub-component called name within comp (or ALL if everything is wanted), or None if it's excluded"""
+    if comp is ALL or comp.find(caldav("allcomp")) is not None:
+        return ALL
+    for child in comp.findall(caldav("comp")):
+        if child.get("name").upper() == name:
+            return child
+    return None
+
+def wants_prop(comp, name):
+    if comp is ALL or comp.find(caldav("allprop")) is not None:
+        return True
+    return name in {prop.get("name").upper() for prop in comp.findall(caldav("prop"))}
+
+def subset_data(calendar_data, data):
+    """returns just the components and properties of data requested by the comp elements of a calendar-data element"""
+    comp = calendar_data.find(caldav("comp"))
+    if comp is None:
+        return data
+    result, stack = [], []
+    for line in content_lines(data):
+        name, _, value = line.partition(":")
+        name, value = name.split(";", 1)[0].upper(), value.strip().upper()
+        if name == "BEGIN":
+            if not stack:
+                stack.append(comp if comp.get("name").upper() == value else None)
+            else:
+                stack.append(child_comp(stack[-1], value) if stack[-1] is not None else None)
+            if stack[-1] is not None:
+                result.append(line)
+        elif name == "END":
+            if stack.pop() is not None:
+                result.append(line)
+        elif stack and stack[-1] is not None and wants_prop(stack[-1], name):
+            result.append(line)
+    return "".join(result)
+
+class DAVRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Handles the subset of WebDAV / CalDAV that the taskdav client uses"""
+    protocol_version = "HTTP/1.1"
+    # buffer each response so that its headers and body are sent together
+    wbufsize = -1
+
+    def log_message(self, format, *args):
+        pass
+
+    def read_body(self):
+        length = int(self.headers.getheader("content-length") or 0)
+        return self.rfile.read(length) if length else ""
+
+    def send_body(self, status, body, content_type="application/xml; charset=utf-8", headers=None):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+        self.server.dav.log_request(self.command, self.path, len(body))
+
+    def send_multistatus(self, responses, sync_token=None):
+        root = etree.Element(dav("multistatus"), nsmap=NSMAP)
+        root.extend(responses)
+        if sync_token is not None:
+            etree.SubElement(root, dav("sync-token")).text = sync_token
+        self.send_body(207, etree.tostring(root, encoding="utf-8", xml_declaration=True))
+
+    def dispatch(self):
+        # read the body before taking the lock, so a slow client doesn't hold up other requests
+        self.body = self.read_body()
+        self.server.dav.wait()
+        status = self.server.dav.next_failure(self.command)
+        if status is not None:
+            if status:
+                self.send_body(status, "", content_type="text/plain")
+            else:
+                self.server.dav.log_request(self.command, self.path, 0)
+                self.close_connection = 1
+            return
+        handler = getattr(self, "handle_%s" % self.command, None)
+        if handler is None:
+            self.send_body(405, "", content_type="text/plain")
+            return
+        with self.server.dav.lock:
+            handler()
+
+    do_GET = do_PUT = do_DELETE = do_PROPFIND = do_REPORT = dispatch
+
+    def find(self):
+        """returns (calendar, resource name) for the request path; either may be None"""
+        return self.server.dav.find(urllib2.unquote(self.path.split("?")[0]))
+
+    def handle_GET(self):
+        calendar, resource_name = self.find()
+        if calendar is None or resource_name not in calendar.resources:
+            self.send_body(404, "", content_type="text/plain")
+            return
+        etag, data = calendar.resources[resource_name]
+        self.send_body(200, data, content_type="text/calendar; charset=utf-8", headers={"ETag": etag})
+
+    def check_precondition(self, calendar, resource_name):
+        """checks If-Match / If-None-Match headers, sending a 412 response and returning False if they fail"""
+        current = calendar.resources.get(resource_name)
+        if_match = self.headers.getheader("if-match")
+        if_none_match = self.headers.getheader("if-none-match")
+        if if_match is not None and (current is None or (if_match != "*" and if_match != current[0])):
+            self.send_body(412, "", content_type="text/plain")
+            return False
+        if if_none_match == "*" and current is not None:
+            self.send_body(412, "", content_type="text/plain")
+            return False
+        return True
+
+    def handle_PUT(self):
+        body = self.body
+        calendar, resource_name = self.find()
+        if calendar is None or resource_name is None:
+            self.send_body(409, "", content_type="text/plain")
+            return
+        if not self.check_precondition(calendar, resource_name):
+            return
+        status = 204 if resource_name in calendar.resources else 201
+        etag = calendar.put(resource_name, body)
+        self.send_body(status, "", content_type="text/plain", headers={"ETag": etag})
+
+    def handle_DELETE(self):
+        calendar, resource_name = self.find()
+        if calendar is None or resource_name not in calendar.resources:
+            self.send_body(404, "", content_type="text/plain")
+            return
+        if not self.check_precondition(calendar, resource_name):
+            return
+        calendar.delete(resource_name)
+        self.send_body(204, "", content_type="text/plain")
+
+    def requested_props(self, body):
+        """returns the list of property tags requested in a propfind/report body"""
+        if not body:
+            return None
+        prop = etree.XML(body).find(dav("prop"))
+        return [child.tag for child in prop] if prop is not None else None
+
+    def collection_response(self, href, calendar, props):
+        response = etree.Element(dav("response"))
+        etree.SubElement(response, dav("href")).text = href
+        propstat = etree.SubElement(response, dav("propstat"))
+        prop = etree.SubElement(propstat, dav("prop"))
+        for tag in props or [dav("resourcetype"), dav("displayname")]:
+            element = etree.SubElement(prop, tag)
+            if tag == dav("resourcetype"):
+                etree.SubElement(element, dav("collection"))
+                if calendar is not None:
+                    etree.SubElement(element, caldav("calendar"))
+            elif tag == dav("displayname") and calendar is not None:
+                element.text = calendar.name
+            elif tag == cs("getctag") and calendar is not None:
+                element.text = str(calendar.ctag)
+            elif tag == dav("sync-token") and calendar is not None and self.server.dav.sync_collection:
+                element.text = calendar.sync_token
+        etree.SubElement(propstat, dav("status")).text = "HTTP/1.1 200 OK"
+        return response
+
+    def resource_response(self, calendar, resource_name, props, calendar_data=None):
+        response = etree.Element(dav("response"))
+        etree.SubElement(response, dav("href")).text = calendar.href(resource_name)
+        if resource_name not in calendar.resources:
+            etree.SubElement(response, dav("status")).text = "HTTP/1.1 404 Not Found"
+            return response
+        etag, data = calendar.resources[resource_name]
+        propstat = etree.SubElement(response, dav("propstat"))
+        prop = etree.SubElement(propstat, dav("prop"))
+        for tag in props or [dav("getetag")]:
+            element = etree.SubElement(prop, tag)
+            if tag == dav("getetag"):
+                element.text = etag
+            elif tag == caldav("calendar-data"):
+                element.text = (subset_data(calendar_data, data) if calendar_data is not None else data).decode("utf-8")
+        etree.SubElement(propstat, dav("status")).text = "HTTP/1.1 200 OK"
+        return response
+
+    def handle_PROPFIND(self):
+        props = self.requested_props(self.body)
+        depth = self.headers.getheader("depth", "0")
+        path = urllib2.unquote(self.path)
+        server = self.server.dav
+        calendar, resource_name = self.find()
+        if calendar is not None and resource_name is not None:
+            if resource_name not in calendar.resources:
+                self.send_body(404, "", content_type="text/plain")
+                return
+            self.send_multistatus([self.resource_response(calendar, resource_name, props)])
+        elif calendar is not None:
+            responses = [self.collection_response(calendar.path, calendar, props)]
+            if depth != "0":
+                responses.extend(self.resource_response(calendar, name, props) for name in sorted(calendar.resources))
+            self.send_multistatus(responses)
+        elif path.rstrip("/") == server.principal_path.rstrip("/"):
+            responses = [self.collection_response(server.principal_path, None, props)]
+            if depth != "0":
+                responses.extend(self.collection_response(c.path, c, props) for c in server.calendars.values())
+            self.send_multistatus(responses)
+        else:
+            self.send_body(404, "", content_type="text/plain")
+
+    def handle_REPORT(self):
+        body = self.body
+        calendar, resource_name = self.find()
+        if calendar is None or resource_name is not None:
+            self.send_body(404, "", content_type="text/plain")
+            return
+        query = etree.XML(body)
+        props = self.requested_props(body)
+        if query.tag == caldav("calendar-query"):
+            names = sorted(calendar.resources)
+            comp_filter = query.find("%s/%s/%s" % (caldav("filter"), caldav("comp-filter"), caldav("comp-filter")))
+            if comp_filter is not None and len(comp_filter):
+                if not self.server.dav.filters:
+                    error = etree.Element(dav("error"), nsmap=NSMAP)
+                    etree.SubElement(error, caldav("supported-filter"))
+                    self.send_body(403, etree.tostring(error, encoding="utf-8", xml_declaration=True))
+                    return
+                names = [name for name in names if filter_matches(comp_filter, calendar.resources[name][1])]
+            calendar_data = query.find("%s/%s" % (dav("prop"), caldav("calendar-data")))
+            self.send_multistatus([self.resource_response(calendar, name, props, calendar_data) for name in names])
+        elif query.tag == dav("sync-collection") and self.server.dav.sync_collection:
+            token = query.findtext(dav("sync-token")) or ""
+            if not token:
+                names = sorted(calendar.resources)
+            elif token.startswith(SYNC_TOKEN_PREFIX) and token[len(SYNC_TOKEN_PREFIX):].isdigit():
+                names = sorted(calendar.changed_since(int(token[len(SYNC_TOKEN_PREFIX):])))
+            else:
+                error = etree.Element(dav("error"), nsmap=NSMAP)
+                etree.SubElement(error, dav("valid-sync-token"))
+                self.send_body(409, etree.tostring(error, encoding="utf-8", xml_declaration=True))
+                return
+            self.send_multistatus([self.resource_response(calendar, name, props) for name in names], calendar.sync_token)
+        elif query.tag == caldav("calendar-multiget") and self.server.dav.multiget:
+            calendar_data = query.find("%s/%s" % (dav("prop"), caldav("calendar-data")))
+            responses = []
+            for href in query.findall(dav("href")):
+                href_calendar, name = self.server.dav.find(urllib2.unquote(urlparse.urlparse(href.text).path))
+                if href_calendar is calendar and name:
+                    responses.append(self.resource_response(calendar, name, props, calendar_data))
+                else:
+                    response = etree.Element(dav("response"))
+                    etree.SubElement(response, dav("href")).text = href.text
+                    etree.SubElement(response, dav("status")).text = "HTTP/1.1 404 Not Found"
+                    responses.append(response)
+            self.send_multistatus(responses)
+        else:
+            error = etree.Element(dav("error"), nsmap=NSMAP)
+            etree.SubElement(error, dav("supported-report"))
+            self.send_body(501, etree.tostring(error, encoding="utf-8", xml_declaration=True))
+
+class ThreadedHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+    # enough for clients opening many connections at once
+    request_queue_size = 64
+
+class CalDAVServer(object):
+    """An in-process CalDAV server holding calendars of tasks in memory
+
+    latency is an artificial delay in seconds added to each request;
+    sync_collection and multiget control whether the RFC 6578 sync-collection and RFC 4791 calendar-multiget reports are supported,
+    and filters whether calendar-query prop-filters are supported or rejected"""
+    def __init__(self, username="user", password="password", latency=0.0, sync_collection=True, filters=True, multiget=True):
+        self.username = username
+        self.password = password
+        self.latency = latency
+        self.sync_collection = sync_collection
+        self.filters = filters
+        self.multiget = multiget
+        self.principal_path = "/dav/%s/" % username
+        self.calendars = {}
+        self.change_number = 0
+        self.requests = []
+        # the number of requests being handled, and the most that have been at once
+        self.in_flight = 0
+        self.most_in_flight = 0
+        # the statuses to answer the next requests of each method with instead of handling them, by method
+        self.failures = {}
+        self.lock = threading.RLock()
+        self.httpd = None
+        self.thread = None
+
+    def next_change(self):
+        self.change_number += 1
+        return self.change_number
+
+    def wait(self):
+        """delays a request by the latency, counting it in flight meanwhile, so that tests can see how many requests a client sends at once"""
+        with self.lock:
+            self.in_flight += 1
+            self.most_in_flight = max(self.most_in_flight, self.in_flight)
+        try:
+            if self.latency:
+                time.sleep(self.latency)
+        finally:
+            with self.lock:
+                self.in_flight -= 1
+
+    def fail_next(self, method, *statuses):
+        """answers the next requests of the given method with the given statuses, one each, instead of handling them;
+        a status of 0 closes the connection without answering, as if it had dropped after the request was sent"""
+        with self.lock:
+            self.failures.setdefault(method, []).extend(statuses)
+
+    def next_failure(self, method):
+        with self.lock:
+            statuses = self.failures.get(method)
+            return statuses.pop(0) if statuses else None
+
+    def log_request(self, method, path, response_bytes):
+        self.requests.append((method, path, response_bytes))
+
+    def add_calendar(self, name, urlname=None):
+        path = "%s%s/" % (self.principal_path, urlname or name)
+        calendar = self.calendars[path] = DAVCalendar(self, path, name)
+        return calendar
+
+    def get_calendar(self, name):
+        for calendar in self.calendars.values():
+            if calendar.name == name:
+                return calendar
+        raise KeyError(name)
+
+    def find(self, path):
+        """returns (calendar, resource name) for the given path; either may be None"""
+        for calendar_path, calendar in self.calendars.items():
+            if path == calendar_path or path + "/" == calendar_path:
+                return calendar, None
+            if path.startswith(calendar_path) and "/" not in path[len(calendar_path):]:
+                return calendar, path[len(calendar_path):]
+        return None, None
+
+    @property
+    def url(self):
+        """the url to give to TaskDAVClient, including credentials and the principal path"""
+        host, port = self.httpd.server_address
+        return "http://%s:%s@%s:%d%s" % (self.username, self.password, host, port, self.principal_path)
+
+    def start(self):
+        self.httpd = ThreadedHTTPServer(("127.0.0.1", 0), DAVRequestHandler)
+        self.httpd.dav = self
+        self.thread = threading.Thread(target=self.httpd.serve_forever, kwargs={"poll_interval": 0.05})
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        if self.httpd is not None:
+            self.httpd.shutdown()
+            self.httpd.server_close()
+            self.httpd = None
@@ -0,0 +1,55 @@
+#!/usr/bin/env python
+
+"""WebDAV / CalDAV elements used by taskdav that caldav.elements does not provide"""
+
+from caldav.elements.base import BaseElement, NamedBaseElement, ValuedBaseElement
+from caldav.lib.namespace import ns
+
+CS_NS = "http://calendarserver.org/ns/"
+
+class Multistatus(BaseElement):
+    tag = ns("D", "multistatus")
+
+class Error(BaseElement):
+    tag = ns("D", "error")
+
+# RFC 4791 calendar-multiget report
+class CalendarMultiget(BaseElement):
+    tag = ns("C", "calendar-multiget")
+
+# RFC 6578 collection synchronization
+class SyncCollection(BaseElement):
+    tag = ns("D", "sync-collection")
+
+class SyncToken(ValuedBaseElement):
+    tag = ns("D", "sync-token")
+
+class SyncLevel(ValuedBaseElement):
+    tag = ns("D", "sync-level")
+
+class ValidSyncToken(BaseElement):
+    tag = ns("D", "valid-sync-token")
+
+# the precondition a server gives when it doesn't support a report
+class SupportedReport(BaseElement):
+    tag = ns("D", "supported-report")
+
+# CalendarServer collection tag, changed whenever anything in the collection changes
+class GetCTag(BaseElement):
+    tag = "{%s}getctag" % CS_NS
+
+# RFC 4791 text-match, with the negate-condition attribute the RFC defines
+class TextMatch(ValuedBaseElement):
+    tag = ns("C", "text-match")
+
+    def __init__(self, value, collation="i;ascii-casemap", negate=False):
+        super(TextMatch, self).__init__(value=value)
+        self.attributes['collation'] = collation
+        self.attributes['negate-condition'] = "yes" if negate else "no"
+
+class SupportedFilter(BaseElement):
+    tag = ns("C", "supported-filter")
+
+# RFC 4791 calendar-data subsetting: a property to return within a comp
+class CalendarProp(NamedBaseElement):
+    tag = ns("C", "prop")
@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+
+"""Lightweight extraction of simple property values from raw iCalendar data, without building a vobject tree"""
+
+import base64
+import re
+
+UNFOLD_RE = re.compile(r'\r?\n[ \t]')
+LINE_RE = re.compile(r'\r\n|\r|\n')
+# everything up to the first unescaped comma, which is where vobject ends a single TEXT value
+TEXT_VALUE_RE = re.compile(r'(?:[^\\,]|\\.)*', re.DOTALL)
+TEXT_ESCAPE_RE = re.compile(r'\\([\\;,Nn"])')
+
+# properties whose values vobject decodes as TEXT
+TEXT_PROPERTIES = {"SUMMARY", "STATUS", "UID", "DESCRIPTION", "LOCATION", "CLASS", "COMMENT", "CONTACT", "RELATED-TO"}
+
+def unescape_text(value):
+    """decodes an iCalendar TEXT value as vobject does: backslash escapes are removed, and an unescaped comma ends the value"""
+    value = TEXT_VALUE_RE.match(value).group(0)
+    return TEXT_ESCAPE_RE.sub(lambda match: "\n" if match.group(1) in "nN" else match.group(1), value)
+
+def split_content_line(line):
+    """splits an unfolded content line into (upper case name, parameter string, value)"""
+    i, n = 0, len(line)
+    while i < n and line[i] not in ";:":
+        i += 1
+    name = line[:i].upper()
+    params_start = i
+    in_quotes = False
+    while i < n and (in_quotes or line[i] != ":"):
+        if line[i] == '"':
+            in_quotes = not in_quotes
+        i += 1
+    return name, line[params_start:i], line[i+1:]
+
+def extract_fields(data, names, component="VTODO"):
+    """returns a dict mapping each of the given upper case property names to its decoded value in the first component of the given type
+    within data; properties that are not present are omitted, and only the first of any repeated property is used.
+    Values are unicode whether data is unicode or UTF-8, as they are when data comes from a parsed report, except for BASE64 ones"""
+    fields = {}
+    if not data:
+        return fields
+    start = data.find("BEGIN:" + component)
+    if start == -1:
+        start = data.upper().find("BEGIN:" + component)
+        if start == -1:
+            return fields
+    depth = 0
+    for line in LINE_RE.split(UNFOLD_RE.sub("", data[start:])):
+        name, params, value = split_content_line(line)
+        if name == "BEGIN":
+            depth += 1
+        elif name == "END":
+            depth -= 1
+            if depth == 0:
+                break
+        elif depth == 1 and name in names and name not in fields:
+            if "ENCODING=BASE64" in params.upper():
+                value = base64.b64decode(value)
+            else:
+                if name in TEXT_PROPERTIES:
+                    value = unescape_text(value)
+                if isinstance(value, str):
+                    value = value.decode("utf-8", "replace")
+            fields[name] = value
+    return fields
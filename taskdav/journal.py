@@ -0,0 +1,233 @@
+#!/usr/bin/env python
+
+"""A durable journal of the writes made by commands in write-behind mode, which are applied to the cache store straight away
+and sent to the server later by flush
+
+Each write is appended to a file of JSON lines, which is synced to disk before the command returns. A save holds the whole of the
+task's new data along with the href and etag it was loaded with, so that sending it is a single conditional PUT, and a task changed
+on the server in the meantime is reported as a conflict rather than overwritten."""
+
+import json
+import os
+from store import append_lines, write_atomically
+
+SAVE = "save"
+DELETE = "delete"
+
+class Entry(object):
+    """One journaled write: the task's calendar name and uid, the href and etag it had on the server (None for a task
+    created in write-behind mode), and its data - for a save the new data, and for a delete the data it had"""
+    __slots__ = ("op", "calendar", "uid", "href", "etag", "data")
+
+    def __init__(self, op, calendar, uid, href=None, etag=None, data=None):
+        self.op = op
+        self.calendar = calendar
+        self.uid = uid
+        self.href = href
+        self.etag = etag
+        self.data = data
+
+    @property
+    def key(self):
+        return (self.calendar, self.uid)
+
+    def to_dict(self):
+        return {name: getattr(self, name) for name in self.__slots__}
+
+    @classmethod
+    def from_dict(cls, d):
+        return cls(d["op"], d["calendar"], d["uid"], d.get("href"), d.get("etag"), d.get("data"))
+
+    def __eq__(self, other):
+        return isinstance(other, Entry) and self.to_dict() == other.to_dict()
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return "Entry(%r, %r, %r, href=%r, etag=%r)" % (self.op, self.calendar, self.uid, self.href, self.etag)
+
+def compact(entries):
+    """returns the entries with the writes to each task combined into one, in the order each task was first written:
+    its last write, based on the href and etag of its first, since that is what the server still has.
+    A task that was both created and deleted in write-behind mode is left out altogether"""
+    combined = {}
+    order = []
+    for entry in entries:
+        first = combined.get(entry.key)
+        if first is None:
+            order.append(entry.key)
+            combined[entry.key] = entry
+        else:
+            combined[entry.key] = Entry(entry.op, entry.calendar, entry.uid, first.href, first.etag, entry.data)
+    return [combined[key] for key in order if not (combined[key].op == DELETE and combined[key].href is None)]
+
+class Journal(object):
+    """The journal file of pending writes"""
+    def __init__(self, filename):
+        self.filename = filename
+
+    def append(self, entries):
+        """appends the entries with a single write, and syncs the file to disk; a line left unfinished by an interrupted write
+        is ended first, so that it can't run into the entries"""
+        append_lines(self.filename, [json.dumps(entry.to_dict()) + "\n" for entry in entries])
+
+    def read(self, offset=0):
+        """returns (entries, offset): the entries from the given offset in the file, and the offset up to which they were read;
+        a line left unfinished by an interrupted write is skipped"""
+        entries = []
+        try:
+            with open(self.filename, "rb") as f:
+                f.seek(offset)
+                for line in f:
+                    if not line.endswith("\n"):
+                        break
+                    offset += len(line)
+                    try:
+                        entries.append(Entry.from_dict(json.loads(line)))
+                    except (ValueError, KeyError):
+                        continue
+        except IOError:
+            pass
+        return entries, offset
+
+    def entries(self):
+        return self.read()[0]
+
+    def replace(self, entries, offset):
+        """replaces the entries read up to offset with the given ones, keeping any appended since they were read;
+        returns the offset up to which the given entries were written, from which the appended ones can be read again"""
+        appended, end = self.read(offset)
+        written = "".join(json.dumps(entry.to_dict()) + "\n" for entry in entries)
+        if entries or appended:
+            write_atomically(self.filename, written + "".join(json.dumps(entry.to_dict()) + "\n" for entry in appended))
+        elif os.path.exists(self.filename):
+            os.remove(self.filename)
+        return len(written)
+
+class JournaledWrite(object):
+    """The outcome of a write made by a JournalWriter, which has the same attributes as a WriteResult"""
+    ok = True
+    conflict = False
+    status = None
+    exception = None
+
+    def __init__(self, task, method):
+        self.task = task
+        self.method = method
+
+    def __str__(self):
+        return "%s journaled" % self.method
+
+class OfflineCalendar(object):
+    """Stands in for the TaskList of the named calendar in write-behind mode, finding its tasks in the cache store rather than on the server"""
+    def __init__(self, write_behind, name):
+        self.write_behind = write_behind
+        self.name = name
+        self._id_lookup = None
+
+    def get_task(self, task_id, load=True):
+        """returns a Task made from the stored task with the given id or unique id prefix, which is always loaded"""
+        from task import Task
+        stored = self.get_id_lookup().unique(task_id)
+        return Task(None, url=stored.url, data=stored.data, parent=self, id=stored.id, etag=stored.etag)
+
+    def load_many(self, tasks):
+        pass
+
+    def get_id_lookup(self):
+        """returns the lookup of stored tasks as it was when first needed, for working out short ids"""
+        if self._id_lookup is None:
+            self._id_lookup = self.write_behind.store.get_tasks()
+        return self._id_lookup
+
+    def added(self, task):
+        if self._id_lookup is not None:
+            self._id_lookup[task.id] = task
+
+class JournalWriter(object):
+    """Takes the place of a BatchWriter in write-behind mode: the queued writes are appended to the journal and applied to the store
+    rather than sent to the server"""
+    def __init__(self, write_behind):
+        self.write_behind = write_behind
+        self.writes = []
+
+    def save(self, task):
+        """queues the task to be saved, creating it if it has no url yet"""
+        self.writes.append((task, "PUT"))
+
+    def delete(self, task):
+        """queues the task to be deleted"""
+        self.writes.append((task, "DELETE"))
+
+    def run(self):
+        """journals all the queued writes and applies them to the store, updating each saved task's data but not its etag,
+        which stays the one the server has until the write is flushed
+
+        Returns:
+         * [JournaledWrite(), ...] in the order the writes were queued
+        """
+        writes, self.writes = self.writes, []
+        entries = []
+        for task, method in writes:
+            href = task.url.geturl() if task.url is not None else None
+            if method == "PUT":
+                task.saved(task.instance.serialize(), task.etag)
+                entries.append(Entry(SAVE, task.parent.name, task.todo_getattr("uid"), href, task.etag, task.data))
+            else:
+                entries.append(Entry(DELETE, task.parent.name, task.todo_getattr("uid"), href, task.etag, task.data))
+        if not entries:
+            return []
+        self.write_behind.journal.append(entries)
+        for task, method in writes:
+            self.write_behind.store.record_journaled(task, method == "DELETE", self.write_behind.cache_dir)
+        return [JournaledWrite(task, method) for task, method in writes]
+
+class WriteBehind(object):
+    """Write-behind mode for a command: the journal, and the cache store that its writes are applied to"""
+    def __init__(self, journal, store, cache_dir=None):
+        self.journal = journal
+        self.store = store
+        self.cache_dir = cache_dir
+
+    def calendar(self, name):
+        return OfflineCalendar(self, name)
+
+    def writer(self):
+        return JournalWriter(self)
+
+    def close(self):
+        self.store.close()
+
+def replay(entries, client, batch_size=100, workers=8, overwrite=False):
+    """
+    Sends the given (compacted) entries to the server in batches of batch_size, each written concurrently by a BatchWriter
+    with the given number of workers.
+    Each write is conditional on the etag the task had when it was journaled, so that a task changed on the server since then
+    is reported as a conflict, unless overwrite is set. A batch in which any write failed to reach the server is the last one sent.
+
+    Yields:
+     * (entries, [WriteResult(), ...]) for each batch sent
+    """
+    # the task module, with caldav, is only imported when the journal is sent to the server
+    import urlparse
+    from caldav.lib import url
+    from task import BatchWriter, Task
+    for start in range(0, len(entries), batch_size):
+        batch = entries[start:start + batch_size]
+        writer = BatchWriter(client, workers)
+        for entry in batch:
+            calendar = client.get_calendar(entry.calendar)
+            task = Task(client, url=entry.href, data=entry.data, parent=calendar, id=entry.uid, etag=entry.etag)
+            if overwrite:
+                task.etag = None
+                if task.url is None:
+                    task.url = urlparse.urlparse(url.make(calendar.url, url.join(calendar.url.path, entry.uid + ".ics")))
+            if entry.op == DELETE:
+                writer.delete(task)
+            else:
+                writer.save(task)
+        results = writer.run()
+        yield batch, results
+        if any(result.exception is not None for result in results):
+            return
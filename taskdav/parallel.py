@@ -0,0 +1,45 @@
+#!/usr/bin/env python
+
+"""Extracting the fields of large numbers of tasks in a pool of worker processes
+
+Parsing is pure Python, so it only uses one core; with enough tasks to make starting the workers worthwhile, their iCalendar data
+is shared out among forked workers in contiguous ranges. Each pool's workers are given its data by the pool's initializer, which they
+inherit when they are forked rather than having it pickled to them, and only send back the small dicts of extracted fields,
+never vobject instances."""
+
+import multiprocessing
+import os
+import ical
+
+DEFAULT_THRESHOLD = 5000
+# ranges per worker, so that a worker that finishes early can take another
+RANGES_PER_WORKER = 4
+
+# the data being parsed by the pool a worker process belongs to, which is only set in the worker
+_datas = None
+
+def use_workers(count, workers, threshold=DEFAULT_THRESHOLD):
+    """whether count tasks should be parsed by a pool of the given number of workers: only if there is more than one,
+    there are at least threshold tasks, and workers can be forked"""
+    return workers > 1 and count >= threshold and hasattr(os, "fork")
+
+def _init_worker(datas):
+    global _datas
+    _datas = datas
+
+def _extract_range(args):
+    start, end, names = args
+    return [ical.extract_fields(data, names) for data in _datas[start:end]]
+
+def extract_fields_many(datas, names, workers=1, threshold=DEFAULT_THRESHOLD):
+    """returns ical.extract_fields(data, names) for each of datas in order, in a pool of workers if use_workers() says so"""
+    if not use_workers(len(datas), workers, threshold):
+        return [ical.extract_fields(data, names) for data in datas]
+    size = -(-len(datas) // (workers * RANGES_PER_WORKER))
+    pool = multiprocessing.Pool(workers, _init_worker, (datas,))
+    try:
+        results = pool.map(_extract_range, [(start, start + size, names) for start in range(0, len(datas), size)])
+    finally:
+        pool.close()
+        pool.join()
+    return [fields for result in results for fields in result]
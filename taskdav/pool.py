@@ -0,0 +1,163 @@
+#!/usr/bin/env python
+
+"""A thread-safe pool of persistent HTTP connections, kept alive between requests"""
+
+import httplib
+import select
+import socket
+import StringIO
+import threading
+import timings
+
+# the most of an unread body that PooledResponse.close() reads so that its connection can be reused, in chunks of DRAIN_CHUNK;
+# a connection with more left is closed instead
+DRAIN_LIMIT = 64 * 1024
+DRAIN_CHUNK = 8192
+
+# methods that can safely be sent again when a connection fails before the response arrives, as sending them twice does no harm
+IDEMPOTENT_METHODS = frozenset(["GET", "HEAD", "OPTIONS", "PROPFIND", "REPORT"])
+
+def closed_by_server(connection):
+    """checks whether an idle connection has been closed by the server, whose socket then reads as ready (with nothing to read)"""
+    try:
+        return bool(select.select([connection.sock], [], [], 0)[0])
+    except (select.error, socket.error, ValueError):
+        return True
+
+class ConnectionPool(object):
+    """Hands out connections made by connect, keeping released ones open for reuse.
+
+    At most size connections are in use at once; acquire blocks until one is released.
+    opened counts the connections that had to be (re)established and reused those that were already open"""
+    def __init__(self, connect, size=8):
+        self.connect = connect
+        self.size = size
+        self.opened = 0
+        self.reused = 0
+        self.lock = threading.Lock()
+        self.available = threading.BoundedSemaphore(size)
+        self.idle = []
+
+    def acquire(self):
+        self.available.acquire()
+        with self.lock:
+            connection = self.idle.pop() if self.idle else None
+        if connection is None:
+            try:
+                connection = self.connect()
+            except Exception:
+                self.available.release()
+                raise
+        with self.lock:
+            # httplib reconnects by itself when the server has closed the connection
+            if connection.sock is None:
+                self.opened += 1
+            else:
+                self.reused += 1
+        return connection
+
+    def release(self, connection, reuse=True):
+        """returns a connection to the pool once its response has been read, or closes it if reuse is False"""
+        if reuse:
+            with self.lock:
+                self.idle.append(connection)
+        else:
+            connection.close()
+        self.available.release()
+
+    def request(self, method, url, body, headers):
+        """sends a request on a pooled connection, returning the connection and its unread httplib response.
+        A reused connection that the server had already closed is retried once on a fresh connection, if the request could not have
+        reached the server or its method is idempotent: a PUT or DELETE that fails after it was sent might have been carried out.
+        Before such a request is sent on a reused connection, the connection is checked and reopened if the server has closed it"""
+        connection = self.acquire()
+        reused = connection.sock is not None
+        if reused and method not in IDEMPOTENT_METHODS and closed_by_server(connection):
+            connection.close()
+        sent = False
+        try:
+            connection.request(method, url, body, headers)
+            sent = True
+            return connection, connection.getresponse()
+        except (httplib.BadStatusLine, socket.error):
+            self.release(connection, reuse=False)
+            if not reused or (sent and method not in IDEMPOTENT_METHODS):
+                raise
+        except Exception:
+            self.release(connection, reuse=False)
+            raise
+        return self.request(method, url, body, headers)
+
+    def stats(self):
+        """returns the number of connections opened and reused so far"""
+        with self.lock:
+            return {"opened": self.opened, "reused": self.reused}
+
+    def close(self):
+        """closes all idle connections"""
+        with self.lock:
+            idle, self.idle = self.idle, []
+        for connection in idle:
+            connection.close()
+
+class PooledResponse(object):
+    """An httplib response whose connection goes back to its pool once the body has been read or the response is closed.
+    The method and the number of bytes sent are only kept to record the request in timings once its body has been received"""
+    def __init__(self, pool, connection, response, method=None, sent=0):
+        self.pool = pool
+        self.connection = connection
+        self.response = response
+        self.status = response.status
+        self.reason = response.reason
+        self.method = method
+        self.sent = sent
+        self.received = 0
+        self.buffered = None
+
+    def getheaders(self):
+        return self.response.getheaders()
+
+    def read(self, amt=None):
+        if self.buffered is not None:
+            return self.buffered.read() if amt is None else self.buffered.read(amt)
+        data = self.response.read(amt)
+        self.received += len(data)
+        if self.response.isclosed():
+            self._release()
+        return data
+
+    def _release(self, reuse=True):
+        if self.connection is not None:
+            connection, self.connection = self.connection, None
+            self.pool.release(connection, reuse)
+            if timings.recorder is not None and self.method is not None:
+                timings.recorder.add_request(self.method, self.sent, self.received)
+
+    def buffer(self):
+        """reads the rest of the body into memory and releases the connection, so that other requests can be sent while this response
+        is still being used; only for responses with small bodies, such as errors"""
+        if self.connection is not None:
+            data = self.response.read()
+            self.received += len(data)
+            self._release()
+            self.buffered = StringIO.StringIO(data)
+
+    def close(self):
+        """reads any rest of the body, so that the connection can be reused, and releases it; if more than DRAIN_LIMIT bytes are left,
+        the connection is closed instead, so that stopping early doesn't download the rest of a large response"""
+        if self.connection is None:
+            return
+        length = self.response.length
+        if length is None or length <= DRAIN_LIMIT:
+            drained = 0
+            while drained <= DRAIN_LIMIT and not self.response.isclosed():
+                data = self.response.read(DRAIN_CHUNK)
+                if not data:
+                    break
+                drained += len(data)
+            self.received += drained
+        if self.response.isclosed():
+            self._release()
+        else:
+            self.response.close()
+            self._release(reuse=False)
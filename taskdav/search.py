@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+
+"""Search terms for task summaries, and an inverted index of the n-grams and @context and +project tags in them
+
+A term matches a task whose id starts with it, or whose summary contains it (ignoring case); a term like test- ending with a -
+instead matches a summary that doesn't contain test. A term at least GRAM_LENGTH long can only be contained in summaries that
+contain every one of its n-grams, so the index finds those by intersecting the postings of its n-grams, and only checks them"""
+
+import short_id
+from todo import CONTEXT_RE, PROJ_RE
+
+GRAM_LENGTH = 3
+
+CONTEXT = "@"
+PROJECT = "+"
+
+def grams(text):
+    """returns the set of n-grams (substrings GRAM_LENGTH long) in the lower case of text"""
+    text = text.lower()
+    return {text[i:i+GRAM_LENGTH] for i in range(len(text) - GRAM_LENGTH + 1)}
+
+def summary_tags(summary):
+    """returns the set of (kind, tag) for the @context and +project tags in summary"""
+    return {(CONTEXT, tag) for tag in CONTEXT_RE.findall(summary)} | {(PROJECT, tag) for tag in PROJ_RE.findall(summary)}
+
+def matches_terms(task_id, summary, terms):
+    """checks if the task with the given id and summary matches all the given lowercase search terms"""
+    search_text = summary.lower()
+    return all(task_id.startswith(t) or (t[:-1] not in search_text if t.endswith('-') else t in search_text) for t in terms)
+
+def ordered_terms(terms):
+    """lowercases the search terms, putting the ones that the index can narrow the search with first"""
+    terms = [t.lower() for t in terms]
+    return sorted(terms, key=lambda t: (t.endswith("-"), -len(t)))
+
+class TaskIndex(object):
+    """An inverted index of the summaries of a lookup of tasks, kept up to date with add() and remove() as the tasks change:
+    the ids of the tasks containing each n-gram, and of the incomplete tasks with each tag"""
+    def __init__(self, tasks=()):
+        self.summaries = short_id.prefix_dict()
+        self.postings = {}
+        self.tag_ids = {CONTEXT: {}, PROJECT: {}}
+        self.task_tags = {}
+        for task_id in tasks:
+            self.add(task_id, tasks[task_id])
+
+    def add(self, task_id, task):
+        """indexes the given task under task_id, replacing anything indexed for it before"""
+        self.remove(task_id)
+        summary = task.summary
+        self.summaries[task_id] = summary.lower()
+        for gram in grams(summary):
+            self.postings.setdefault(gram, set()).add(task_id)
+        if task.status != "COMPLETED":
+            tags = self.task_tags[task_id] = summary_tags(summary)
+            for kind, tag in tags:
+                self.tag_ids[kind].setdefault(tag, set()).add(task_id)
+
+    def remove(self, task_id):
+        """removes the task with the given id from the index, if it's there"""
+        summary = self.summaries.pop(task_id, None)
+        if summary is None:
+            return
+        for gram in grams(summary):
+            ids = self.postings[gram]
+            ids.discard(task_id)
+            if not ids:
+                del self.postings[gram]
+        for kind, tag in self.task_tags.pop(task_id, ()):
+            ids = self.tag_ids[kind][tag]
+            ids.discard(task_id)
+            if not ids:
+                del self.tag_ids[kind][tag]
+
+    def containing(self, text, within=None):
+        """returns the ids of the tasks whose summaries contain the lowercase text, only checking those within the given ids if given"""
+        if len(text) < GRAM_LENGTH:
+            candidates = self.summaries if within is None else within
+        else:
+            postings = sorted((self.postings.get(gram, ()) for gram in grams(text)), key=len)
+            candidates = set(postings[0]).intersection(*postings[1:])
+            if within is not None:
+                candidates &= within
+        return {task_id for task_id in candidates if text in self.summaries[task_id]}
+
+    def search(self, terms):
+        """returns the set of ids of the tasks matching all the given search terms"""
+        matched = None
+        for term in ordered_terms(terms):
+            ids = set(self.summaries.search(term))
+            if term.endswith("-"):
+                within = set(self.summaries) if matched is None else matched
+                ids.update(within - self.containing(term[:-1], within))
+            else:
+                ids.update(self.containing(term, matched))
+            matched = ids if matched is None else matched & ids
+            if not matched:
+                break
+        return set(self.summaries) if matched is None else matched
+
+    def tags(self, kind):
+        """returns the sorted list of distinct tags of the given kind (CONTEXT or PROJECT) in incomplete tasks"""
+        return sorted(self.tag_ids[kind])
@@ -2,32 +2,129 @@
 
 """Given a complete set of IDs, reduces each one to the minimal initial string needed to distinguish it from the others"""
 
-# TODO: think through API
+import bisect
+
+def common_prefix_len(a, b):
+    """returns the length of the common prefix of the strings a and b"""
+    n = min(len(a), len(b))
+    i = 0
+    while i < n and a[i] == b[i]:
+        i += 1
+    return i
 
 class prefix_dict(dict):
-   """A set that enables lookup based on the shortest unique prefix, for a relatively small number of string keys"""
+   """A dict that enables lookup based on the shortest unique prefix of its string keys
+
+   The string keys are kept in a sorted index (built lazily on first lookup, then maintained on each change),
+   so that all keys sharing a prefix are adjacent and can be found by bisection"""
+   _index = None
+
+   def __init__(self, *args, **kwargs):
+       dict.__init__(self, *args, **kwargs)
+       self._index = None
+
+   def __setitem__(self, key, value):
+       if self._index is not None and isinstance(key, basestring) and key not in self:
+           bisect.insort(self._index, key)
+       dict.__setitem__(self, key, value)
+
+   def __delitem__(self, key):
+       dict.__delitem__(self, key)
+       if self._index is not None and isinstance(key, basestring):
+           del self._index[bisect.bisect_left(self._index, key)]
+
+   def pop(self, key, *default):
+       if key in self:
+           value = self[key]
+           del self[key]
+           return value
+       return dict.pop(self, key, *default)
+
+   def popitem(self):
+       key, value = dict.popitem(self)
+       if self._index is not None and isinstance(key, basestring):
+           del self._index[bisect.bisect_left(self._index, key)]
+       return key, value
+
+   def setdefault(self, key, default=None):
+       if key not in self:
+           self[key] = default
+       return self[key]
+
+   def update(self, *args, **kwargs):
+       dict.update(self, *args, **kwargs)
+       self._index = None
+
+   def clear(self):
+       dict.clear(self)
+       self._index = None
+
+   def sorted_keys(self):
+       """returns the sorted list of string keys - this is the internal index and must not be modified"""
+       if self._index is None:
+           self._index = sorted(key for key in self.iterkeys() if isinstance(key, basestring))
+       return self._index
+
+   def _iter_search(self, prefix):
+       """iterates over the keys beginning with the given prefix, in sorted order"""
+       index = self.sorted_keys()
+       i = bisect.bisect_left(index, prefix)
+       while i < len(index) and index[i].startswith(prefix):
+           yield index[i]
+           i += 1
+
    def search(self, prefix):
        """looks up all keys beginning with the given prefix"""
-       return [key for key in self.iterkeys() if isinstance(key, basestring) and key.startswith(prefix)]
+       return list(self._iter_search(prefix))
 
    def unique(self, prefix):
        """obtains the unique item starting with the given prefix - errors if search returns 0, 2 or more"""
-       keys = self.search(prefix)
-       if len(keys) > 1:
-           raise ValueError("Could not distinguish between keys from %s: %s" % (prefix, ", ".join(keys)))
-       elif not keys:
+       return self[self.unique_key(prefix)]
+
+   def unique_key(self, prefix):
+       """obtains the unique key starting with the given prefix - errors as unique() does"""
+       keys = []
+       for key in self._iter_search(prefix):
+           keys.append(key)
+           if len(keys) > 1:
+               raise ValueError("Could not distinguish between keys from %s: %s" % (prefix, ", ".join(self.search(prefix))))
+       if not keys:
            raise KeyError("Could not find key starting with prefix %s" % prefix)
-       return self[keys[0]]
+       return keys[0]
+
+   def _count_search(self, prefix, limit=2):
+       """counts the keys beginning with the given prefix, stopping once limit is reached"""
+       count = 0
+       for key in self._iter_search(prefix):
+           count += 1
+           if count >= limit:
+               break
+       return count
 
    def shortest(self, key):
        """Obtains the shortest prefix for the given key that will match only that key out of the current set"""
+       index = self.sorted_keys()
+       pos = bisect.bisect_left(index, key)
+       if pos < len(index) and index[pos] == key:
+           # the only keys that can share a longer prefix with key are its neighbours in the index
+           shared = 0
+           if pos > 0:
+               shared = common_prefix_len(key, index[pos-1])
+           if pos + 1 < len(index):
+               shared = max(shared, common_prefix_len(key, index[pos+1]))
+           return key[:max(shared + 1, 1)]
        i = 1
-       keys = self.search(key[:i])
-       while i < len(key):
-           if len(keys) == 1:
-               break
+       while i < len(key) and self._count_search(key[:i]) != 1:
            i += 1
-           prefix = key[:i]
-           keys = [k for k in keys if k.startswith(prefix)]
        return key[:i]
 
+   def shortest_all(self):
+       """Returns a dict mapping every string key to its shortest unique prefix, computed in a single pass over the index"""
+       index = self.sorted_keys()
+       result = {}
+       shared_prev = 0
+       for i, key in enumerate(index):
+           shared_next = common_prefix_len(key, index[i+1]) if i + 1 < len(index) else 0
+           result[key] = key[:max(shared_prev, shared_next) + 1]
+           shared_prev = shared_next
+       return result
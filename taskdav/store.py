@@ -0,0 +1,362 @@
+#!/usr/bin/env python
+
+"""A local SQLite store of tasks, keeping the fields that commands display and filter on in indexed columns alongside the raw iCalendar data"""
+
+import itertools
+import json
+import os
+import sqlite3
+import parallel
+import short_id
+import timings
+from aggregate import TaskColumns
+from search import CONTEXT, PROJECT, GRAM_LENGTH, grams, summary_tags, matches_terms, ordered_terms
+from todo import STATUS_KEY, TaskRecord
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS tasks (
+    id TEXT PRIMARY KEY,
+    uid TEXT,
+    href TEXT,
+    etag TEXT,
+    filename TEXT,
+    mtime REAL,
+    status TEXT,
+    status_key INTEGER,
+    priority INTEGER,
+    priority_key INTEGER,
+    summary TEXT,
+    data TEXT
+);
+CREATE INDEX IF NOT EXISTS tasks_order ON tasks (priority_key, status_key, status, summary);
+CREATE INDEX IF NOT EXISTS tasks_status ON tasks (status);
+CREATE INDEX IF NOT EXISTS tasks_href ON tasks (href);
+CREATE TABLE IF NOT EXISTS tags (
+    kind TEXT,
+    tag TEXT,
+    id TEXT REFERENCES tasks (id) ON DELETE CASCADE,
+    PRIMARY KEY (kind, tag, id)
+);
+CREATE INDEX IF NOT EXISTS tags_id ON tags (id);
+CREATE TABLE IF NOT EXISTS grams (
+    gram TEXT,
+    id TEXT REFERENCES tasks (id) ON DELETE CASCADE,
+    PRIMARY KEY (gram, id)
+);
+CREATE INDEX IF NOT EXISTS grams_id ON grams (id);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+"""
+
+TASK_COLUMNS = "id, uid, href, etag, status, priority, summary"
+
+INCOMPLETE = "(status IS NULL OR status != 'COMPLETED')"
+
+def task_key(task):
+    """returns the key used to look up the given task - its id if known, otherwise the name of its resource"""
+    from task import get_object_urlname
+    return task.id or get_object_urlname(task).replace(".ics", "")
+
+def href_task_key(href):
+    """returns the key of the task stored at the given href"""
+    import urllib2
+    return urllib2.unquote(href.rstrip("/").rsplit("/", 1)[-1]).replace(".ics", "")
+
+def write_atomically(filename, data):
+    """writes the file by renaming a new one over it, so that other processes never read it half written"""
+    temp_filename = "%s.%d" % (filename, os.getpid())
+    with open(temp_filename, "wb") as f:
+        f.write(data)
+    try:
+        os.rename(temp_filename, filename)
+    except OSError:
+        # on Windows the existing file has to be removed first
+        os.remove(filename)
+        os.rename(temp_filename, filename)
+
+def append_lines(filename, lines):
+    """appends the lines, each ending with a newline, with a single write, and syncs the file to disk; a line left unfinished
+    by an interrupted write is ended first, so that it can't run into them. The file's directory is made if necessary"""
+    dirname = os.path.dirname(filename)
+    if dirname and not os.path.isdir(dirname):
+        os.makedirs(dirname)
+    with open(filename, "a+b") as f:
+        f.seek(0, os.SEEK_END)
+        separator = ""
+        if f.tell() > 0:
+            f.seek(-1, os.SEEK_END)
+            separator = "" if f.read(1) == "\n" else "\n"
+        f.write(separator + "".join(lines))
+        f.flush()
+        os.fsync(f.fileno())
+
+def to_unicode(s):
+    return s.decode("utf-8") if isinstance(s, str) else s
+
+class StoredTask(TaskRecord):
+    """A read-only view of a task in a TaskStore, with the same read properties as Task but without parsing its iCalendar data"""
+    __slots__ = ("store", "id", "uid", "url", "etag")
+
+    def __init__(self, store, id, uid, href, etag, status, priority, summary):
+        TaskRecord.__init__(self, priority, status, summary)
+        self.store = store
+        self.id = id
+        self.uid = uid
+        self.url = href
+        self.etag = etag
+
+    @property
+    def data(self):
+        return self.store.get_data(self.id)
+
+class TaskStore(object):
+    """A local store of tasks in an SQLite database
+
+    Tasks are added from a TaskList by sync, or imported from a directory of .ics files,
+    and can be listed, filtered and counted without parsing their iCalendar data"""
+    def __init__(self, filename):
+        self.filename = filename
+        self.db = sqlite3.connect(filename)
+        self.db.text_factory = unicode
+        self.db.executescript(SCHEMA)
+        self.db.execute("PRAGMA foreign_keys = ON")
+        self._tasks = None
+        if self.get_meta("grams") != str(GRAM_LENGTH):
+            self._index_grams()
+
+    def close(self):
+        self.db.close()
+
+    def get_meta(self, key, default=None):
+        row = self.db.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row[0] if row is not None else default
+
+    def set_meta(self, key, value):
+        self.db.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, value))
+
+    def get_sync_state(self):
+        # the task module, with caldav, is only imported when the store is synced with the server
+        from task import SyncState
+        value = self.get_meta("sync_state")
+        return SyncState.from_dict(json.loads(value)) if value else SyncState()
+
+    def synced_url(self):
+        """returns the url of the calendar the store was last synced with, or None if it never has been, without importing the task module"""
+        value = self.get_meta("sync_state")
+        return json.loads(value).get("url") if value else None
+
+    def set_sync_state(self, state):
+        with self.db:
+            self.set_meta("sync_state", json.dumps(state.to_dict()))
+
+    def _put(self, task, key=None, filename=None, mtime=None):
+        """adds or replaces the given task; must be called within a transaction"""
+        key = key or task_key(task)
+        status = to_unicode(task.status)
+        status_key = STATUS_KEY.get(status.upper(), len(STATUS_KEY)) if status else len(STATUS_KEY)
+        priority = task.priority
+        summary = to_unicode(task.summary)
+        href = task.url.geturl() if task.url is not None else None
+        self.db.execute("DELETE FROM tasks WHERE id = ?", (key,))
+        self.db.execute("INSERT INTO tasks (id, uid, href, etag, filename, mtime, status, status_key, priority, priority_key, summary, data) "
+                        "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                        (key, task.todo_getattr("uid", None), href, task.etag, filename, mtime,
+                         status, status_key, priority.value, priority.sort_key, summary, to_unicode(task.data)))
+        self.db.executemany("INSERT INTO tags (kind, tag, id) VALUES (?, ?, ?)", [(kind, tag, key) for kind, tag in summary_tags(summary)])
+        self.db.executemany("INSERT INTO grams (gram, id) VALUES (?, ?)", [(gram, key) for gram in grams(summary)])
+        self._tasks = None
+
+    def _index_grams(self):
+        """indexes the n-grams of every summary, for a store made before they were indexed or with a different GRAM_LENGTH"""
+        with self.db:
+            self.db.execute("DELETE FROM grams")
+            for key, summary in self.db.execute("SELECT id, summary FROM tasks").fetchall():
+                self.db.executemany("INSERT INTO grams (gram, id) VALUES (?, ?)", [(gram, key) for gram in grams(summary or u"")])
+            self.set_meta("grams", str(GRAM_LENGTH))
+
+    def _delete(self, key):
+        self.db.execute("DELETE FROM tasks WHERE id = ?", (key,))
+        self._tasks = None
+
+    def put(self, task, key=None):
+        """adds or replaces the given task"""
+        with self.db:
+            self._put(task, key)
+
+    def delete(self, key):
+        with self.db:
+            self._delete(key)
+
+    def sync(self, calendar):
+        """incrementally brings the store up to date with the given TaskList, returning (changed tasks, deleted hrefs)"""
+        state = self.get_sync_state()
+        changed, deleted = calendar.sync_changes(state)
+        with self.db:
+            for href in deleted:
+                self._delete(href_task_key(href))
+            for task in changed:
+                self._put(task)
+            self.set_meta("sync_state", json.dumps(state.to_dict()))
+        return changed, deleted
+
+    def _written_row(self, task):
+        """returns (key, filename) of the row for a task that has just been written to the server, or None if the task
+        belongs to a calendar other than the one the store is synced with. The row is found by href, or else by uid for an imported file.
+        A store that has never been synced doesn't know its calendar, so only the tasks it already has are written through to it"""
+        state = self.get_sync_state()
+        if state.url is not None and (task.parent is None or task.parent.canonical_url != state.url):
+            return None
+        href = task.url.geturl()
+        row = self.db.execute("SELECT id, filename FROM tasks WHERE href = ?", (href,)).fetchone()
+        if row is None:
+            row = self.db.execute("SELECT id, filename FROM tasks WHERE href IS NULL AND uid = ?", (task.todo_getattr("uid", None),)).fetchone()
+        if row is not None:
+            return tuple(row)
+        return (href_task_key(href), None) if state.url is not None else None
+
+    def record_saved(self, task, cache_dir=None):
+        """
+        Writes a task that has just been saved to the server through to the store, with its new etag,
+        so that the store is up to date without syncing it; if the task was imported from a file in cache_dir, the file is replaced too.
+        The etag is also recorded in the sync state, so that syncing only fetches the task again if it has changed since.
+        """
+        row = self._written_row(task)
+        if row is None:
+            return
+        key, filename = row
+        mtime = None
+        if filename is not None and cache_dir is not None:
+            path = os.path.join(cache_dir, filename)
+            write_atomically(path, task.data.encode("utf-8") if isinstance(task.data, unicode) else task.data)
+            mtime = os.stat(path).st_mtime
+        state = self.get_sync_state()
+        if task.etag:
+            state.etags[task.canonical_url] = task.etag
+        with self.db:
+            self._put(task, key, filename, mtime)
+            self.set_meta("sync_state", json.dumps(state.to_dict()))
+
+    def record_deleted(self, task, cache_dir=None):
+        """removes a task that has just been deleted from the server from the store, and its file in cache_dir if it was imported from one"""
+        row = self._written_row(task)
+        if row is None:
+            return
+        key, filename = row
+        if filename is not None and cache_dir is not None and os.path.exists(os.path.join(cache_dir, filename)):
+            os.remove(os.path.join(cache_dir, filename))
+        state = self.get_sync_state()
+        state.etags.pop(task.canonical_url, None)
+        with self.db:
+            self._delete(key)
+            self.set_meta("sync_state", json.dumps(state.to_dict()))
+
+    def record_journaled(self, task, deleted=False, cache_dir=None):
+        """
+        Applies a write that has been journaled in write-behind mode to the store, and to the task's file in cache_dir if it was imported
+        from one, so that commands see it before it is sent to the server. The task keeps the etag it was loaded with, and the sync state
+        is left alone, so that syncing in the meantime only replaces the task if it has been changed on the server.
+        """
+        key = task_key(task)
+        row = self.db.execute("SELECT filename FROM tasks WHERE id = ?", (key,)).fetchone()
+        filename = row[0] if row is not None else None
+        path = os.path.join(cache_dir, filename) if filename is not None and cache_dir is not None else None
+        mtime = None
+        if deleted:
+            if path is not None and os.path.exists(path):
+                os.remove(path)
+            self.delete(key)
+            return
+        if path is not None:
+            write_atomically(path, task.data.encode("utf-8") if isinstance(task.data, unicode) else task.data)
+            mtime = os.stat(path).st_mtime
+        with self.db:
+            self._put(task, key, filename, mtime)
+
+    def import_dir(self, cache_dir, parse_workers=1, parse_threshold=parallel.DEFAULT_THRESHOLD):
+        """imports .ics files from cache_dir that have been added, changed or removed since the last import, extracting their fields
+        in a pool of parse_workers processes if there are at least parse_threshold of them
+
+        Every file's modification time is checked, so that files rewritten in place are picked up as well as those that were renamed;
+        only the files that have changed are read and parsed"""
+        known = dict(self.db.execute("SELECT filename, mtime FROM tasks WHERE filename IS NOT NULL"))
+        changed = []
+        for filename in os.listdir(cache_dir):
+            if filename.endswith(".ics"):
+                path = os.path.join(cache_dir, filename)
+                mtime = os.stat(path).st_mtime
+                if known.pop(filename, None) != mtime:
+                    with open(path) as f:
+                        changed.append((f.read(), filename, mtime))
+        if not changed and not known:
+            return
+        # the task module, with caldav, is only imported when there are files to parse
+        from task import Task
+        changed = [(Task(None, url=None, data=data, etag=None), filename, file_mtime) for data, filename, file_mtime in changed]
+        Task.extract_fields_many([task for task, filename, file_mtime in changed], parse_workers, parse_threshold)
+        with self.db:
+            for task, filename, mtime in changed:
+                self._put(task, task.id or filename.replace(".ics", ""), filename, mtime)
+            for filename in known:
+                self.db.execute("DELETE FROM tasks WHERE filename = ?", (filename,))
+        self._tasks = None
+
+    def _stored_tasks(self, sql, args=()):
+        return [StoredTask(self, *row) for row in self.db.execute(sql, args)]
+
+    @timings.timed("query store")
+    def get_tasks(self):
+        """returns a lookup mapping id to StoredTask for all tasks in the store"""
+        if self._tasks is None:
+            self._tasks = short_id.prefix_dict((task.id, task) for task in self._stored_tasks("SELECT %s FROM tasks" % TASK_COLUMNS))
+        return self._tasks
+
+    def get_task(self, task_id):
+        """returns a StoredTask by id or unique id prefix"""
+        return self.get_tasks().unique(task_id)
+
+    def get_data(self, task_id):
+        row = self.db.execute("SELECT data FROM tasks WHERE id = ?", (task_id,)).fetchone()
+        return row[0] if row is not None else None
+
+    @timings.timed("query store")
+    def query(self, incomplete=False, priorities=None, terms=(), limit=None):
+        """returns StoredTasks sorted by priority, then status, then summary; optionally only incomplete ones, those with the given priorities,
+        or those matching all the given search terms, and only the first limit of them if limit is given, which stops reading rows once they
+        are found. Each search term at least GRAM_LENGTH long only looks at tasks whose ids start with it
+        or that have all of its n-grams, and the rest are checked against just those"""
+        conditions, args = [], []
+        terms = ordered_terms([to_unicode(term) for term in terms])
+        for term in terms:
+            if len(term) >= GRAM_LENGTH and not term.endswith("-"):
+                term_grams = grams(term)
+                conditions.append("(substr(id, 1, ?) = ? OR id IN (SELECT id FROM grams WHERE gram IN (%s) GROUP BY id HAVING COUNT(*) = ?))"
+                                  % ", ".join("?" for gram in term_grams))
+                args.extend([len(term), term] + list(term_grams) + [len(term_grams)])
+        if incomplete:
+            conditions.append(INCOMPLETE)
+        if priorities is not None:
+            conditions.append("priority IN (%s)" % ", ".join("?" for p in priorities))
+            args.extend(p.value for p in priorities)
+        where = ("WHERE " + " AND ".join(conditions)) if conditions else ""
+        rows = self.db.execute("SELECT %s FROM tasks %s ORDER BY priority_key, status_key, status, summary" % (TASK_COLUMNS, where), args)
+        tasks = (StoredTask(self, *row) for row in rows)
+        if terms:
+            tasks = (task for task in tasks if matches_terms(task.id, task.summary, terms))
+        return list(itertools.islice(tasks, limit))
+
+    def status_counts(self):
+        """returns a dict mapping each status to the number of tasks with it"""
+        return dict(self.db.execute("SELECT status, COUNT(*) FROM tasks GROUP BY status"))
+
+    @timings.timed("query store")
+    def columns(self):
+        """returns a TaskColumns of the status, priority and tags of every task in the store"""
+        return TaskColumns.from_rows(self.db.execute("SELECT status, priority, summary FROM tasks"))
+
+    def tags(self, kind, incomplete=True):
+        """returns the sorted list of distinct tags of the given kind (CONTEXT or PROJECT), by default only from incomplete tasks"""
+        where = ("AND " + INCOMPLETE) if incomplete else ""
+        sql = "SELECT DISTINCT tag FROM tags JOIN tasks USING (id) WHERE kind = ? %s ORDER BY tag" % where
+        return [row[0] for row in self.db.execute(sql, (kind,))]
@@ -1,18 +1,27 @@
 #!/usr/bin/env python
 
 import caldav
-import functools
-import re
+import heapq
+import httplib
+import threading
 import uuid
 import urlparse
 import urllib2
+import StringIO
+import ical
+import parallel
 import short_id
+import todo
+import timings
+from search import TaskIndex
 from datetime import datetime
+from elements import CalendarMultiget, CalendarProp, GetCTag, SupportedReport, SyncCollection, SyncLevel, SyncToken, ValidSyncToken, TextMatch
+from pool import ConnectionPool, PooledResponse
 from lxml import etree
-from caldav.elements import base, cdav, dav
+from multiprocessing.pool import ThreadPool
+from caldav.elements import cdav, dav
 from caldav.lib import error, vcal, url
-from caldav.lib.namespace import ns
-from flufl import enum
+from todo import Priority, PriorityValue, STATUS_KEY, CONTEXT_RE, PROJ_RE, TaskRecord, format_task
 
 utc = caldav.vobject.icalendar.utc
 
@@ -22,75 +31,102 @@ def get_object_urlname(davobject):
     name = name if "/" not in name else name[name.rfind("/")+1:]
     return urllib2.unquote(name)
 
-class PriorityValue(enum._enum.EnumValue):
-    """Implements priority comparisons"""
-
-    def __eq__(self, other):
-        return type(self) == type(other) and self.value == other.value
+class Task(caldav.Event):
+    # priority map: A-D = 1-4 (high), none=0=5 (medium), E-H=6-9 (low) except G has been temporarily replaced with W for delegated tasks
+    # TODO: find another way to do task delegation
 
-    def __ne__(self, other):
-        return type(self) != type(other) or self.value != other.value
+    # these properties are read straight from data until the vobject instance is needed
+    FAST_FIELDS = {"summary": "SUMMARY", "status": "STATUS", "priority": "PRIORITY", "uid": "UID"}
+    # the properties needed to list tasks, which can be fetched on their own
+    LIST_PROPS = ("UID", "SUMMARY", "STATUS", "PRIORITY", "LAST-MODIFIED")
+    _fields = None
+    _record = None
+    # whether data only contains some properties, in which case the full task is loaded when the instance is needed
+    partial = False
 
-    def __lt__(self, other):
-        if type(self) != type(other):
-            return type(self) < type(other)
-        return self.sort_key < other.sort_key
+    def set_data(self, data):
+        """sets the vCal data; the vobject instance is only parsed from it when first needed"""
+        self._data = vcal.fix(data)
+        self._instance = None
+        self._fields = None
+        self._record = None
+        return self
 
-    def __le__(self, other):
-        if type(self) != type(other):
-            return type(self) < type(other)
-        return self.sort_key <= other.sort_key
+    def get_data(self):
+        return self._data
+    data = property(get_data, set_data, doc="vCal representation of the task")
 
-    def __gt__(self, other):
-        if type(self) != type(other):
-            return type(self) > type(other)
-        return self.sort_key > other.sort_key
+    def set_instance(self, inst):
+        self._fields = None
+        self._record = None
+        return caldav.Event.set_instance(self, inst)
 
-    def __ge__(self, other):
-        if type(self) != type(other):
-            return type(self) > type(other)
-        return self.sort_key >= other.sort_key
+    def get_instance(self):
+        if self._instance is None and self.partial and self.url is not None:
+            self.load()
+        if self._instance is None and self._data is not None:
+            with timings.phase("parse vobject"):
+                self._instance = caldav.vobject.readOne(StringIO.StringIO(self._data))
+        return self._instance
+    instance = property(get_instance, set_instance, doc="vobject instance of the task, parsed from data on first use")
 
-    @property
-    def sort_key(self):
-        return self.value if self.value != 0 else 5
+    @classmethod
+    def extract_fields_many(cls, tasks, workers=1, threshold=parallel.DEFAULT_THRESHOLD):
+        """extracts the FAST_FIELDS of all the given tasks up front in a pool of worker processes, if parallel.use_workers() says
+        there are enough of them to make it worthwhile; otherwise they are left to be extracted from each task when first needed"""
+        pending = [task for task in tasks if task._fields is None and task._data is not None]
+        if not parallel.use_workers(len(pending), workers, threshold):
+            return
+        with timings.phase("parse fields"):
+            fields = parallel.extract_fields_many([task._data for task in pending], set(cls.FAST_FIELDS.values()), workers, threshold)
+        for task, task_fields in zip(pending, fields):
+            task._fields = task_fields
 
     @property
-    def str_value(self):
-        return str(self.value)
+    def fields(self):
+        """the FAST_FIELDS values extracted from data without parsing it into a vobject instance, keyed by property name"""
+        if self._fields is None:
+            with timings.phase("parse fields"):
+                self._fields = ical.extract_fields(self._data, set(self.FAST_FIELDS.values()))
+        return self._fields
 
-    @property
-    def display_name(self):
-        return self.name if len(self.name) == 1 else ""
-
-class Priority(enum.Enum):
-    unspecified = 0
-    A = 1
-    B = 2
-    C = 3
-    D = 4
-    default = 5
-    E = 6
-    F = 7
-    W = 8
-    H = 9
-
-    __value_factory__ = PriorityValue
-
-Priority.__all__ = set(Priority)
-Priority.__named__ = {p for p in Priority if len(p.name) == 1}
-Priority.__range_re__ = re.compile(r'([A-FHWa-fhw]|[A-FHWa-fhw]-[A-FHWa-fhw])')
+    @timings.timed("write")
+    def save(self):
+        """
+        Save the task, which needs the vobject instance to serialize; creates it if it has no url yet.
+        Afterwards data is what was saved, and etag is the new etag if the server gave one.
+        """
+        data = self.instance.serialize()
+        if self.url is None:
+            self.id = self.id or str(uuid.uuid1())
+            path = url.join(self.parent.url.path, self.id + ".ics")
+        else:
+            path = self.url.path
+        r = self.client.put(path, data, {"Content-Type": 'text/calendar; charset="utf-8"'})
+        if r.status not in (200, 201, 204):
+            raise error.PutError(r.raw)
+        if self.url is None:
+            self.url = urlparse.urlparse(url.make(self.parent.url, path))
+        self.saved(data, dict(r.headers).get("etag"))
+        return self
 
-class Task(caldav.Event):
-    # priority map: A-D = 1-4 (high), none=0=5 (medium), E-H=6-9 (low) except G has been temporarily replaced with W for delegated tasks
-    # TODO: find another way to do task delegation
+    def saved(self, data, etag):
+        """records that data has been saved to the server, which gave it the given etag"""
+        self._data = data
+        self._fields = None
+        self._record = None
+        self.partial = False
+        self.etag = etag
 
+    @timings.timed("load task")
     def load(self):
         """
         Load the task from the caldav server.
         """
         r = self.client.request(self.url.path)
         self.data = vcal.fix(r.raw)
+        self.etag = dict(r.headers).get("etag", self.etag)
+        self.partial = False
         return self
 
     @classmethod
@@ -117,49 +153,54 @@ class Task(caldav.Event):
     @classmethod
     def parse_priority_range(cls, priority_str):
         """Parses the given priority_str which can be either a single priority `C` or a range `B-E`, and return a set of PriorityValues"""
-        if priority_str:
-            if not Priority.__range_re__.match(priority_str):
-                raise ValueError("Priority range expression is not valid: %s" % priority_str)
-            priority_str = priority_str.upper()
-            if "-" in priority_str:
-                start_p, stop_p = Priority(priority_str[0]), Priority(priority_str[2])
-                return {p for p in Priority if start_p <= p <= stop_p}
-            else:
-                return {Priority(priority_str)}
-        else:
-            return Priority.__named__
+        return todo.parse_priority_range(priority_str)
 
     @classmethod
     def parse_priority(cls, priority_str):
         """Parses the given priority_str which must be a single priority `C`, and return a PriorityValue"""
-        if priority_str:
-            priority_str = priority_str.upper()
-            return Priority(priority_str)
-        else:
-            return None
+        return todo.parse_priority(priority_str)
 
     def todo_getattr(self, attr_name, default=""):
-        """Returns the attribute from self.instance.vtodo with the given name's value, or default if not present"""
-        if not self.instance:
+        """Returns the attribute from self.instance.vtodo with the given name's value, or default if not present.
+        FAST_FIELDS are read from the raw data unless the instance has already been parsed"""
+        if self._data is None:
             self.load()
+        if self._instance is None and attr_name in self.FAST_FIELDS:
+            return self.fields.get(self.FAST_FIELDS[attr_name], default)
         vtodo = self.instance.vtodo
         obj = getattr(vtodo, attr_name, None)
         return obj.value if obj is not None else default
 
     def todo_setattr(self, attr_name, value):
         """sets the attribute from self.instance.vtodo to the given value"""
-        if not self.instance:
+        if self._data is None and self._instance is None:
             self.load()
         vtodo = self.instance.vtodo
+        self._record = None
         if not hasattr(vtodo, attr_name):
             vtodo.add(attr_name).value = value
         else:
             getattr(vtodo, attr_name).value = value
 
+    @property
+    def record(self):
+        """the TaskRecord of the task's priority, status and summary, decoded on first use and kept until the task is changed,
+        which must be done through todo_setattr or by setting data or instance"""
+        if self._record is None:
+            self._record = TaskRecord(int(self.todo_getattr("priority", "0")), self.todo_getattr("status", None), self.todo_getattr("summary", ""))
+            # the record holds all that listing needs, so the fields it was decoded from aren't kept as well
+            self._fields = None
+        return self._record
+
+    @property
+    def sort_key(self):
+        """the key to sort tasks by priority, then status, then summary"""
+        return self.record.sort_key
+
     @property
     def status(self):
         """Returns the current status"""
-        return self.todo_getattr("status", None)
+        return self.record.status
 
     @status.setter
     def status(self, value):
@@ -168,7 +209,7 @@ class Task(caldav.Event):
     @property
     def priority(self):
         """Returns the current priority as a PriorityValue"""
-        return Priority(int(self.todo_getattr("priority", "0")))
+        return self.record.priority
 
     @priority.setter
     def priority(self, value):
@@ -185,7 +226,7 @@ class Task(caldav.Event):
     @property
     def summary(self):
         """Returns the current summary"""
-        return self.todo_getattr("summary", "")
+        return self.record.summary
 
     @summary.setter
     def summary(self, value):
@@ -193,59 +234,522 @@ class Task(caldav.Event):
 
     def format(self):
         """Formats a task for output"""
-        if not self.instance:
+        if self._data is None and self._instance is None:
             self.load()
-        priority = self.priority.display_name
-        status_str = ("x " if self.status == "COMPLETED" else "") + (priority + " " if priority else "")
-        return "%s%s" % (status_str, self.summary)
+        return self.record.format()
+
+class SyncTokenError(error.ReportError):
+    """The server rejected the sync-token given in a sync-collection report"""
+
+class SyncUnsupportedError(error.ReportError):
+    """The server doesn't support the sync-collection report"""
+
+# the statuses with which servers refuse a report they don't support
+UNSUPPORTED_REPORT_STATUSES = (403, 405, 501)
+
+class SyncState(object):
+    """What is known about a TaskList from the last sync: the sync-token and ctag for the collection, and the etag for each href"""
+    def __init__(self, url=None, sync_token=None, ctag=None, etags=None, sync_collection=None):
+        self.url = url
+        self.sync_token = sync_token
+        self.ctag = ctag
+        self.etags = etags or {}
+        # None if unknown, otherwise whether the server supports sync-collection reports
+        self.sync_collection = sync_collection
+
+    def reset(self, url):
+        self.__init__(url)
+
+    def to_dict(self):
+        return {"url": self.url, "sync_token": self.sync_token, "ctag": self.ctag, "etags": self.etags, "sync_collection": self.sync_collection}
+
+    @classmethod
+    def from_dict(cls, d):
+        return cls(d.get("url"), d.get("sync_token"), d.get("ctag"), d.get("etags"), d.get("sync_collection"))
+
+class TaskFilter(object):
+    """Conditions on tasks that are sent to the server as calendar-query prop-filters, and also checked locally.
+
+    Servers don't match prop-filters against missing properties, so when incomplete is set, the tasks without a STATUS are searched for
+    in a query of their own; and the priority condition is only sent when unspecified priority is excluded, as it's the only one
+    a missing PRIORITY can have"""
+    def __init__(self, incomplete=False, priorities=None, summary_terms=(), summary_excludes=()):
+        self.incomplete = incomplete
+        self.priorities = priorities
+        self.summary_terms = [term.lower() for term in summary_terms]
+        self.summary_excludes = [term.lower() for term in summary_excludes]
+
+    def __nonzero__(self):
+        return bool(self.incomplete or self.priorities is not None or self.summary_terms or self.summary_excludes)
+
+    def prop_filter_sets(self):
+        """returns a list of the prop-filter elements to add to the VTODO comp-filter of each query to send, all of which must match;
+        the queries find separate tasks, which together are those that match"""
+        filters = []
+        if self.priorities is not None and Priority.unspecified not in self.priorities:
+            # a text-match can't give a set of alternatives, so exclude each priority that isn't wanted
+            for p in Priority:
+                if p not in self.priorities:
+                    filters.append(cdav.PropFilter("PRIORITY") + TextMatch(p.str_value, collation="i;octet", negate=True))
+        for term in self.summary_terms:
+            filters.append(cdav.PropFilter("SUMMARY") + TextMatch(term))
+        for term in self.summary_excludes:
+            filters.append(cdav.PropFilter("SUMMARY") + TextMatch(term, negate=True))
+        if self.incomplete:
+            return [[cdav.PropFilter("STATUS") + TextMatch("COMPLETED", negate=True)] + filters,
+                    [cdav.PropFilter("STATUS") + cdav.NotDefined()] + filters]
+        return [filters]
+
+    def matches(self, task):
+        """checks the conditions against the given task locally"""
+        if self.incomplete and task.status == "COMPLETED":
+            return False
+        if self.priorities is not None and task.priority not in self.priorities:
+            return False
+        if self.summary_terms or self.summary_excludes:
+            summary = task.summary.lower()
+            if not all(term in summary for term in self.summary_terms):
+                return False
+            if any(term in summary for term in self.summary_excludes):
+                return False
+        return True
 
 class TaskList(caldav.Calendar):
     event_cls = Task
     _tasks = None
+    # the collection tag as it was when the calendar was found, if known
+    ctag = None
+    # the SyncState of the lookup of tasks, once sync_tasks() is keeping it up to date
+    _sync_state = None
+    # the search index of the lookup of tasks, once it has been asked for
+    _index = None
+    # the lookup of (href, etag) by task id found without fetching the tasks, once it has been asked for
+    _id_index = None
 
-    def tasks(self):
-        """
-        Search tasks in the calendar
-
-        Returns:
-         * [Task(), ...]
-        """
-        matches = []
+    def _task_from_response(self, r, etag=None):
+        """constructs a task from a multistatus response element, or returns None if the response contains no calendar data"""
+        href = urlparse.urlparse(r.find(dav.Href.tag).text)
+        href = url.canonicalize(href, self)
+        data = r.find(".//" + cdav.CalendarData.tag)
+        if data is None or data.text is None:
+            return None
+        etag_element = r.find(".//" + dav.GetEtag.tag)
+        etag = etag_element.text if etag_element is not None else etag
+        return self.event_cls(self.client, url=href, data=data.text, parent=self, etag=etag)
 
-        # build the request
+    def _tasks_query(self, prop_filters=(), props=None):
+        """builds the calendar-query report for tasks() and iter_tasks()"""
         getetag = dav.GetEtag()
         data = cdav.CalendarData()
+        if props is not None:
+            vtodo = cdav.Comp("VTODO") + [CalendarProp(name) for name in props]
+            data += cdav.Comp("VCALENDAR") + [CalendarProp("VERSION"), vtodo]
         prop = dav.Prop() + [getetag, data]
 
         vevent = cdav.CompFilter("VTODO")
+        if prop_filters:
+            vevent += prop_filters
         vcal = cdav.CompFilter("VCALENDAR") + vevent
         filter = cdav.Filter() + vcal
 
         root = cdav.CalendarQuery() + [prop, filter]
 
-        q = etree.tostring(root.xmlelement(), encoding="utf-8",
-                           xml_declaration=True)
+        return etree.tostring(root.xmlelement(), encoding="utf-8",
+                              xml_declaration=True)
+
+    def _response_task(self, r, props, raw=None):
+        """returns the task for a calendar-query response element, raising a ReportError with raw (or the element) if it's not a success"""
+        status = r.find(".//" + dav.Status.tag)
+        if status is None or not status.text.endswith("200 OK"):
+            raise error.ReportError(raw if raw is not None else etree.tostring(r))
+        task = self._task_from_response(r)
+        task.partial = props is not None
+        return task
+
+    def _tasks_queries(self, task_filter=None, props=None):
+        """returns the calendar-query reports to send for task_filter, whose tasks together are those that match"""
+        if not task_filter:
+            return [self._tasks_query(props=props)]
+        return [self._tasks_query(prop_filters, props) for prop_filters in task_filter.prop_filter_sets()]
+
+    @timings.timed("fetch tasks")
+    def tasks(self, task_filter=None, props=None):
+        """
+        Search tasks in the calendar, optionally only those matching task_filter.
+        The filter is sent to the server; if the server rejects it, all tasks are fetched and filtered locally.
+        If props is given, only those VTODO properties are fetched, and the tasks are marked as partial.
+
+        Returns:
+         * [Task(), ...]
+        """
+        matches = []
+        for q in self._tasks_queries(task_filter, props):
+            if task_filter:
+                try:
+                    response = self.client.report(self.url.path, q, 1)
+                except error.AuthorizationError:
+                    # caldav raises this for any 403, which is how servers reject an unsupported filter
+                    response = None
+                if response is None or response.status != 207:
+                    return [task for task in self.tasks(props=props) if task_filter.matches(task)]
+            else:
+                response = self.client.report(self.url.path, q, 1)
+            matches.extend(self._response_task(r, props, response.raw) for r in response.tree.findall(".//" + dav.Response.tag))
+        self._extract_fields(matches)
+
+        if task_filter:
+            # the server may not have applied every condition
+            matches = [task for task in matches if task_filter.matches(task)]
+        return matches
+
+    def iter_tasks(self, task_filter=None, props=None):
+        """
+        Like tasks(), but parses the report incrementally as it is received, yielding each task as soon as its response is complete.
+        Each response element is discarded once its task is made, so memory use doesn't grow with the size of the report.
+        If iteration is stopped early, a short rest of the report is still read so that the connection can be reused; after a long one it is closed.
+
+        Yields:
+         * Task()
+        """
+        queries = self._tasks_queries(task_filter, props)
+        # the tasks found by earlier queries, so that listing every task if a later one is rejected doesn't yield them again
+        found = set()
+        for q in queries:
+            try:
+                response = self.client.stream_report(self.url.path, q, 1)
+            except error.AuthorizationError:
+                if not task_filter:
+                    raise
+                # caldav raises this for any 403, which is how servers reject an unsupported filter
+                response = None
+            if response is None or response.status != 207:
+                raw = response.read() if response is not None else ""
+                if not task_filter:
+                    raise error.ReportError(raw)
+                for task in self.iter_tasks(props=props):
+                    if task_filter.matches(task) and task.canonical_url not in found:
+                        yield task
+                return
+            try:
+                for event, r in etree.iterparse(response, events=("end",), tag=dav.Response.tag):
+                    task = self._response_task(r, props)
+                    # free the parsed response, and any preceding siblings that are still held by the root
+                    r.clear()
+                    while r.getprevious() is not None:
+                        del r.getparent()[0]
+                    # the server may not have applied every condition
+                    if not task_filter or task_filter.matches(task):
+                        if len(queries) > 1:
+                            found.add(task.canonical_url)
+                        yield task
+            finally:
+                response.close()
+
+    def top(self, n, task_filter=None):
+        """
+        Returns the first n tasks by priority, then status, then summary, optionally only those matching task_filter, keeping a heap of
+        at most n tasks instead of sorting them all. The lookup of tasks is used if it has been loaded; otherwise the tasks are listed
+        from the server with the filtered report, and each is considered as it arrives.
+
+        Returns:
+         * [Task(), ...]
+        """
+        if self._tasks is not None:
+            tasks = (task for task in self._tasks.itervalues() if not task_filter or task_filter.matches(task))
+        else:
+            tasks = self.iter_tasks(task_filter, props=Task.LIST_PROPS)
+        return heapq.nsmallest(n, tasks, key=lambda task: task.sort_key)
+
+    def _extract_fields(self, tasks):
+        """extracts the fields of the given tasks up front, in the client's pool of parse_workers if there are at least parse_threshold"""
+        self.event_cls.extract_fields_many(tasks, self.client.parse_workers, self.client.parse_threshold)
+
+    def _propfind(self, props, depth=0):
+        """sends a propfind for the given properties, returning the response elements"""
+        root = dav.Propfind() + (dav.Prop() + props)
+        q = etree.tostring(root.xmlelement(), encoding="utf-8", xml_declaration=True)
+        response = self.client.propfind(self.url.path, q, depth)
+        if response.tree is None:
+            raise error.ReportError(response.raw)
+        return response.tree.findall(".//" + dav.Response.tag)
+
+    def get_ctag(self):
+        """returns the collection tag for this calendar, or None if the server does not provide one"""
+        for r in self._propfind([GetCTag()]):
+            ctag = r.find(".//" + GetCTag.tag)
+            if ctag is not None and ctag.text:
+                return ctag.text
+        return None
+
+    def get_etags(self):
+        """returns a dict mapping the canonical href of each resource in the calendar to its etag"""
+        etags = {}
+        for r in self._propfind([dav.GetEtag()], depth=1):
+            href = url.canonicalize(urlparse.urlparse(r.find(dav.Href.tag).text), self)
+            etag = r.find(".//" + dav.GetEtag.tag)
+            if href != self.canonical_url and etag is not None and etag.text:
+                etags[href] = etag.text
+        return etags
+
+    def get_ids(self):
+        """returns a lookup mapping the id of every task in this TaskList to its href, found without fetching the tasks themselves"""
+        ids = short_id.prefix_dict()
+        for href in self.get_etags():
+            ids[get_object_urlname(self.event_cls(self.client, url=href)).replace(".ics", "")] = href
+        return ids
+
+    def current_ctag(self):
+        """returns the collection tag as it is on the server: the one found with the calendar if it was found on the server in this run,
+        or else asked for"""
+        if self.ctag is not None and self.url.path not in self.client.unchecked_calendars:
+            return self.ctag
+        return self.get_ctag()
+
+    def _propfind_ids(self):
+        """returns the ctag and a dict mapping the id of every task in this TaskList to its (href, etag), found with a single propfind"""
+        ctag, ids = None, {}
+        for r in self._propfind([GetCTag(), dav.GetEtag()], depth=1):
+            href = url.canonicalize(urlparse.urlparse(r.find(dav.Href.tag).text), self)
+            if href == self.canonical_url:
+                ctag = r.findtext(".//" + GetCTag.tag) or None
+                continue
+            etag = r.find(".//" + dav.GetEtag.tag)
+            if etag is not None and etag.text:
+                ids[get_object_urlname(self.event_cls(self.client, url=href)).replace(".ics", "")] = (href, etag.text)
+        return ctag, ids
+
+    def _cached_ids(self):
+        """returns (ctag, ids) as last recorded in the client's id_cache, or None"""
+        if self.client.id_cache is None:
+            return None
+        return self.client.id_cache.get(self.canonical_url)
+
+    @timings.timed("fetch ids")
+    def get_id_index(self):
+        """
+        Returns a lookup mapping the id of every task in this TaskList to its (href, etag), without fetching the tasks themselves.
+        The ids recorded in the client's id_cache are used for as long as the calendar's ctag hasn't changed; otherwise they are
+        listed again with a propfind, and recorded.
+        """
+        if self._id_index is None:
+            cached = self._cached_ids()
+            ctag = self.current_ctag() if cached is not None else None
+            if cached is not None and ctag is not None and cached[0] == ctag:
+                ids = cached[1]
+            else:
+                ctag, ids = self._propfind_ids()
+                if self.client.id_cache is not None and ctag is not None:
+                    self.client.id_cache.set(self.canonical_url, ctag, ids)
+            self._id_index = short_id.prefix_dict(ids)
+        return self._id_index
+
+    def get_id_lookup(self):
+        """returns a lookup whose keys are the ids of all the tasks in this TaskList, for working out short ids:
+        the lookup of tasks if they are loaded, or else the id index"""
+        if self._tasks is not None:
+            return self._tasks
+        return self.get_id_index()
+
+    def added(self, task):
+        """records a task that has just been created in the lookup of tasks or id index, whichever are in use"""
+        if self._tasks is not None:
+            self._tasks[task.id] = task
+        if self._id_index is not None:
+            self._id_index[task.id] = (task.canonical_url, task.etag)
+
+    def _multiget(self, tasks):
+        """loads the given tasks with a single calendar-multiget report, returning those the server didn't return.
+        Raises error.ReportError if the server doesn't support calendar-multiget"""
+        prop = dav.Prop() + [dav.GetEtag(), cdav.CalendarData()]
+        root = CalendarMultiget() + ([prop] + [dav.Href(value=task.url.path) for task in tasks])
+        q = etree.tostring(root.xmlelement(), encoding="utf-8", xml_declaration=True)
         response = self.client.report(self.url.path, q, 1)
+        if response.status != 207 or response.tree is None:
+            raise error.ReportError(response.raw)
+        by_href = {}
+        for task in tasks:
+            by_href.setdefault(task.canonical_url, []).append(task)
         for r in response.tree.findall(".//" + dav.Response.tag):
-            status = r.find(".//" + dav.Status.tag)
-            if status.text.endswith("200 OK"):
-                href = urlparse.urlparse(r.find(dav.Href.tag).text)
-                href = url.canonicalize(href, self)
-                data = r.find(".//" + cdav.CalendarData.tag).text
-                etag = r.find(".//" + dav.GetEtag.tag).text
-                e = self.event_cls(self.client, url=href, data=data, parent=self, etag=etag)
-                matches.append(e)
+            loaded = self._task_from_response(r)
+            if loaded is not None:
+                for task in by_href.pop(loaded.canonical_url, ()):
+                    task.data = loaded.data
+                    task.etag = loaded.etag
+                    task.partial = False
+        return [task for href_tasks in by_href.values() for task in href_tasks]
+
+    @timings.timed("fetch tasks")
+    def load_many(self, tasks):
+        """
+        Loads the given tasks from the server in full, with a calendar-multiget report for each batch of up to
+        client.multiget_batch_size tasks instead of a request for each one. Any task the server doesn't return is loaded on its own,
+        as are all of them if the server doesn't support calendar-multiget.
+
+        Returns:
+         * [Task(), ...] the given tasks
+        """
+        tasks = list(tasks)
+        batch_size = self.client.multiget_batch_size
+        pending = tasks
+        while pending:
+            batch, pending = pending[:batch_size], pending[batch_size:]
+            try:
+                missing = self._multiget(batch)
+            except (error.ReportError, error.AuthorizationError):
+                missing, pending = batch + pending, []
+            for task in missing:
+                task.load()
+        return tasks
+
+    def sync_collection(self, sync_token=None):
+        """
+        Asks for the changes since sync_token with an RFC 6578 sync-collection report (everything if sync_token is None)
+
+        Returns:
+         * ([Task(), ...] changed, [href, ...] deleted, new sync_token)
+        Raises SyncTokenError if the server rejects the token, SyncUnsupportedError if it doesn't support sync-collection,
+        or error.ReportError if the report fails in any other way
+        """
+        prop = dav.Prop() + [dav.GetEtag(), cdav.CalendarData()]
+        root = SyncCollection() + [SyncToken(sync_token or ""), SyncLevel("1"), prop]
+        q = etree.tostring(root.xmlelement(), encoding="utf-8", xml_declaration=True)
+        try:
+            response = self.client.report(self.url.path, q, 0)
+        except error.AuthorizationError as e:
+            # caldav raises this for any 403, which is also how servers reject an invalid sync-token
+            if sync_token:
+                raise SyncTokenError(e.reason)
+            raise SyncUnsupportedError(e.reason)
+        if response.status != 207 or response.tree is None:
+            if sync_token and response.tree is not None and response.tree.find(".//" + ValidSyncToken.tag) is not None:
+                raise SyncTokenError(response.raw)
+            if response.status in UNSUPPORTED_REPORT_STATUSES or \
+                    (response.tree is not None and response.tree.find(".//" + SupportedReport.tag) is not None):
+                raise SyncUnsupportedError(response.raw)
+            raise error.ReportError(response.raw)
+        changed, deleted, unloaded = [], [], []
+        for r in response.tree.findall(".//" + dav.Response.tag):
+            href = url.canonicalize(urlparse.urlparse(r.find(dav.Href.tag).text), self)
+            if href == self.canonical_url:
+                continue
+            status = r.find(dav.Status.tag)
+            if status is not None and status.text.endswith("404 Not Found"):
+                deleted.append(href)
+                continue
+            task = self._task_from_response(r)
+            if task is not None:
+                changed.append(task)
             else:
-                raise error.ReportError(response.raw)
+                etag = r.find(".//" + dav.GetEtag.tag)
+                unloaded.append(self.event_cls(self.client, url=href, parent=self, etag=etag.text if etag is not None else None))
+        changed.extend(self.load_many(unloaded))
+        new_token = response.tree.findtext(SyncToken.tag)
+        return changed, deleted, new_token
 
-        return matches
+    @timings.timed("fetch tasks")
+    def sync_changes(self, state):
+        """
+        Brings the given SyncState up to date with the server, fetching only tasks that were added or changed since it was last synced.
+        Uses sync-collection if the server supports it, and otherwise compares the ctag and then each resource's etag.
+        Only a server that refuses the sync-collection report is given up on; any other failure is raised, to try again next time.
+
+        Returns:
+         * ([Task(), ...] added or changed, [href, ...] deleted)
+        """
+        if state.url != self.canonical_url:
+            state.reset(self.canonical_url)
+        if state.sync_collection is not False:
+            sync_token = state.sync_token
+            try:
+                try:
+                    changed, deleted, new_token = self.sync_collection(sync_token)
+                except SyncTokenError:
+                    sync_token = None
+                    changed, deleted, new_token = self.sync_collection(None)
+            except SyncUnsupportedError:
+                state.sync_collection = False
+                state.sync_token = None
+            else:
+                state.sync_collection = True
+                state.sync_token = new_token
+                if not sync_token:
+                    # a full listing: anything not listed has gone, and anything unchanged can be skipped
+                    hrefs = {task.canonical_url for task in changed}
+                    deleted = [href for href in state.etags if href not in hrefs]
+                    changed = [task for task in changed if state.etags.get(task.canonical_url) != task.etag]
+                for href in deleted:
+                    state.etags.pop(href, None)
+                for task in changed:
+                    state.etags[task.canonical_url] = task.etag
+                return changed, deleted
+        ctag = self.get_ctag()
+        if ctag is not None and ctag == state.ctag:
+            return [], []
+        etags = self.get_etags()
+        deleted = [href for href in state.etags if href not in etags]
+        changed = self.load_many(self.event_cls(self.client, url=href, parent=self, etag=etag)
+                                 for href, etag in sorted(etags.items()) if state.etags.get(href) != etag)
+        state.ctag = ctag
+        state.etags = etags
+        return changed, deleted
 
-    def load_tasks(self):
-        """loads all tasks in this TaskList into a lookup by id"""
-        self._tasks = tasks = short_id.prefix_dict()
-        for task in self.tasks():
+    @timings.timed("fetch tasks")
+    def load_tasks(self, props=Task.LIST_PROPS):
+        """loads all tasks in this TaskList into a lookup by id; by default only with the properties needed to list them,
+        as each task is fully loaded when it is changed"""
+        tasks = short_id.prefix_dict()
+        for task in self.iter_tasks(props=props):
             task_id = task.id or (get_object_urlname(task).replace(".ics", ""))
             tasks[task_id] = task
+        self._extract_fields(tasks.values())
+        self._tasks = tasks
+        self._index = None
+        self._id_index = None
+
+    def forget_tasks(self):
+        """drops the lookup of tasks, so that the next sync_tasks() loads every task afresh; for when tasks in it may have been
+        changed without the changes reaching the server"""
+        self._tasks = None
+        self._sync_state = None
+        self._index = None
+        self._id_index = None
+
+    def sync_tasks(self):
+        """
+        Brings the lookup of tasks up to date with the server, fetching only the tasks that were added or changed since it was last
+        synced; the first sync loads every task in full. This is how a long-running process keeps its tasks current.
+        The lookup is replaced rather than changed, so that anyone still using the old one sees it unchanged.
+
+        Returns:
+         * ([Task(), ...] added or changed, [href, ...] deleted)
+        """
+        first_sync = self._sync_state is None
+        if first_sync:
+            self._sync_state = SyncState()
+            tasks = short_id.prefix_dict()
+        else:
+            tasks = short_id.prefix_dict(self._tasks)
+        changed, deleted = self.sync_changes(self._sync_state)
+        if first_sync or changed or deleted:
+            index = None if first_sync else self._index
+            hrefs = set(deleted) | {task.canonical_url for task in changed}
+            for task_id, task in tasks.items():
+                if task.canonical_url in hrefs:
+                    del tasks[task_id]
+                    if index is not None:
+                        index.remove(task_id)
+            for task in changed:
+                task_id = task.id or get_object_urlname(task).replace(".ics", "")
+                tasks[task_id] = task
+                if index is not None:
+                    index.add(task_id, task)
+            self._tasks = tasks
+            self._index = index
+        return changed, deleted
+
+    def tasks_loaded(self):
+        """whether the tasks have already been loaded into the lookup, so that they can be searched without asking the server"""
+        return self._tasks is not None
 
     def get_tasks(self):
         """returns a lookup making id to task for all tasks in this TaskList"""
@@ -253,40 +757,359 @@ class TaskList(caldav.Calendar):
             self.load_tasks()
         return self._tasks
 
-    def get_task(self, task_id):
-        """returns a task by id, ensuring it is loaded"""
-        tasks = self.get_tasks()
-        task = tasks.unique(task_id)
-        if not task.instance:
+    def get_index(self):
+        """returns the TaskIndex of all tasks in this TaskList, which sync_tasks() keeps up to date"""
+        if self._index is None:
+            self._index = TaskIndex(self.get_tasks())
+        return self._index
+
+    def _fetch_cached_task(self, task_id):
+        """fetches the task whose full id is task_id with a single GET, if the ids in the client's id_cache name it without ambiguity,
+        even if the calendar may have changed since; returns None if they don't, or the task is no longer there"""
+        cached = self._cached_ids()
+        if cached is None or task_id not in cached[1]:
+            return None
+        if any(other != task_id and other.startswith(task_id) for other in cached[1]):
+            return None
+        href = cached[1][task_id][0]
+        response = self.client.request(urlparse.urlparse(href).path)
+        if response.status != httplib.OK:
+            return None
+        task = self.event_cls(self.client, url=href, parent=self, data=vcal.fix(response.raw), etag=dict(response.headers).get("etag"))
+        task.id = task_id
+        return task
+
+    def get_task(self, task_id, load=True):
+        """
+        Returns a task by id or unique id prefix, ensuring it is loaded unless load is False.
+
+        If the tasks haven't all been loaded, only the one task is fetched: straight away if task_id is a full id in the client's id_cache,
+        or else once the prefix has been resolved against the id index, which costs at most a ctag check or propfind on top of the GET.
+        """
+        if self._tasks is None:
+            task = self._fetch_cached_task(task_id) if load else None
+            if task is None:
+                ids = self.get_id_index()
+                task_id = ids.unique_key(task_id)
+                href, etag = ids[task_id]
+                task = self.event_cls(self.client, url=href, parent=self, etag=etag)
+                task.id = task_id
+                if load:
+                    task.load()
+            return task
+        task = self._tasks.unique(task_id)
+        if load and task.data is None:
             task.load()
         if not task.id:
-            task.id = task.instance.vtodo.uid.value
+            task.id = task.todo_getattr("uid", None)
         return task
 
+class WriteResult(object):
+    """The outcome of one write sent by a BatchWriter: the response status, or the exception raised while sending it"""
+    def __init__(self, task, method, status=None, exception=None):
+        self.task = task
+        self.method = method
+        self.status = status
+        self.exception = exception
+
+    @property
+    def ok(self):
+        # as in caldav, deleting something that has already gone is not an error
+        return self.status in (200, 201, 204) or (self.method == "DELETE" and self.status == 404)
+
+    @property
+    def conflict(self):
+        """whether the task was changed or removed on the server since it was loaded, so was not written"""
+        return self.status == httplib.PRECONDITION_FAILED
+
+    def __str__(self):
+        if self.exception is not None:
+            return "%s failed: %r" % (self.method, self.exception)
+        return "%s %s" % (self.method, self.status)
+
+class BatchWriter(object):
+    """
+    Saves and deletes many tasks by sending their PUT and DELETE requests concurrently from a bounded pool of worker threads,
+    over the client's connection pool.
+
+    Writes are conditional on each task's etag if it is known (with If-Match), and new tasks must not already exist (If-None-Match),
+    so a task changed on the server since it was loaded is not overwritten; such writes are reported as conflicts.
+    """
+    def __init__(self, client, workers=8):
+        self.client = client
+        self.workers = workers
+        self.writes = []
+
+    def save(self, task):
+        """queues the task to be saved, creating it if it has no url yet"""
+        self.writes.append(self.save_request(task))
+
+    def delete(self, task):
+        """queues the task to be deleted"""
+        self.writes.append(self.delete_request(task))
+
+    @staticmethod
+    def save_request(task):
+        """returns the write that saves the task, as (task, method, path, body, headers)"""
+        body = task.instance.serialize()
+        headers = {"Content-Type": 'text/calendar; charset="utf-8"'}
+        if task.url is None:
+            task.id = task.id or str(uuid.uuid1())
+            path = url.join(task.parent.url.path, task.id + ".ics")
+            headers["If-None-Match"] = "*"
+        else:
+            path = task.url.path
+            if task.etag:
+                headers["If-Match"] = task.etag
+        return (task, "PUT", path, body, headers)
+
+    @staticmethod
+    def delete_request(task):
+        """returns the write that deletes the task, as (task, method, path, body, headers)"""
+        headers = {"If-Match": task.etag} if task.etag else {}
+        return (task, "DELETE", task.url.path, "", headers)
+
+    def send(self, write):
+        """sends a single write, updating the task's url, data and etag if it was saved, and returns its WriteResult"""
+        task, method, path, body, headers = write
+        try:
+            response = self.client.send_request(path, method, body, headers)
+        except Exception as e:
+            return WriteResult(task, method, exception=e)
+        result = WriteResult(task, method, response.status)
+        if result.ok and method == "PUT":
+            if task.url is None:
+                task.url = urlparse.urlparse(url.make(task.parent.url, path))
+            task.saved(body, dict(response.headers).get("etag"))
+        return result
+
+    @timings.timed("write")
+    def run(self):
+        """
+        Sends all the queued writes, updating each saved task's url, data and etag.
+
+        Returns:
+         * [WriteResult(), ...] in the order the writes were queued
+        """
+        writes, self.writes = self.writes, []
+        if not writes:
+            return []
+        pool = ThreadPool(min(self.workers, len(writes)))
+        try:
+            return pool.map(self.send, writes)
+        finally:
+            pool.close()
+            pool.join()
+
 class TaskPrincipal(caldav.Principal):
     calendar_cls = TaskList
 
+    def calendars(self):
+        """
+        List all calendar collections in this principal, with their ctags, from a single propfind.
+
+        Returns:
+         * [TaskList(), ...]
+        """
+        root = dav.Propfind() + (dav.Prop() + [dav.ResourceType(), GetCTag()])
+        q = etree.tostring(root.xmlelement(), encoding="utf-8", xml_declaration=True)
+        response = self.client.propfind(self.url.path, q, 1)
+        if response.tree is None:
+            raise error.ReportError(response.raw)
+        cals = []
+        for r in response.tree.findall(dav.Response.tag):
+            href = url.canonicalize(urlparse.urlparse(r.find(dav.Href.tag).text), self)
+            if href != self.canonical_url and r.find(".//" + cdav.Calendar.tag) is not None:
+                calendar = self.calendar_cls(self.client, href, parent=self)
+                calendar.ctag = r.findtext(".//" + GetCTag.tag) or None
+                cals.append(calendar)
+        return cals
+
 class TaskDAVClient(caldav.DAVClient):
-    """Client that knows about tasks"""
-    def __init__(self, url):
+    """
+    Client that knows about tasks, sending its requests over a pool of up to pool_size keep-alive connections.
+
+    If calendar_cache is given, calendars are looked up in it before being discovered from the server, and the cache is updated
+    whenever they are discovered. A stale entry is checked with a propfind on the calendar itself; an entry that is used without
+    checking and then turns out not to exist causes the calendars to be discovered again, and the request to be retried.
+    If id_cache is given, the ids of the tasks in each calendar are kept in it for TaskList.get_id_index().
+    Listings of at least parse_threshold tasks have their fields extracted by a pool of parse_workers processes, if there is more than one
+    """
+    def __init__(self, url, pool_size=8, calendar_cache=None, multiget_batch_size=100, id_cache=None, parse_workers=1,
+                 parse_threshold=parallel.DEFAULT_THRESHOLD):
         caldav.DAVClient.__init__(self, url)
+        self.pool = ConnectionPool(self.connect, pool_size)
+        # the most tasks TaskList.load_many() asks for in one calendar-multiget report
+        self.multiget_batch_size = multiget_batch_size
+        self.parse_workers = parse_workers
+        self.parse_threshold = parse_threshold
         # cache a principal we can use
         self.principal = TaskPrincipal(self, url)
         self.calendar_lookup = {}
+        # whether calendar_lookup holds every calendar, rather than only those taken from calendar_cache
+        self.calendars_loaded = False
+        self.calendar_cache = calendar_cache
+        self.id_cache = id_cache
+        # names of calendars taken from calendar_cache without checking them, by url path
+        self.unchecked_calendars = {}
+        self.discovery_lock = threading.RLock()
 
+    @timings.timed("discovery")
     def load_calendars(self):
-        self.calendar_lookup = {}
-        calendars = self.principal.calendars()
-        for calendar in calendars:
-            name = calendar.name or get_object_urlname(calendar)
-            # print (calendar.url.geturl(), name, calendar.id)
+        with self.discovery_lock:
+            self.calendar_lookup = {}
+            self.unchecked_calendars = {}
+            calendars = self.principal.calendars()
+            for calendar in calendars:
+                name = calendar.name or get_object_urlname(calendar)
+                # print (calendar.url.geturl(), name, calendar.id)
+                self.calendar_lookup[name] = calendar
+            self.calendars_loaded = True
+            if self.calendar_cache is not None:
+                found = {name: (calendar.url.geturl(), calendar.ctag) for name, calendar in self.calendar_lookup.items()}
+                self.calendar_cache.set_calendars(self.principal.canonical_url, found)
+
+    @timings.timed("discovery")
+    def load_cached_calendar(self, calendar_name):
+        """adds the named calendar to calendar_lookup from calendar_cache, checking it on the server first if its entry is stale;
+        returns whether it was found"""
+        if self.calendar_cache is None:
+            return False
+        entry = self.calendar_cache.get(self.principal.canonical_url, calendar_name)
+        if entry is None:
+            return False
+        calendar_url, ctag, fresh = entry
+        calendar = self.principal.calendar_cls(self, calendar_url, parent=self.principal)
+        calendar.ctag = ctag
+        if fresh:
+            self.unchecked_calendars[calendar.url.path] = calendar_name
+        else:
+            try:
+                responses = calendar._propfind([dav.ResourceType(), GetCTag()])
+            except error.ReportError:
+                return False
+            if not responses or responses[0].find(".//" + cdav.Calendar.tag) is None:
+                return False
+            calendar.ctag = responses[0].findtext(".//" + GetCTag.tag) or None
+            self.calendar_cache.set_calendar(self.principal.canonical_url, calendar_name, calendar_url, calendar.ctag)
+        self.calendar_lookup[calendar_name] = calendar
+        return True
+
+    def rediscover(self, path):
+        """
+        After a 404 for path within a calendar that was taken from calendar_cache without checking it, discovers the calendars again,
+        moving the existing calendar object to its new url.
+
+        Returns:
+         * the equivalent path within the calendar's new url, or None if the calendar hasn't moved
+        """
+        with self.discovery_lock:
+            for calendar_path, name in self.unchecked_calendars.items():
+                if path.startswith(calendar_path):
+                    break
+            else:
+                return None
+            calendar = self.calendar_lookup.get(name)
+            self.load_calendars()
+            found = self.calendar_lookup.get(name)
+            if calendar is None or found is None:
+                return None
+            calendar.url, calendar.ctag = found.url, found.ctag
             self.calendar_lookup[name] = calendar
+            if found.url.path == calendar_path:
+                return None
+            return found.url.path + path[len(calendar_path):]
+
+    def connect(self):
+        """returns a new connection to the server"""
+        if self.proxy is not None:
+            return httplib.HTTPConnection(*self.proxy)
+        elif self.url.port == 443 or self.url.scheme == 'https':
+            return httplib.HTTPSConnection(self.url.hostname, self.url.port)
+        return httplib.HTTPConnection(self.url.hostname, self.url.port)
+
+    def _send(self, url, method, body, headers):
+        """sends a request over a pooled connection, returning the url it was sent to and the unread PooledResponse.
+        Unlike caldav's request(), the given headers are not kept for later requests"""
+        path = url
+        if self.proxy is not None:
+            url = "%s://%s:%s%s" % (self.url.scheme, self.url.hostname, self.url.port, url)
+        combined_headers = dict(self.headers)
+        combined_headers.update(headers)
+        if not body:
+            combined_headers.pop("Content-Type", None)
+        connection, response = self.pool.request(method, url, body, combined_headers)
+        response = PooledResponse(self.pool, connection, response, method, len(body))
+        if response.status == httplib.NOT_FOUND and self.unchecked_calendars:
+            # discovery needs a connection of its own, which might be the only one in the pool
+            response.buffer()
+            new_path = self.rediscover(path)
+            if new_path is not None:
+                return self._send(new_path, method, body, headers)
+        return url, response
+
+    def _check_authorization(self, url, response):
+        if response.status in (httplib.FORBIDDEN, httplib.UNAUTHORIZED):
+            ex = error.AuthorizationError()
+            ex.url = url
+            ex.reason = response.reason
+            raise ex
+
+    def send_request(self, url, method="GET", body="", headers={}):
+        """sends a request, returning the DAVResponse whatever its status; this can be called from several threads at once"""
+        url, response = self._send(url, method, body, headers)
+        return caldav.davclient.DAVResponse(response)
+
+    def request(self, url, method="GET", body="", headers={}):
+        """sends a request, returning the DAVResponse; as in caldav, AuthorizationError is raised for a 401 or 403 status"""
+        response = self.send_request(url, method, body, headers)
+        self._check_authorization(url, response)
+        return response
+
+    def stream_request(self, url, method="GET", body="", headers={}):
+        """
+        Sends a request like request(), but returns the response without reading its body, so that it can be parsed as it arrives.
+        Its connection is returned to the pool once the body has been read to the end, or the response is closed.
+        """
+        url, response = self._send(url, method, body, headers)
+        if response.status in (httplib.FORBIDDEN, httplib.UNAUTHORIZED):
+            response.close()
+            self._check_authorization(url, response)
+        return response
+
+    def stream_report(self, url, query="", depth=0):
+        """sends a report request, returning the unread httplib response as stream_request() does"""
+        return self.stream_request(url, "REPORT", query, {"depth": str(depth), "Content-Type": "application/xml; charset=\"utf-8\""})
 
     def get_calendar(self, calendar_name):
-        if not calendar_name in self.calendar_lookup:
+        if not calendar_name in self.calendar_lookup and not self.load_cached_calendar(calendar_name):
             self.load_calendars()
         return self.calendar_lookup[calendar_name]
 
+    def map_calendars(self, func):
+        """
+        Calls func with every calendar concurrently, with as many at once as the connection pool allows.
+
+        Returns:
+         * {calendar name: func(calendar), ...}
+        """
+        if not self.calendars_loaded:
+            self.load_calendars()
+        names = sorted(self.calendar_lookup)
+        if not names:
+            return {}
+        pool = ThreadPool(min(self.pool.size, len(names)))
+        try:
+            results = pool.map(lambda name: func(self.calendar_lookup[name]), names)
+        finally:
+            pool.close()
+            pool.join()
+        return dict(zip(names, results))
+
+    def get_all_tasks(self):
+        """returns a dict mapping each calendar name to its lookup of tasks by id, fetching the tasks of every calendar concurrently"""
+        return self.map_calendars(lambda calendar: calendar.get_tasks())
+
     def load_tasks(self, calendar_name):
         self.get_calendar(calendar_name).load_tasks()
 
@@ -1,30 +1,82 @@
 #!/usr/bin/env python
 
-"""todo.txt command-line compatibility - implements many commands from todo.txt"""
+"""todo.txt command-line compatibility - implements many commands from todo.txt
 
-from taskdav.task import Priority, Task, TaskList, TaskDAVClient
+The CalDAV modules (caldav, lxml and vobject) are slow to import, so they are only imported, and the client created,
+when a command first needs the server; commands that read from the cache store don't.
+When a daemon is running (see taskdav.daemon), commands are sent to it before anything else is imported."""
+
+import os
+import sys
+
+if __name__ == "__main__":
+    from taskdav import daemon
+    status = daemon.forward(sys.argv[1:])
+    if status is not None:
+        sys.exit(status)
+
+from taskdav.todo import Priority, CONTEXT_RE, PROJ_RE, parse_priority, parse_priority_range
+from taskdav.search import matches_terms
+from taskdav.aggregate import DIMENSIONS, SnapshotLog, TaskColumns, parse_dimensions
+from taskdav import cache
 from taskdav import config
-from taskdav import short_id
+from taskdav import journal
+from taskdav import parallel
+from taskdav import store
+from taskdav import timings
 from datetime import datetime
-import caldav
+import heapq
 import re
 import aaargh
 import colorama
-import os
-import subprocess
-import sys
 
 cfg = config.get_config()
 url = cfg.get('server', 'url').replace("://", "://%s:%s@" % (cfg.get('server', 'username'), cfg.get('server', 'password'))) + "dav/%s/" % (cfg.get('server', 'username'),)
-client = TaskDAVClient(url)
+pool_size = cfg.getint('server', 'pool_size') if cfg.has_option('server', 'pool_size') else 8
 cache_dir = cfg.get('cache', 'dir') if cfg.has_option('cache', 'dir') else None
+calendars_ttl = cfg.getint('cache', 'calendars_ttl') if cfg.has_option('cache', 'calendars_ttl') else 3600
 cache_update = cfg.get('cache', 'update') if cfg.has_option('cache', 'update') else None
 boolean_option = {'t': True, 'true': True, 'y': True, 'yes': True, 'f': False, 'false': False, 'n': False, 'no': False}
 cache_default = (boolean_option[cfg.get('cache', 'default').lower()] if cfg.has_option('cache', 'default') else True) if cache_dir else False
-
-utc = caldav.vobject.icalendar.utc
-
-app = aaargh.App(description="A simple command-line tool for interacting with Tasks over CalDAV")
+write_workers = cfg.getint('server', 'write_workers') if cfg.has_option('server', 'write_workers') else 8
+multiget_batch_size = cfg.getint('server', 'multiget_batch_size') if cfg.has_option('server', 'multiget_batch_size') else 100
+parse_workers = cfg.getint('parse', 'workers') if cfg.has_option('parse', 'workers') else 1
+parse_threshold = cfg.getint('parse', 'threshold') if cfg.has_option('parse', 'threshold') else parallel.DEFAULT_THRESHOLD
+sync_default = boolean_option[cfg.get('cache', 'sync').lower()] if cache_dir and cfg.has_option('cache', 'sync') else False
+write_behind_default = boolean_option[cfg.get('cache', 'write_behind').lower()] if cache_dir and cfg.has_option('cache', 'write_behind') else False
+flush_batch_size = cfg.getint('cache', 'flush_batch_size') if cfg.has_option('cache', 'flush_batch_size') else 100
+
+TIMINGS_ENV = "TASKDAV_TIMINGS"
+
+_client = None
+
+def get_client():
+    """returns the client for the configured server, creating it on first use"""
+    global _client
+    if _client is None:
+        from taskdav.task import TaskDAVClient
+        calendar_cache = cache.CalendarCache(cache.calendars_filename(cache_dir), calendars_ttl) if calendars_ttl > 0 else None
+        id_cache = cache.IdCache(cache.ids_filename(cache_dir))
+        _client = TaskDAVClient(url, pool_size, calendar_cache, multiget_batch_size, id_cache,
+                                parse_workers=parse_workers, parse_threshold=parse_threshold)
+    return _client
+
+def get_writer():
+    """returns a BatchWriter to send writes to the server with, or in write-behind mode a JournalWriter to journal them with"""
+    if _write_behind is not None:
+        return _write_behind.writer()
+    from taskdav.task import BatchWriter
+    return BatchWriter(get_client(), write_workers)
+
+def get_write_calendar(calendar_name):
+    """returns the named calendar to write tasks to, or in write-behind mode its stand-in that finds tasks in the cache store"""
+    if _write_behind is not None:
+        return _write_behind.calendar(calendar_name)
+    return get_client().get_calendar(calendar_name)
+
+app = aaargh.App(description="A simple command-line tool for interacting with Tasks over CalDAV",
+                 epilog="Give --timings before the command (or set %s) to print the time spent in each phase of it and the requests it sent "
+                        "to standard error, or --profile FILE to save a cProfile of it to FILE" % TIMINGS_ENV)
 
 app.arg('-n', '--calendar-name', help="Name of the calendar to use", default="Tasks")
 app.arg('-c', '--color', dest='color', action="store_true", help="Color output mode", default=True)
@@ -34,29 +86,115 @@ def cache_args(f):
     """decorator that adds standard caching arguments to a cmd which reads data"""
     use_cache = app.cmd_arg('-C', '--cache', dest='use_cache', action="store_true", help="Use cache directory", default=None)
     no_use_cache = app.cmd_arg('--no-cache', dest='use_cache', action="store_false", help="Don't use cache directory")
-    return no_use_cache(use_cache(f))
+    sync = app.cmd_arg('-s', '--sync', dest='sync', action="store_true", help="Incrementally sync the cache directory with the server before using it", default=None)
+    return sync(no_use_cache(use_cache(f)))
 
 def cache_update_args(f):
-    """decorator that adds standard caching arguments to a cmd which writes data, and does a background update after that command finishes"""
+    """decorator that adds standard caching arguments to a cmd which writes data, and does a background update after that command finishes;
+    in write-behind mode the command's writes are journaled and applied to the cache store instead, so there is nothing to update"""
     use_cache = app.cmd_arg('-C', '--cache', dest='update_cache', action="store_true", help="Update cache directory after changes", default=None)
     no_use_cache = app.cmd_arg('--no-cache', dest='update_cache', action="store_false", help="Don't update cache directory after changes")
+    use_write_behind = app.cmd_arg('-w', '--write-behind', dest='write_behind', action="store_true", default=None,
+                                   help="Journal changes and apply them to the cache directory straight away, to be sent to the server by flush")
+    no_write_behind = app.cmd_arg('--no-write-behind', dest='write_behind', action="store_false", help="Send changes to the server straight away")
+    @no_write_behind
+    @use_write_behind
     @no_use_cache
     @use_cache
-    def g(update_cache=None, **kwargs):
-        retval = f(**kwargs)
+    def g(update_cache=None, write_behind=None, **kwargs):
+        del written_tasks[:]
+        if start_write_behind(write_behind):
+            try:
+                return f(**kwargs)
+            finally:
+                stop_write_behind()
+        try:
+            retval = f(**kwargs)
+        except Exception:
+            write_failed()
+            raise
+        for listener in write_listeners:
+            listener()
         do_cache_update(update_cache)
         return retval
     g.__name__ = f.__name__
     return g
 
+# functions called after each command that writes to the server; the daemon uses this to sync its tasks straight away
+write_listeners = []
+
+# functions called when a command that writes to the server fails, or some of its writes do, so that tasks it changed in memory
+# may differ from the server's; the daemon uses this to load its tasks afresh
+write_failure_listeners = []
+
+def write_failed():
+    for listener in write_failure_listeners:
+        listener()
+
 PROCESS_FLAGS = {'creationflags': 0x08} if sys.platform == 'win32' else {}
 
+# the tasks written to the server by the current command, as (task, deleted), to be written through to the cache store
+written_tasks = []
+
+# the WriteBehind of the current command if it is in write-behind mode, which journals its writes rather than sending them to the server
+_write_behind = None
+
+def start_write_behind(enabled=None):
+    """puts the current command in write-behind mode if enabled (by default, if the cache is configured to), returning whether it is"""
+    global _write_behind
+    enabled = write_behind_default if enabled is None else enabled
+    if not enabled:
+        return False
+    if cache_dir is None:
+        raise ValueError("Attempt to use write-behind but cache.dir is not defined in config")
+    _write_behind = journal.WriteBehind(journal.Journal(cache.journal_filename(cache_dir)),
+                                        cache.open_store(cache_dir, parse_workers, parse_threshold), cache_dir)
+    return True
+
+def stop_write_behind():
+    global _write_behind
+    _write_behind.close()
+    _write_behind = None
+
+def save_task(task):
+    """saves the task to the server, noting it to be written through to the cache store; in write-behind mode it is journaled instead"""
+    if _write_behind is not None:
+        writer = _write_behind.writer()
+        writer.save(task)
+        writer.run()
+        return
+    task.save()
+    written_tasks.append((task, False))
+
+def run_writes(writer):
+    """sends the writes queued on a BatchWriter, noting the tasks written to be written through to the cache store, and returns the results"""
+    results = writer.run()
+    written_tasks.extend((result.task, result.method == "DELETE") for result in results if result.ok)
+    if not all(result.ok for result in results):
+        write_failed()
+    return results
+
 def do_cache_update(update_cache=None):
-    update_cache = (cache_default and cache_update is not None) if update_cache is None else update_cache
+    """writes the tasks written by the command through to the cache store, so that it's up to date without syncing,
+    and then starts the cache.update program if one is configured"""
+    update_cache = cache_default if update_cache is None else update_cache
     if not update_cache:
         return
-    subprocess.Popen([cache_update], **PROCESS_FLAGS)
-    return
+    if cache_dir is None:
+        raise ValueError("Attempt to update cache but cache.dir is not defined in config")
+    if written_tasks:
+        task_store = cache.open_store(cache_dir)
+        try:
+            for task, deleted in written_tasks:
+                if deleted:
+                    task_store.record_deleted(task, cache_dir)
+                else:
+                    task_store.record_saved(task, cache_dir)
+        finally:
+            task_store.close()
+    if cache_update is not None:
+        import subprocess
+        subprocess.Popen([cache_update], **PROCESS_FLAGS)
 
 def setup_color(enabled):
     """Enables or disables color output"""
@@ -72,8 +210,27 @@ PRIORITY_COLOR_MAP = {
         Priority.W: colorama.Style.BRIGHT, # Waiting
     }
     
-def output_task(task_lookup, task):
-    print PRIORITY_COLOR_MAP.get(task.priority, "") + task_lookup.shortest(task.id), task.format() + colorama.Style.RESET_ALL
+def output_task(task_lookup, task, short_ids=None):
+    """prints the task with its shortest unique id; short_ids can be precomputed from task_lookup.shortest_all() when printing many tasks"""
+    print task_line(task_lookup, task, short_ids)
+
+def task_line(task_lookup, task, short_ids=None):
+    """returns the line output_task prints for the task"""
+    task_short_id = short_ids.get(task.id) if short_ids is not None else None
+    return format_task_line(task_short_id or task_lookup.shortest(task.id), task)
+
+def print_task(task_id, task):
+    """prints the task with the given id"""
+    print format_task_line(task_id, task)
+
+def format_task_line(task_id, task):
+    """returns the line print_task prints for the task with the given id"""
+    return PRIORITY_COLOR_MAP.get(task.priority, "") + task_id + " " + task.format() + colorama.Style.RESET_ALL
+
+def write_lines(lines):
+    """prints the lines with a single write, rather than a print for each"""
+    if lines:
+        sys.stdout.write("\n".join(lines) + "\n")
 
 def alias(name, alias_name):
     """Adds an alias to the given command name"""
@@ -81,140 +238,279 @@ def alias(name, alias_name):
     parser_map = app._parser._subparsers._group_actions[0]._name_parser_map
     parser_map[alias_name] = parser_map[name]
 
-STATUS_KEY = {"NEEDS-ACTION": 0, "IN-PROCESS": 1, "COMPLETED": 2, "CANCELLED": 3}
+def task_sort_key(task):
+    """returns the key to sort a task by priority, then status, then summary, which is kept in its record"""
+    return task.sort_key
 
+@timings.timed("sort")
 def sorted_tasks(task_lookup):
     """returns the given tasks sorted by priority, then status, then summary"""
-    return sorted(task_lookup, key=lambda t: (task_lookup[t].priority, STATUS_KEY.get(task_lookup[t].status.upper(), task_lookup[t].status), task_lookup[t].summary))
-
-def get_tasks(calendar_name, use_cache=None):
-    """gets a calendar and tasks, and returns the tuple of both of them. Loads tasks from cache if necessary"""
-    from_cache = cache_default if use_cache is None else use_cache
+    return sorted(task_lookup, key=lambda t: task_lookup[t].sort_key)
+
+def first_tasks(tasks, limit=None, key=task_sort_key):
+    """returns the tasks sorted by key (by default priority, then status, then summary), or if limit is given only the first limit of them,
+    which are selected with a heap of at most limit tasks rather than by sorting them all"""
+    with timings.phase("sort"):
+        if limit is None:
+            return sorted(tasks, key=key)
+        return heapq.nsmallest(limit, tasks, key=key)
+
+def get_calendar(calendar_name, use_cache=None, sync=None):
+    """returns the calendar to read tasks from: the cache store if necessary (syncing it first if requested), or else the server calendar"""
+    sync = sync_default if sync is None else sync
+    from_cache = sync or (cache_default if use_cache is None else use_cache)
     if from_cache:
         if cache_dir is None:
             raise ValueError("Attempt to use cache but cache.dir is not defined in config")
-        calendar = TaskList(client)
-        if calendar._tasks is None:
-            calendar._tasks = short_id.prefix_dict()
-        tasks = calendar._tasks
-        for filename in os.listdir(cache_dir):
-            if filename.endswith(".ics"):
-                with open(os.path.join(cache_dir, filename)) as f:
-                    t = Task(client, url=None, data=f.read(), parent=calendar, etag=None)
-                    task_id = t.id or (filename.replace(".ics", ""))
-                    tasks[task_id] = t
+        task_store = cache.open_store(cache_dir, parse_workers, parse_threshold)
+        if sync:
+            task_store.sync(get_client().get_calendar(calendar_name))
+        return task_store
+    return get_client().get_calendar(calendar_name)
+
+def get_tasks(calendar_name, use_cache=None, sync=None):
+    """gets a calendar and tasks, and returns the tuple of both of them. Loads tasks from the cache store if necessary, syncing it first if requested"""
+    calendar = get_calendar(calendar_name, use_cache, sync)
+    return calendar, calendar.get_tasks()
+
+def query_tasks(calendar_name, use_cache=None, sync=None, incomplete=False, priorities=None, terms=(), limit=None):
+    """returns a lookup of all task ids (for working out short ids), and the tasks sorted by priority, then status, then summary;
+    optionally only incomplete ones, those with the given priorities, or those matching all the given lowercase search terms,
+    and only the first limit of them if limit is given.
+    The cache store answers this with an indexed query, and the server with a filtered report, unless its tasks are already loaded,
+    in which case their search index is used"""
+    calendar = get_calendar(calendar_name, use_cache, sync)
+    if isinstance(calendar, store.TaskStore):
+        return calendar.get_tasks(), calendar.query(incomplete, priorities, terms, limit)
+    return query_calendar(calendar, incomplete, priorities, terms, limit)
+
+def query_calendar(calendar, incomplete=False, priorities=None, terms=(), limit=None):
+    """answers query_tasks for a calendar on the server"""
+    from taskdav.task import Task, TaskFilter
+    task_filter = TaskFilter(incomplete=incomplete, priorities=priorities)
+    if not task_filter or calendar.tasks_loaded():
+        task_lookup = calendar.get_tasks()
+        matched = calendar.get_index().search(terms) if terms else task_lookup
+        task_ids = [task_id for task_id in matched if task_filter.matches(task_lookup[task_id])]
+        task_ids = first_tasks(task_ids, limit, key=lambda task_id: task_lookup[task_id].sort_key)
+        return task_lookup, [calendar.get_task(task_id) for task_id in task_ids]
+    if limit is not None and not terms:
+        tasks = calendar.top(limit, task_filter)
     else:
-        calendar = client.get_calendar(calendar_name)
-        tasks = calendar.get_tasks()
-    return calendar, tasks
+        tasks = calendar.tasks(task_filter, props=Task.LIST_PROPS)
+    for task in tasks:
+        task.id = task.id or task.todo_getattr("uid", None)
+    tasks = [task for task in tasks if matches_terms(task.id, task.summary, terms)]
+    return calendar.get_id_lookup(), first_tasks(tasks, limit)
+
+def query_all_calendars(incomplete=False, priorities=None, terms=(), limit=None):
+    """queries every calendar on the server concurrently as query_tasks does, returning a list of (qualified short id, task)
+    sorted by priority, then status, then summary across all of them, or only the first limit of them;
+    a qualified id is the calendar name and short id, as in Work:3f"""
+    results = get_client().map_calendars(lambda calendar: query_calendar(calendar, incomplete, priorities, terms, limit))
+    listed = []
+    for calendar_name in sorted(results):
+        task_lookup, tasks = results[calendar_name]
+        with timings.phase("short ids"):
+            short_ids = task_lookup.shortest_all() if limit is None else {}
+            listed.extend(("%s:%s" % (calendar_name, short_ids.get(task.id) or task_lookup.shortest(task.id)), task) for task in tasks)
+    return first_tasks(listed, limit, key=lambda (task_id, task): task_sort_key(task))
+
+def find_task(calendar_name, task_id, load=True):
+    """returns the calendar and task with the given id in the named calendar, or in another calendar if the id is qualified with its name;
+    the task is loaded unless load is False"""
+    qualifier, sep, qualified_id = task_id.rpartition(":")
+    # in write-behind mode, tasks are only found in the calendar kept in the cache store
+    if qualifier and _write_behind is None:
+        try:
+            get_client().get_calendar(qualifier)
+        except KeyError:
+            pass
+        else:
+            calendar_name, task_id = qualifier, qualified_id
+    calendar = get_write_calendar(calendar_name)
+    return calendar, calendar.get_task(task_id, load)
+
+def find_tasks(calendar_name, task_ids):
+    """returns the calendar and task for each of the given ids as find_task does, loading the tasks that were only listed
+    in full with one request for each calendar, so that they can be changed"""
+    found = [find_task(calendar_name, task_id, load=False) for task_id in task_ids]
+    partial = {}
+    for calendar, task in found:
+        if task.data is None or task.partial:
+            partial.setdefault(calendar, []).append(task)
+    for calendar, tasks in partial.items():
+        calendar.load_many(tasks)
+    return found
+
+def output_matching(calendar_name, term, use_cache, sync, all_calendars, incomplete=False, priorities=None, limit=None):
+    """prints the tasks from query_tasks that match the search terms, or from every calendar with qualified ids if all_calendars is set;
+    only the first limit of them if limit is given"""
+    term = [t.lower() for t in term]
+    if all_calendars:
+        if use_cache or sync:
+            raise ValueError("--all-calendars reads from the server, and can't be used with the cache")
+        listed = query_all_calendars(incomplete, priorities, term, limit)
+        with timings.phase("output"):
+            write_lines([format_task_line(task_id, task) for task_id, task in listed])
+        return
+    task_lookup, tasks = query_tasks(calendar_name, use_cache, sync, incomplete, priorities, term, limit)
+    with timings.phase("short ids"):
+        # working out the short id of a few tasks on their own is quicker than working them all out
+        short_ids = task_lookup.shortest_all() if limit is None else None
+    with timings.phase("output"):
+        write_lines([task_line(task_lookup, task, short_ids) for task in tasks])
+
+def all_calendars_arg(f):
+    """decorator that adds the argument to list tasks from all calendars to a cmd which lists tasks"""
+    return app.cmd_arg('-a', '--all-calendars', dest='all_calendars', action="store_true", default=False,
+                       help="List tasks from all calendars, with ids qualified by calendar name")(f)
+
+def limit_arg(f):
+    """decorator that adds the argument to list only the first tasks to a cmd which lists tasks"""
+    return app.cmd_arg('-l', '--limit', dest='limit', type=int, default=None, help="Only list the first LIMIT tasks")(f)
 
 @app.cmd(name="list", help="Displays all incomplete tasks containing the given search terms (if any) either as ID prefix or summary text; a term like test- ending with a - is a negative search")
 @app.cmd_arg('term', type=str, nargs='*', help="Search terms")
+@all_calendars_arg
+@limit_arg
 @cache_args
-def list_(calendar_name, term, color, use_cache):
+def list_(calendar_name, term, color, use_cache, sync, all_calendars, limit):
     setup_color(color)
-    calendar, task_lookup = get_tasks(calendar_name, use_cache)
-    # TODO: make lookup by known ID not have to load all tasks
-    term = [t.lower() for t in term]
-    for task_id in sorted_tasks(task_lookup):
-        task = calendar.get_task(task_id)
-        if task.status != "COMPLETED":
-            search_text = task.summary.lower()
-            if all(task.id.startswith(t) or (t[:-1] not in search_text if t.endswith('-') else t in search_text) for t in term):
-                output_task(task_lookup, task)
+    output_matching(calendar_name, term, use_cache, sync, all_calendars, incomplete=True, limit=limit)
 
 alias("list", "ls")
 
 @app.cmd(help="Displays all tasks containing the given search terms (if any) either as ID prefix or summary text; a term like test- ending with a - is a negative search")
 @app.cmd_arg('term', type=str, nargs='*', help="Search terms")
+@all_calendars_arg
+@limit_arg
 @cache_args
-def listall(calendar_name, term, color, use_cache):
+def listall(calendar_name, term, color, use_cache, sync, all_calendars, limit):
     setup_color(color)
-    calendar, task_lookup = get_tasks(calendar_name, use_cache)
-    # TODO: make lookup by known ID not have to load all tasks
-    term = [t.lower() for t in term]
-    for task_id in sorted_tasks(task_lookup):
-        task = calendar.get_task(task_id)
-        search_text = task.summary.lower()
-        if all(task.id.startswith(t) or (t[:-1] not in search_text if t.endswith('-') else t in search_text) for t in term):
-            output_task(task_lookup, task)
+    output_matching(calendar_name, term, use_cache, sync, all_calendars, limit=limit)
 
 alias("listall", "lsa")
 
-@app.cmd(help="Reports on the number of open and done tasks")
+def task_columns(calendar):
+    """returns a TaskColumns of the tasks in the calendar or TaskStore, built from the tasks as they are listed"""
+    if isinstance(calendar, store.TaskStore):
+        return calendar.columns()
+    return TaskColumns.from_tasks(calendar.get_tasks().values())
+
+def snapshot_url(calendar):
+    """returns the url of the calendar that report files the snapshots of a calendar or TaskStore under:
+    for the store, that of the calendar it is synced with, or None if it has never been synced"""
+    if isinstance(calendar, store.TaskStore):
+        return calendar.synced_url()
+    return calendar.canonical_url
+
+@app.cmd(help="Reports on the number of tasks with each status, or in each group of the given dimensions; if cache.dir is defined in config, the counts by status and priority are recorded each time, and --history shows the open and done tasks in each of these snapshots")
+@app.cmd_arg('-b', '--by', type=str, default="status", help="Comma-separated dimensions to group by, from %s (default: status)" % ", ".join(DIMENSIONS))
+@app.cmd_arg('--history', action='store_true', default=False, help="Show the number of open and done tasks at each earlier report instead")
 @cache_args
-def report(calendar_name, color, use_cache):
+def report(calendar_name, by, history, color, use_cache, sync):
     setup_color(color)
-    date = datetime.utcnow().replace(tzinfo=utc)
-    calendar, task_lookup = get_tasks(calendar_name, use_cache)
-    task_status_count = {}
-    for task_id in task_lookup:
-        task = calendar.get_task(task_id)
-        status = task.status
-        task_status_count[status] = task_status_count.get(status, 0) + 1
+    from dateutil.tz import tzutc
+    snapshots = SnapshotLog(cache.snapshots_filename(cache_dir)) if cache_dir is not None else None
+    if history:
+        if snapshots is None:
+            raise ValueError("Attempt to show report history but cache.dir is not defined in config")
+        for when, status_counts in snapshots.history(snapshot_url(get_calendar(calendar_name, use_cache))):
+            done = status_counts.get("COMPLETED", 0)
+            print datetime.fromtimestamp(when, tzutc()), "open", sum(status_counts.values()) - done, "done", done
+        return
+    dimensions = parse_dimensions(by)
+    date = datetime.utcnow().replace(tzinfo=tzutc())
+    calendar = get_calendar(calendar_name, use_cache, sync)
+    columns = task_columns(calendar)
+    url = snapshot_url(calendar) if snapshots is not None else None
+    if url is not None:
+        snapshots.record(url, columns)
+    counts = columns.counts(dimensions)
     print date
-    for status in sorted(task_status_count):
-        print status, task_status_count[status]
+    for key in sorted(counts):
+        print " ".join(key), counts[key]
 
 @app.cmd(help="Displays all incomplete tasks of the given (or any) priority containing the given search terms (if any) either as ID prefix or summary text; a term like test- ending with a - is a negative search")
 @app.cmd_arg('priority', type=str, nargs='?', help="Priority")
 @app.cmd_arg('term', type=str, nargs='*', help="Search terms")
+@all_calendars_arg
+@limit_arg
 @cache_args
-def listpri(calendar_name, priority, term, color, use_cache):
+def listpri(calendar_name, priority, term, color, use_cache, sync, all_calendars, limit):
     setup_color(color)
     try:
-        priorities = Task.parse_priority_range(priority)
+        priorities = parse_priority_range(priority)
     except ValueError:
         # Assume this wasn't really a priority
         term.insert(0, priority)
         priorities = Priority.__named__
-    calendar, task_lookup = get_tasks(calendar_name, use_cache)
-    term = [t.lower() for t in term]
-    for task_id in sorted_tasks(task_lookup):
-        task = calendar.get_task(task_id)
-        if task.status != "COMPLETED" and task.priority in priorities:
-            search_text = task.summary.lower()
-            if all(task.id.startswith(t) or (t[:-1] not in search_text if t.endswith('-') else t in search_text) for t in term):
-                output_task(task_lookup, task)
+    output_matching(calendar_name, term, use_cache, sync, all_calendars, incomplete=True, priorities=priorities, limit=limit)
 
 alias("listpri", "lsp")
 
-CONTEXT_RE = re.compile(r'(?:^|\s)(@\w*\b)')
+def incomplete_tags(calendar, tag_re, kind):
+    """returns the sorted distinct tags matching tag_re in incomplete task summaries; a TaskStore, or a calendar whose tasks are loaded,
+    looks these up by kind from its tag index"""
+    if isinstance(calendar, store.TaskStore):
+        return calendar.tags(kind)
+    if calendar.tasks_loaded():
+        return calendar.get_index().tags(kind)
+    from taskdav.task import Task, TaskFilter
+    tags = set()
+    for task in calendar.tasks(TaskFilter(incomplete=True), props=Task.LIST_PROPS):
+        tags.update(tag_re.findall(task.summary))
+    return sorted(tags)
 
 @app.cmd(help="Lists all the task contexts that start with the @ sign in task summaries")
 @cache_args
-def listcon(calendar_name, color, use_cache):
+def listcon(calendar_name, color, use_cache, sync):
     setup_color(color)
-    calendar, task_lookup = get_tasks(calendar_name, use_cache)
-    contexts = set()
-    for task_id in task_lookup:
-        task = calendar.get_task(task_id)
-        if task.status != "COMPLETED":
-            contexts.update(CONTEXT_RE.findall(task.summary))
-    for context in sorted(contexts):
+    calendar = get_calendar(calendar_name, use_cache, sync)
+    for context in incomplete_tags(calendar, CONTEXT_RE, store.CONTEXT):
         print context
 
 alias("listcon", "lsc")
 
-PROJ_RE = re.compile(r'(?:^|\s)(\+\w*\b)')
-
 @app.cmd(help="Lists all the task projects that start with the + sign in task summaries")
 @cache_args
-def listproj(calendar_name, color, use_cache):
+def listproj(calendar_name, color, use_cache, sync):
     setup_color(color)
-    calendar, task_lookup = get_tasks(calendar_name, use_cache)
-    projects = set()
-    for task_id in task_lookup:
-        task = calendar.get_task(task_id)
-        if task.status != "COMPLETED":
-            projects.update(PROJ_RE.findall(task.summary))
-    for project in sorted(projects):
+    calendar = get_calendar(calendar_name, use_cache, sync)
+    for project in incomplete_tags(calendar, PROJ_RE, store.PROJECT):
         print project
 
 alias("listproj", "lsprj")
 
 PRIORITY_PREFIX_RE = re.compile('^[(]([A-FHWa-fhw])[)]\s+')
 
+def new_task(calendar, text, priority=None):
+    """constructs a new task in the calendar from the given text, taking its priority from a prefix like (A) if priority is not given"""
+    from taskdav.task import Task
+    if priority is not None:
+        priority = Priority(priority.upper())
+    else:
+        prefix_match = PRIORITY_PREFIX_RE.match(text)
+        if prefix_match:
+            priority, text = parse_priority(prefix_match.group(1)), text[prefix_match.end():]
+    task = Task.new_task(get_client(), parent=calendar, summary=text)
+    if priority is not None:
+        task.priority = priority
+    return task
+
+def output_writes(results, done_message=None, task_lookup=None):
+    """prints each task written by a BatchWriter, followed by done_message if given, or the conflict or error that stopped the write;
+    short ids are worked out from task_lookup if given, or else from the ids in each task's calendar"""
+    for result in results:
+        output_task(task_lookup if task_lookup is not None else result.task.parent.get_id_lookup(), result.task)
+        if result.conflict:
+            print colorama.Fore.RED + "not written: changed on the server since it was loaded" + colorama.Style.RESET_ALL
+        elif not result.ok:
+            print colorama.Fore.RED + "error: %s" % result + colorama.Style.RESET_ALL
+        elif done_message:
+            print colorama.Fore.RED + done_message + colorama.Style.RESET_ALL
+
 @app.cmd
 @app.cmd_arg('text', type=str, nargs='+', help="The description of the task")
 @app.cmd_arg('-p', '--priority', action='store', dest='priority', default=None, help="Set priority of new task")
@@ -222,25 +518,15 @@ PRIORITY_PREFIX_RE = re.compile('^[(]([A-FHWa-fhw])[)]\s+')
 def add(calendar_name, text, priority, color):
     setup_color(color)
     text = " ".join(text)
-    if priority is not None:
-        priority = Priority(priority.upper())
-    else:
-        prefix_match = PRIORITY_PREFIX_RE.match(text)
-        if prefix_match:
-            priority, text = Task.parse_priority(prefix_match.group(1)), text[prefix_match.end():]
-        else:
-            priority = None
-    calendar = client.get_calendar(calendar_name)
+    calendar = get_write_calendar(calendar_name)
     try:
-        task = Task.new_task(client, parent=calendar, summary=text)
-        if priority is not None:
-            task.priority = priority
-        task.save()
+        task = new_task(calendar, text, priority)
+        save_task(task)
     except Exception, e:
         print "Error saving event: %r" % e
         return
-    task_lookup = calendar.get_tasks()
-    task_lookup[task.id] = task
+    task_lookup = calendar.get_id_lookup()
+    calendar.added(task)
     output_task(task_lookup, task)
 
 alias("add", "a")
@@ -251,8 +537,17 @@ alias("add", "a")
 def addm(calendar_name, tasks, color):
     setup_color(color)
     tasks = [task.strip() for task in " ".join(tasks).split("\n") if task.strip()]
-    for task in tasks:
-        add(calendar_name, [task], None, color)
+    calendar = get_write_calendar(calendar_name)
+    writer = get_writer()
+    for text in tasks:
+        writer.save(new_task(calendar, text))
+    results = run_writes(writer)
+    # the id lookup is found first, so that the new tasks are recorded in it even if it was listed before they were added
+    calendar.get_id_lookup()
+    for result in results:
+        if result.ok:
+            calendar.added(result.task)
+    output_writes(results)
 
 @app.cmd
 @app.cmd_arg('task_id', type=str, help="ID of the task to amend")
@@ -261,12 +556,10 @@ def addm(calendar_name, tasks, color):
 def replace(calendar_name, task_id, text, color):
     setup_color(color)
     text = " ".join(text)
-    calendar = client.get_calendar(calendar_name)
-    task = calendar.get_task(task_id)
+    calendar, task = find_task(calendar_name, task_id)
     task.summary = text
-    task.save()
-    task_lookup = calendar.get_tasks()
-    output_task(task_lookup, task)
+    save_task(task)
+    output_task(calendar.get_id_lookup(), task)
 
 @app.cmd
 @app.cmd_arg('task_id', type=str, help="ID of the task to amend")
@@ -275,12 +568,10 @@ def replace(calendar_name, task_id, text, color):
 def append(calendar_name, task_id, text, color):
     setup_color(color)
     text = " ".join(text)
-    calendar = client.get_calendar(calendar_name)
-    task = calendar.get_task(task_id)
+    calendar, task = find_task(calendar_name, task_id)
     task.summary = task.summary.rstrip(" ") + " " + text
-    task.save()
-    task_lookup = calendar.get_tasks()
-    output_task(task_lookup, task)
+    save_task(task)
+    output_task(calendar.get_id_lookup(), task)
 
 alias("append", "app")
 
@@ -291,12 +582,10 @@ alias("append", "app")
 def prepend(calendar_name, task_id, text, color):
     setup_color(color)
     text = " ".join(text)
-    calendar = client.get_calendar(calendar_name)
-    task = calendar.get_task(task_id)
+    calendar, task = find_task(calendar_name, task_id)
     task.summary = text + " " + task.summary.lstrip(" ")
-    task.save()
-    task_lookup = calendar.get_tasks()
-    output_task(task_lookup, task)
+    save_task(task)
+    output_task(calendar.get_id_lookup(), task)
 
 alias("prepend", "prep")
 
@@ -306,19 +595,17 @@ alias("prepend", "prep")
 @cache_update_args
 def rm(calendar_name, task_id, prompt, color):
     setup_color(color)
-    calendar = client.get_calendar(calendar_name)
-    task_lookup = calendar.get_tasks()
-    for tid in task_id:
-        task = calendar.get_task(tid)
-        output_task(task_lookup, task)
+    writer = get_writer()
+    for calendar, task in find_tasks(calendar_name, task_id):
         answer = "y"
         if prompt:
+            output_task(calendar.get_id_lookup(), task)
             answer = ""
             while answer not in {"y", "n"}:
                 answer = raw_input("delete (y/n)").lower()
         if answer == "y":
-            task.delete()
-            print colorama.Fore.RED + "deleted" + colorama.Style.RESET_ALL
+            writer.delete(task)
+    output_writes(run_writes(writer), "deleted")
 
 alias("rm", "del")
 
@@ -328,12 +615,10 @@ alias("rm", "del")
 @cache_update_args
 def pri(calendar_name, task_id, priority, color):
     setup_color(color)
-    calendar = client.get_calendar(calendar_name)
-    task = calendar.get_task(task_id)
+    calendar, task = find_task(calendar_name, task_id)
     task.priority = task.parse_priority(priority)
-    task.save()
-    task_lookup = calendar.get_tasks()
-    output_task(task_lookup, task)
+    save_task(task)
+    output_task(calendar.get_id_lookup(), task)
 
 alias("pri", "p")
 
@@ -342,13 +627,11 @@ alias("pri", "p")
 @cache_update_args
 def depri(calendar_name, task_ids, color):
     setup_color(color)
-    calendar = client.get_calendar(calendar_name)
-    task_lookup = calendar.get_tasks()
-    for task_id in task_ids:
-        task = calendar.get_task(task_id)
+    writer = get_writer()
+    for calendar, task in find_tasks(calendar_name, task_ids):
         task.priority = Priority.unspecified
-        task.save()
-        output_task(task_lookup, task)
+        writer.save(task)
+    output_writes(run_writes(writer))
 
 alias("depri", "dp")
 
@@ -357,16 +640,104 @@ alias("depri", "dp")
 @cache_update_args
 def do(calendar_name, task_ids, color):
     setup_color(color)
-    calendar = client.get_calendar(calendar_name)
-    task_lookup = calendar.get_tasks()
-    for task_id in task_ids:
-        task = calendar.get_task(task_id)
+    writer = get_writer()
+    for calendar, task in find_tasks(calendar_name, task_ids):
         task.status = "COMPLETED"
         task.todo_setattr("percent_complete", "100")
-        task.save()
-        output_task(task_lookup, task)
-
-if __name__ == "__main__":
-    app.run()
+        writer.save(task)
+    output_writes(run_writes(writer))
 
+@app.cmd(help="Sends the changes journaled in write-behind mode to the server in batches, combining all the changes to each task into one write; a change to a task that has since been changed on the server is reported as a conflict, and kept in the journal unless --conflicts says otherwise")
+@app.cmd_arg('--conflicts', choices=("keep", "overwrite", "discard"), default="keep",
+             help="What to do with conflicting changes: keep them in the journal (the default), overwrite the server's changes with them, or discard them")
+def flush(calendar_name, color, conflicts):
+    setup_color(color)
+    if cache_dir is None:
+        raise ValueError("Attempt to flush the write-behind journal but cache.dir is not defined in config")
+    pending_journal = journal.Journal(cache.journal_filename(cache_dir))
+    entries, offset = pending_journal.read()
+    pending = journal.compact(entries)
+    if not pending:
+        if entries:
+            pending_journal.replace([], offset)
+        return
+    task_store = cache.open_store(cache_dir, parse_workers, parse_threshold)
+    try:
+        task_lookup = task_store.get_tasks()
+        kept, sent = [], 0
+        for batch, results in journal.replay(pending, get_client(), flush_batch_size, write_workers, overwrite=conflicts == "overwrite"):
+            sent += len(batch)
+            for entry, result in zip(batch, results):
+                if result.ok and result.method == "DELETE":
+                    task_store.record_deleted(result.task, cache_dir)
+                elif result.ok:
+                    task_store.record_saved(result.task, cache_dir)
+                elif not (result.conflict and conflicts == "discard"):
+                    kept.append(entry)
+            # the journal is rewritten after each batch, so that nothing written is sent again if flushing is interrupted
+            offset = pending_journal.replace(kept + pending[sent:], offset)
+            output_writes(results, task_lookup=task_lookup)
+    finally:
+        task_store.close()
+    for listener in write_listeners:
+        listener()
+    unsent = len(kept) + len(pending) - sent
+    if unsent:
+        print colorama.Fore.RED + "%d change%s kept in the journal" % (unsent, "" if unsent == 1 else "s") + colorama.Style.RESET_ALL
+
+def run_options(args):
+    """
+    Takes the --timings and --profile FILE options out of the command line args, only where they come before the command name
+    and only as spelt in full, so that the same words in the text of a task are left alone.
+
+    Returns:
+     * (whether to show timings, the file to save the profile in or None, the rest of the args)
+    """
+    show_timings = bool(os.environ.get(TIMINGS_ENV))
+    profile = None
+    global_options = app._parser._option_string_actions
+    rest = []
+    n = 0
+    while n < len(args) and args[n].startswith("-"):
+        arg = args[n]
+        if arg == "--timings":
+            show_timings = True
+        elif arg == "--profile" and n + 1 < len(args):
+            n += 1
+            profile = args[n]
+        elif arg.startswith("--profile="):
+            profile = arg[len("--profile="):]
+        elif arg in global_options and global_options[arg].nargs != 0 and n + 1 < len(args):
+            # a global option's value may not start with -, and isn't the command name
+            rest += args[n:n + 2]
+            n += 1
+        else:
+            rest.append(arg)
+        n += 1
+    return show_timings, profile, rest + args[n:]
+
+def run(args=None):
+    """
+    Runs the command given by the command line args (by default sys.argv) as app.run() does. With --timings, or the TASKDAV_TIMINGS
+    environment variable set, the time spent in each phase and the requests sent are printed to standard error afterwards;
+    with --profile FILE, the command is profiled with cProfile and the stats saved to FILE.
+    """
+    show_timings, profile, args = run_options(sys.argv[1:] if args is None else args)
+    if show_timings:
+        timings.start()
+    try:
+        if profile:
+            import cProfile
+            profiler = cProfile.Profile()
+            try:
+                return profiler.runcall(app.run, args)
+            finally:
+                profiler.dump_stats(profile)
+        return app.run(args)
+    finally:
+        recorder = timings.stop()
+        if recorder is not None:
+            recorder.report(sys.stderr)
 
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,56 @@
+#!/usr/bin/env python
+
+import os
+import shutil
+import tempfile
+import aggregate
+from helpers import raises
+from test_store import make_task, make_store
+
+def make_tasks():
+    return [make_task("walk the dog @home", "B", uid="a1"),
+            make_task("buy milk @shop @home +food", uid="a2"),
+            make_task("eat cake +food", "A", "COMPLETED", uid="b1"),
+            make_task("pay bills @home +money", "A", "IN-PROCESS", uid="b2"),
+            make_task("sleep", "A", "COMPLETED", uid="c1")]
+
+def test_counts():
+    columns = aggregate.TaskColumns.from_tasks(make_tasks())
+    assert len(columns) == 5
+    assert columns.counts(["status"]) == {("NEEDS-ACTION",): 2, ("IN-PROCESS",): 1, ("COMPLETED",): 2}
+    assert columns.counts(["priority", "status"]) == {("B", "NEEDS-ACTION"): 1, ("unspecified", "NEEDS-ACTION"): 1,
+                                                      ("A", "COMPLETED"): 2, ("A", "IN-PROCESS"): 1}
+    # a task is counted once for each of its tags
+    assert columns.counts(["context"]) == {("@home",): 3, ("@shop",): 1, ("-",): 2}
+    assert columns.counts(["status", "project", "context"]) == {
+        ("NEEDS-ACTION", "-", "@home"): 1, ("NEEDS-ACTION", "+food", "@home"): 1, ("NEEDS-ACTION", "+food", "@shop"): 1,
+        ("COMPLETED", "+food", "-"): 1, ("IN-PROCESS", "+money", "@home"): 1, ("COMPLETED", "-", "-"): 1}
+
+def test_store_columns():
+    tasks = make_tasks()
+    for dimensions in (["status"], ["priority", "project"], ["context", "status"]):
+        assert make_store(*tasks).columns().counts(dimensions) == aggregate.TaskColumns.from_tasks(tasks).counts(dimensions)
+
+def test_parse_dimensions():
+    assert aggregate.parse_dimensions("status, Priority,project") == ["status", "priority", "project"]
+    assert raises(ValueError, aggregate.parse_dimensions, "status,colour")
+
+TASKS_URL = "http://localhost/calendars/tasks/"
+
+def test_snapshots():
+    temp_dir = tempfile.mkdtemp()
+    try:
+        snapshots = aggregate.SnapshotLog(os.path.join(temp_dir, "store", "snapshots.jsonl"))
+        assert snapshots.history(TASKS_URL) == []
+        tasks = make_tasks()
+        snapshots.record(TASKS_URL, aggregate.TaskColumns.from_tasks(tasks[:2]), when=100)
+        snapshots.record("http://localhost/calendars/other/", aggregate.TaskColumns.from_tasks(tasks[:1]), when=150)
+        snapshots.record(TASKS_URL, aggregate.TaskColumns.from_tasks(tasks), when=200)
+        with open(snapshots.filename, "a") as f:
+            f.write('{"time": 300, "calen')
+        # a snapshot recorded after an interrupted write doesn't run into its unfinished line
+        snapshots.record(TASKS_URL, aggregate.TaskColumns.from_tasks(tasks[:1]), when=400)
+        assert snapshots.history(TASKS_URL) == [(100, {"NEEDS-ACTION": 2}), (200, {"NEEDS-ACTION": 2, "IN-PROCESS": 1, "COMPLETED": 2}),
+                                                (400, {"NEEDS-ACTION": 1})]
+    finally:
+        shutil.rmtree(temp_dir)
@@ -0,0 +1,63 @@
+#!/usr/bin/env python
+
+import threading
+import time
+import asyncdav
+from helpers import raises
+from task import SyncState, Task, TaskDAVClient, get_object_urlname
+from test_sync import make_server, add_task
+
+def test_executor():
+    with asyncdav.Executor(2) as executor:
+        running = []
+        release = threading.Event()
+        def call(n):
+            running.append(n)
+            release.wait(5)
+            return n * 10
+        futures = [executor.submit(call, n) for n in range(4)]
+        time.sleep(0.1)
+        # no more calls run at once than there are workers
+        assert len(running) == 2 and not any(future.done() for future in futures)
+        assert raises(asyncdav.TimeoutError, futures[0].result, 0.01)
+        release.set()
+        assert sorted(future.result() for future in asyncdav.as_completed(futures, 5)) == [0, 10, 20, 30]
+        failed = executor.submit(int, "x")
+        assert isinstance(failed.exception(5), ValueError)
+        assert raises(ValueError, failed.result)
+        done = []
+        failed.add_done_callback(done.append)
+        assert done == [failed]
+
+def test_async_client():
+    server, dav_calendar = make_server(2, latency=0.1)
+    dav_calendars = {name: server.add_calendar(name) for name in ("Work", "Home", "Garden")}
+    for name, calendar in dav_calendars.items():
+        add_task(calendar, "%s task" % name, uid=name.lower())
+    try:
+        with asyncdav.Executor(8) as executor:
+            client = asyncdav.AsyncTaskDAVClient(TaskDAVClient(server.url), executor)
+            assert sorted(client.load_calendars().result(5)) == ["Garden", "Home", "Tasks", "Work"]
+            server.most_in_flight = 0
+            found = dict(client.iter_tasks(timeout=5))
+            # one report for each calendar, all at once
+            assert server.most_in_flight == 4
+            assert sorted(found) == ["Garden", "Home", "Tasks", "Work"]
+            assert [task.summary for task in found["Work"]] == ["Work task"]
+            assert len(found["Tasks"]) == 2
+            task = client.get_task("Home", "h").result(5)
+            assert task.summary == "Home task"
+            assert isinstance(client.get_task("Home", "x").exception(5), KeyError)
+            # writes are conditional on the etag the task was loaded with
+            stale = client.get_task("Work", "work").result(5)
+            task.status = stale.status = "COMPLETED"
+            new_task = Task.new_task(client.client, client.client.get_calendar("Work"), "new task")
+            results = [future.result(5) for future in (client.save(task), client.save(new_task), client.delete(found["Work"][0]))]
+            assert all(result.ok for result in results)
+            assert "STATUS:COMPLETED" in dav_calendars["Home"].resources["home.ics"][1]
+            assert sorted(dav_calendars["Work"].resources) == [get_object_urlname(new_task)]
+            assert client.save(stale).result(5).conflict
+            changed, deleted = client.sync_changes("Work", SyncState()).result(5)
+            assert [changed_task.summary for changed_task in changed] == ["new task"] and deleted == []
+    finally:
+        server.stop()
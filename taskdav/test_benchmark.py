@@ -0,0 +1,36 @@
+#!/usr/bin/env python
+
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import benchmark
+from task import Task
+
+PACKAGE_PARENT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def test_synthetic_tasks():
+    tasks = list(benchmark.synthetic_tasks(200, seed=5))
+    assert tasks == list(benchmark.synthetic_tasks(200, seed=5))
+    assert len({uid for uid, data in tasks}) == 200
+    parsed = [Task(None, data=data) for uid, data in tasks]
+    assert {task.status for task in parsed} == {"NEEDS-ACTION", "IN-PROCESS", "COMPLETED"}
+    assert len({task.priority for task in parsed}) > 3
+    assert any("@" in task.summary for task in parsed) and any("+" in task.summary for task in parsed)
+
+def test_run():
+    temp_dir = tempfile.mkdtemp()
+    try:
+        filename = os.path.join(temp_dir, "results.json")
+        subprocess.check_call([sys.executable, "-m", "taskdav.benchmark", "--sizes", "20,30", "--repeat", "1", "--latency", "0",
+                               "--label", "test", "-o", filename], cwd=PACKAGE_PARENT)
+        with open(filename) as f:
+            results = json.load(f)
+        assert results["label"] == "test"
+        assert sorted((r["size"], r["benchmark"]) for r in results["results"]) == \
+            sorted((size, name) for size in (20, 30) for name in benchmark.Benchmarks.names())
+        assert all(len(r["times"]) == 1 and r["best"] == r["median"] > 0 for r in results["results"])
+    finally:
+        shutil.rmtree(temp_dir)
@@ -0,0 +1,144 @@
+#!/usr/bin/env python
+
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import cache
+from caldav.lib import error
+from helpers import raises
+from task import TaskDAVClient
+from test_sync import make_server, add_task
+
+def propfinds(server):
+    return [path for method, path, size in server.requests if method == "PROPFIND"]
+
+def check_calendar_cache(check):
+    server, dav_calendar = make_server(2)
+    temp_dir = tempfile.mkdtemp()
+    try:
+        filename = os.path.join(temp_dir, "calendars.json")
+        client = TaskDAVClient(server.url, calendar_cache=cache.CalendarCache(filename))
+        calendar = client.get_calendar("Tasks")
+        assert calendar.ctag == str(dav_calendar.ctag)
+        assert propfinds(server) == [server.principal_path]
+        del server.requests[:]
+        check(server, dav_calendar, filename)
+    finally:
+        server.stop()
+        shutil.rmtree(temp_dir)
+
+def test_fresh():
+    def check(server, dav_calendar, filename):
+        client = TaskDAVClient(server.url, calendar_cache=cache.CalendarCache(filename))
+        assert len(client.get_calendar("Tasks").get_tasks()) == 2
+        assert propfinds(server) == []
+    check_calendar_cache(check)
+
+def test_stale():
+    def check(server, dav_calendar, filename):
+        add_task(dav_calendar, "another task")
+        client = TaskDAVClient(server.url, calendar_cache=cache.CalendarCache(filename, ttl=0))
+        calendar = client.get_calendar("Tasks")
+        # only the calendar itself is checked
+        assert propfinds(server) == [dav_calendar.path]
+        assert calendar.ctag == str(dav_calendar.ctag)
+        assert cache.CalendarCache(filename).get(client.principal.canonical_url, "Tasks")[1] == calendar.ctag
+    check_calendar_cache(check)
+
+def in_thread(f, *args):
+    """calls f in a thread, failing rather than hanging if it doesn't finish within 10 seconds"""
+    failed = []
+    def call():
+        try:
+            f(*args)
+        except Exception:
+            failed.append(sys.exc_info())
+    thread = threading.Thread(target=call)
+    thread.daemon = True
+    thread.start()
+    thread.join(10)
+    assert not thread.is_alive()
+    if failed:
+        raise failed[0][0], failed[0][1], failed[0][2]
+
+def check_moved(pool_size=8):
+    def check(server, dav_calendar, filename):
+        old_path = dav_calendar.path
+        # calendars are named after the last part of their url, so keep that
+        dav_calendar.path = server.principal_path + "moved/Tasks/"
+        server.calendars[dav_calendar.path] = server.calendars.pop(old_path)
+        client = TaskDAVClient(server.url, pool_size=pool_size, calendar_cache=cache.CalendarCache(filename))
+        calendar = client.get_calendar("Tasks")
+        assert calendar.url.path == old_path
+        # the 404 from the old url leads to discovery, and the report is sent again to the new url
+        assert len(calendar.get_tasks()) == 2
+        assert calendar.url.path == dav_calendar.path
+        assert client.get_calendar("Tasks") is calendar
+        assert [method for method, path, size in server.requests] == ["REPORT", "PROPFIND", "REPORT"]
+        url, ctag, fresh = cache.CalendarCache(filename).get(client.principal.canonical_url, "Tasks")
+        assert url.endswith("/moved/Tasks/") and fresh
+    check_calendar_cache(check)
+
+def test_moved():
+    check_moved()
+
+def test_moved_single_connection():
+    # the connection the 404 arrived on has to be released before discovery can use it
+    in_thread(check_moved, 1)
+
+def check_removed(pool_size=8):
+    def check(server, dav_calendar, filename):
+        del server.calendars[dav_calendar.path]
+        client = TaskDAVClient(server.url, pool_size=pool_size, calendar_cache=cache.CalendarCache(filename))
+        calendar = client.get_calendar("Tasks")
+        assert raises(error.ReportError, calendar.get_tasks)
+        assert cache.CalendarCache(filename).get(client.principal.canonical_url, "Tasks") is None
+        assert raises(KeyError, TaskDAVClient(server.url, calendar_cache=cache.CalendarCache(filename)).get_calendar, "Tasks")
+    check_calendar_cache(check)
+
+def test_removed():
+    check_removed()
+
+def test_removed_single_connection():
+    in_thread(check_removed, 1)
+
+def test_id_cache():
+    server, dav_calendar = make_server(0)
+    for n in range(50):
+        add_task(dav_calendar, "task %d" % n, uid="a%02d" % n)
+    add_task(dav_calendar, "the only z task", uid="zz-top")
+    temp_dir = tempfile.mkdtemp()
+    def run_client():
+        client = TaskDAVClient(server.url, calendar_cache=cache.CalendarCache(os.path.join(temp_dir, "calendars.json")),
+                               id_cache=cache.IdCache(os.path.join(temp_dir, "ids.json")))
+        calendar = client.get_calendar("Tasks")
+        del server.requests[:]
+        return calendar
+    def methods():
+        return [method for method, path, size in server.requests]
+    try:
+        # the ids are listed once, and then kept
+        assert run_client().get_task("zz").summary == "the only z task"
+        assert methods() == ["PROPFIND", "GET"]
+        assert run_client().get_task("zz").id == "zz-top"
+        assert methods() == ["PROPFIND", "GET"]
+        assert cache.IdCache(os.path.join(temp_dir, "ids.json")).get(run_client().canonical_url)[0] == str(dav_calendar.ctag)
+        # a full id is fetched straight away
+        calendar = run_client()
+        assert calendar.get_task("a07").summary == "task 7"
+        assert methods() == ["GET"]
+        assert not calendar.tasks_loaded()
+        assert calendar.get_id_lookup().shortest("a07") == "a07"
+        # once the calendar changes, its ids are listed again
+        add_task(dav_calendar, "another task", uid="b00")
+        assert run_client().get_task("b").summary == "another task"
+        assert methods() == ["PROPFIND", "PROPFIND", "GET"]
+        # an id that is no longer there is looked for in the current ids
+        dav_calendar.delete("a07.ics")
+        assert raises(KeyError, run_client().get_task, "a07")
+        assert methods() == ["GET", "PROPFIND", "PROPFIND"]
+    finally:
+        server.stop()
+        shutil.rmtree(temp_dir)
@@ -0,0 +1,150 @@
+#!/usr/bin/env python
+
+import os
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+import daemon
+import davserver
+from test_sync import add_task
+
+PACKAGE_PARENT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def make_home(server):
+    """makes a home directory with a config for the given server, and a daemon socket within it"""
+    home = tempfile.mkdtemp()
+    host, port = server.httpd.server_address
+    socket_path = os.path.join(home, "daemon.sock")
+    with open(os.path.join(home, ".taskdav"), "w") as f:
+        f.write("[server]\nurl = http://%s:%d/\nusername = user\npassword = password\n[daemon]\nsocket = %s\n" % (host, port, socket_path))
+    return home, socket_path
+
+def start_daemon(home, socket_path):
+    process = subprocess.Popen([sys.executable, "-m", "taskdav.daemon", "--sync-interval", "1"], env=dict(os.environ, HOME=home), cwd=PACKAGE_PARENT)
+    for n in range(200):
+        if os.path.exists(socket_path):
+            return process
+        time.sleep(0.05)
+    process.kill()
+    raise AssertionError("daemon did not start")
+
+def tdtc(home, *args, **kwargs):
+    """runs tdtc with the given args, returning the lines it printed"""
+    process = subprocess.Popen([sys.executable, "-m", "taskdav.tdtc", "-m"] + list(args), env=dict(os.environ, HOME=home), cwd=PACKAGE_PARENT,
+                               stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+    output = process.communicate(kwargs.get("input", ""))[0]
+    assert process.returncode == 0
+    return output.splitlines()
+
+def test_daemon():
+    server = davserver.CalDAVServer().start()
+    calendar = server.add_calendar("Tasks")
+    for n in range(3):
+        add_task(calendar, "task %d" % n, uid="%d%d" % (n, n))
+    home, socket_path = make_home(server)
+    process = start_daemon(home, socket_path)
+    try:
+        del server.requests[:]
+        assert tdtc(home, "ls") == ["0 task 0", "1 task 1", "2 task 2"]
+        # answered from the tasks the daemon holds in memory
+        assert server.requests == []
+        assert daemon.forward(["-m", "ls", "task 1"], socket_path) == 0
+        assert server.requests == []
+        # changes made by commands are synced straight away
+        assert tdtc(home, "do", "1") == ["1 x task 1"]
+        assert tdtc(home, "ls") == ["0 task 0", "2 task 2"]
+        # and changes made elsewhere in the background
+        add_task(calendar, "task 3", uid="33")
+        for n in range(50):
+            if len(tdtc(home, "ls")) == 3:
+                break
+            time.sleep(0.1)
+        assert tdtc(home, "ls") == ["0 task 0", "2 task 2", "3 task 3"]
+        # a change that the server didn't accept is forgotten, whether the write's failure is reported or raised
+        server.fail_next("PUT", 500)
+        assert tdtc(home, "do", "2")[-1].startswith("error")
+        assert tdtc(home, "ls") == ["0 task 0", "2 task 2", "3 task 3"]
+        server.fail_next("PUT", 500)
+        assert daemon.forward(["-m", "pri", "3", "A"], socket_path) == 1
+        assert tdtc(home, "ls") == ["0 task 0", "2 task 2", "3 task 3"]
+        # commands that need input are run directly
+        assert tdtc(home, "rm", "0", input="n\n")[-1].endswith("delete (y/n)")
+        assert "00.ics" in calendar.resources
+    finally:
+        process.send_signal(signal.SIGTERM)
+        process.wait()
+        server.stop()
+        assert not os.path.exists(socket_path)
+        shutil.rmtree(home)
+
+def test_report_snapshots():
+    server = davserver.CalDAVServer().start()
+    calendar = server.add_calendar("Tasks")
+    server.add_calendar("Other")
+    for n in range(3):
+        add_task(calendar, "task %d" % n)
+    home, socket_path = make_home(server)
+    try:
+        # without a cache directory nothing is recorded
+        tdtc(home, "report")
+        assert not os.path.exists(os.path.join(home, ".taskdav-snapshots.jsonl"))
+        cache_dir = os.path.join(home, "cache")
+        os.mkdir(cache_dir)
+        with open(os.path.join(home, ".taskdav"), "a") as f:
+            f.write("[cache]\ndir = %s\n" % cache_dir)
+        tdtc(home, "report", "-s")
+        tdtc(home, "report", "--no-cache")
+        tdtc(home, "-n", "Other", "report", "--no-cache")
+        # the snapshots of the store are those of the calendar it is synced with, whatever calendar is named
+        for args in (["report", "--no-cache", "--history"], ["-n", "Other", "report", "--history"]):
+            assert [line.split()[2:] for line in tdtc(home, *args)] == [["open", "3", "done", "0"]] * 2
+        assert [line.split()[2:] for line in tdtc(home, "-n", "Other", "report", "--no-cache", "--history")] == [["open", "0", "done", "0"]]
+    finally:
+        shutil.rmtree(home)
+        server.stop()
+
+def test_rm():
+    server = davserver.CalDAVServer().start()
+    calendar = server.add_calendar("Tasks")
+    for n in range(3):
+        add_task(calendar, "task %d" % n, uid="%d%d" % (n, n))
+    home, socket_path = make_home(server)
+    try:
+        del server.requests[:]
+        assert tdtc(home, "rm", "-y", "00", "11")[-1].endswith("deleted")
+        # the tasks are loaded together rather than with a GET each
+        methods = [method for method, path, size in server.requests]
+        assert "GET" not in methods and methods.count("DELETE") == 2
+        assert sorted(calendar.resources) == ["22.ics"]
+    finally:
+        shutil.rmtree(home)
+        server.stop()
+
+def test_run_options():
+    server = davserver.CalDAVServer().start()
+    server.add_calendar("Tasks")
+    home, socket_path = make_home(server)
+    try:
+        profile = os.path.join(home, "profile")
+        # only taken before the command name, so the text of a task can have them
+        tdtc(home, "-n", "Tasks", "--profile", profile, "add", "--", "read", "--timings", "--profile", "notes")
+        assert os.path.exists(profile) and not os.path.exists(os.path.join(PACKAGE_PARENT, "notes"))
+        assert [line.split(" ", 1)[1] for line in tdtc(home, "ls")] == ["read --timings --profile notes"]
+        # after the command name they are the command's own, which an abbreviation doesn't stand for
+        process = subprocess.Popen([sys.executable, "-m", "taskdav.tdtc", "add", "write", "--prof", "notes"], env=dict(os.environ, HOME=home),
+                                   cwd=PACKAGE_PARENT, stderr=subprocess.PIPE)
+        assert "unrecognized arguments: --prof notes" in process.communicate()[1]
+        assert process.returncode != 0 and not os.path.exists(os.path.join(PACKAGE_PARENT, "notes"))
+    finally:
+        shutil.rmtree(home)
+        server.stop()
+
+def test_no_daemon():
+    home = tempfile.mkdtemp()
+    try:
+        assert daemon.forward(["ls"], os.path.join(home, "daemon.sock")) is None
+    finally:
+        shutil.rmtree(home)
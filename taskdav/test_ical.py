@@ -0,0 +1,67 @@
+#!/usr/bin/env python
+
+import StringIO
+import caldav
+import ical
+from task import Priority, STATUS_KEY, Task
+
+SAMPLE = "\r\n".join([
+    "BEGIN:VCALENDAR",
+    "VERSION:2.0",
+    "BEGIN:VTODO",
+    "UID:abc\\,def",
+    "SUMMARY;LANGUAGE=\"en:gb\":caf\xc3\xa9 a\\, b\;c\\\\d\\ne\\N \\q",
+    "  folded, and cut at the comma",
+    "status:IN-PROCESS",
+    "PRIORITY:3",
+    "BEGIN:VALARM",
+    "ACTION:EMAIL",
+    "SUMMARY:alarm summary",
+    "END:VALARM",
+    "SUMMARY:second summary",
+    "END:VTODO",
+    "END:VCALENDAR",
+    ""])
+
+FIELDS = {"SUMMARY", "STATUS", "PRIORITY", "UID", "DESCRIPTION"}
+
+def vobject_fields(data):
+    vtodo = caldav.vobject.readOne(StringIO.StringIO(data)).vtodo
+    return dict((name, getattr(vtodo, name.lower()).value) for name in FIELDS if hasattr(vtodo, name.lower()))
+
+def test_extract_fields():
+    fields = ical.extract_fields(SAMPLE, FIELDS)
+    assert fields["SUMMARY"] == u"caf\xe9 a, b;c\\d\ne\n \\q folded"
+    # UTF-8 data gives the same unicode values as unicode data
+    assert all(isinstance(value, unicode) for value in fields.values())
+    assert fields == dict((name, value.decode("utf-8")) for name, value in vobject_fields(SAMPLE).items())
+    unicode_sample = SAMPLE.decode("utf-8").replace("\r\n", "\n")
+    assert ical.extract_fields(unicode_sample, FIELDS) == vobject_fields(unicode_sample) == fields
+    assert ical.extract_fields("", FIELDS) == {}
+    assert ical.extract_fields("BEGIN:VCALENDAR\r\nEND:VCALENDAR\r\n", FIELDS) == {}
+
+def test_task_lazy_instance():
+    task = Task(None, data=SAMPLE)
+    assert task.summary.startswith("caf")
+    assert task.status == "IN-PROCESS"
+    assert task.priority == Priority.C
+    assert task.todo_getattr("uid") == "abc,def"
+    assert task._instance is None
+    task.priority = "A"
+    assert task._instance is not None
+    assert task.priority == Priority.A
+    new_task = Task.new_task(None, None, "new task")
+    assert new_task.summary == "new task"
+    assert new_task.priority == Priority.unspecified
+
+def test_task_record():
+    task = Task(None, data=SAMPLE)
+    record = task.record
+    assert task.record is record
+    assert task.sort_key == (Priority.C.sort_key, STATUS_KEY["IN-PROCESS"], task.summary)
+    task.status = "COMPLETED"
+    assert task.record is not record
+    assert task.sort_key[1] == STATUS_KEY["COMPLETED"]
+    assert task.format().startswith("x C caf")
+    task.data = SAMPLE
+    assert task.status == "IN-PROCESS"
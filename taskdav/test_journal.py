@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+
+import os
+import shutil
+import tempfile
+import davserver
+import journal
+from test_daemon import tdtc
+from test_sync import add_task
+
+def make_entries():
+    return [journal.Entry(journal.SAVE, "Tasks", "a", "http://h/a.ics", '"1"', "pri B"),
+            journal.Entry(journal.SAVE, "Tasks", "new", None, None, "created"),
+            journal.Entry(journal.SAVE, "Tasks", "a", "http://h/a.ics", '"1"', "pri A"),
+            journal.Entry(journal.DELETE, "Tasks", "b", "http://h/b.ics", '"2"', "deleted"),
+            journal.Entry(journal.SAVE, "Other", "a", "http://h/other/a.ics", '"3"', "other"),
+            journal.Entry(journal.SAVE, "Tasks", "new", None, None, "changed"),
+            journal.Entry(journal.SAVE, "Tasks", "gone", None, None, "created"),
+            journal.Entry(journal.DELETE, "Tasks", "gone", None, None)]
+
+def test_compact():
+    assert journal.compact(make_entries()) == [
+        journal.Entry(journal.SAVE, "Tasks", "a", "http://h/a.ics", '"1"', "pri A"),
+        journal.Entry(journal.SAVE, "Tasks", "new", None, None, "changed"),
+        journal.Entry(journal.DELETE, "Tasks", "b", "http://h/b.ics", '"2"', "deleted"),
+        journal.Entry(journal.SAVE, "Other", "a", "http://h/other/a.ics", '"3"', "other")]
+
+def test_journal():
+    temp_dir = tempfile.mkdtemp()
+    try:
+        pending = journal.Journal(os.path.join(temp_dir, "store", "journal.jsonl"))
+        assert pending.read() == ([], 0)
+        entries = make_entries()
+        pending.append(entries[:3])
+        pending.append(entries[3:])
+        with open(pending.filename, "a") as f:
+            f.write('{"op": "save", "calen')
+        read, offset = pending.read()
+        assert read == entries
+        # entries appended while the journal was being flushed are kept when it is rewritten
+        pending.append(entries[:1])
+        offset = pending.replace(entries[5:6], offset)
+        assert pending.entries() == [entries[5], entries[0]]
+        assert pending.read(offset)[0] == [entries[0]]
+        pending.replace([], pending.read()[1])
+        assert not os.path.exists(pending.filename)
+    finally:
+        shutil.rmtree(temp_dir)
+
+def make_home(server):
+    """makes a home directory with a config for the given server and a cache directory, in which commands write behind by default"""
+    home = tempfile.mkdtemp()
+    host, port = server.httpd.server_address
+    with open(os.path.join(home, ".taskdav"), "w") as f:
+        f.write("[server]\nurl = http://%s:%d/\nusername = user\npassword = password\n[cache]\ndir = %s\nwrite_behind = yes\n"
+                % (host, port, os.path.join(home, "cache")))
+    return home
+
+def without_ids(lines):
+    """returns the lines tdtc printed without the short ids of the tasks, which depend on the random id of a task it added"""
+    return [line.split(" ", 1)[1] for line in lines]
+
+def test_write_behind():
+    server = davserver.CalDAVServer().start()
+    calendar = server.add_calendar("Tasks")
+    for n in range(4):
+        add_task(calendar, "task %d" % n, uid="%d%d" % (n, n))
+    home = make_home(server)
+    try:
+        assert tdtc(home, "ls", "-s") == ["0 task 0", "1 task 1", "2 task 2", "3 task 3"]
+        del server.requests[:]
+        assert tdtc(home, "pri", "1", "A") == ["1 A task 1"]
+        assert tdtc(home, "pri", "1", "B") == ["1 B task 1"]
+        assert tdtc(home, "do", "2", "3") == ["2 x task 2", "3 x task 3"]
+        assert tdtc(home, "rm", "-y", "0") == ["0 task 0", "deleted"]
+        assert without_ids(tdtc(home, "add", "new task")) == ["new task"]
+        # nothing is sent to the server until the journal is flushed, but the cache is up to date
+        assert server.requests == []
+        assert without_ids(tdtc(home, "lsa")) == ["B task 1", "new task", "x task 2", "x task 3"]
+        # a task changed on the server in the meantime is a conflict
+        calendar.put("33.ics", calendar.resources["33.ics"][1].replace("SUMMARY:task 3", "SUMMARY:changed task 3"))
+        flushed = tdtc(home, "flush")
+        assert without_ids(flushed[:3] + flushed[4:6]) == ["B task 1", "x task 2", "x task 3", "task 0", "new task"]
+        assert flushed[3::3] == ["not written: changed on the server since it was loaded", "1 change kept in the journal"]
+        # the two changes to task 1 are sent as one write
+        assert sorted(method for method, path, size in server.requests if method in ("PUT", "DELETE")) == ["DELETE", "PUT", "PUT", "PUT", "PUT"]
+        assert "00.ics" not in calendar.resources
+        assert "PRIORITY:2" in calendar.resources["11.ics"][1] and "COMPLETED" in calendar.resources["22.ics"][1]
+        assert "changed task 3" in calendar.resources["33.ics"][1]
+        assert len(calendar.resources) == 4
+        del server.requests[:]
+        assert without_ids(tdtc(home, "flush", "--conflicts", "overwrite")) == ["x task 3"]
+        assert "SUMMARY:task 3" in calendar.resources["33.ics"][1]
+        assert tdtc(home, "flush") == []
+        assert not os.path.exists(os.path.join(home, "cache", ".taskdav", "journal.jsonl"))
+        # writes can still be sent straight away
+        assert without_ids(tdtc(home, "pri", "--no-write-behind", "11", "C")) == ["C task 1"]
+        assert "PRIORITY:3" in calendar.resources["11.ics"][1]
+    finally:
+        server.stop()
+        shutil.rmtree(home)
@@ -0,0 +1,45 @@
+#!/usr/bin/env python
+
+import threading
+import parallel
+from task import Task
+from test_ical import FIELDS, SAMPLE
+from test_store import make_task
+
+def test_use_workers():
+    assert not parallel.use_workers(10000, 1)
+    assert not parallel.use_workers(10, 4, threshold=100)
+    assert parallel.use_workers(100, 4, threshold=100)
+
+def test_extract_fields_many():
+    datas = [SAMPLE] + [make_task("task %02d" % n, "ABC"[n % 3], uid="u%d" % n).data for n in range(20)]
+    serial = parallel.extract_fields_many(datas, FIELDS)
+    assert serial[0]["UID"] == "abc,def" and serial[5]["SUMMARY"] == "task 04"
+    assert parallel.extract_fields_many(datas, FIELDS, workers=3, threshold=1) == serial
+
+def test_concurrent_pools():
+    # each pool parses its own data, even while other threads are starting pools of their own
+    datas = [[make_task("set %d task %d" % (n, i)).data for i in range(20 + n * 10)] for n in range(4)]
+    expected = [parallel.extract_fields_many(set_datas, FIELDS) for set_datas in datas]
+    mismatched = []
+    def extract(n):
+        for attempt in range(5):
+            if parallel.extract_fields_many(datas[n], FIELDS, workers=2, threshold=1) != expected[n]:
+                mismatched.append(n)
+    threads = [threading.Thread(target=extract, args=(n,)) for n in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert mismatched == []
+
+def test_task_extract_fields_many():
+    tasks = [Task(None, url=None, data=make_task("task %02d" % n, uid="u%d" % n).data, etag=None) for n in range(10)]
+    Task.extract_fields_many(tasks, workers=2, threshold=5)
+    assert all(task._fields is not None for task in tasks)
+    assert [task.summary for task in tasks] == ["task %02d" % n for n in range(10)]
+    assert [task.todo_getattr("uid") for task in tasks] == ["u%d" % n for n in range(10)]
+    # below the threshold the fields are left to be extracted when needed
+    tasks = [Task(None, url=None, data=make_task("task").data, etag=None)]
+    Task.extract_fields_many(tasks, workers=2, threshold=5)
+    assert tasks[0]._fields is None and tasks[0].summary == "task"
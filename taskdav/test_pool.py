@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+
+from task import BatchWriter, TaskDAVClient
+from test_sync import make_server, add_task
+
+def test_reuse():
+    server, dav_calendar = make_server(5)
+    try:
+        client = TaskDAVClient(server.url)
+        calendar = client.get_calendar("Tasks")
+        for task in calendar.get_tasks().values():
+            task.load()
+        stats = client.pool.stats()
+        assert stats["opened"] == 1
+        assert stats["reused"] == len(server.requests) - 1
+        # a streamed report that is stopped early still gives its connection back
+        next(calendar.iter_tasks())
+        calendar.get_etags()
+        assert client.pool.stats()["opened"] == 1
+    finally:
+        server.stop()
+
+def test_large_response_not_drained():
+    server, dav_calendar = make_server(0)
+    for n in range(400):
+        add_task(dav_calendar, "task %d " % n + "x" * 200)
+    try:
+        client = TaskDAVClient(server.url)
+        calendar = client.get_calendar("Tasks")
+        tasks = calendar.iter_tasks()
+        next(tasks)
+        tasks.close()
+        # the rest of the report is too large to read just to reuse the connection, so it is closed instead
+        assert client.pool.stats()["opened"] == 1 and client.pool.idle == []
+        assert len(calendar.get_ids()) == 400
+        assert client.pool.stats()["opened"] == 2
+    finally:
+        server.stop()
+
+def test_closed_connection_retried():
+    server, dav_calendar = make_server(1)
+    try:
+        client = TaskDAVClient(server.url)
+        calendar = client.get_calendar("Tasks")
+        for connection in client.pool.idle:
+            connection.sock.close()
+        assert len(calendar.get_ids()) == 1
+        assert client.pool.stats()["opened"] == 2
+        # a write isn't sent on a connection that has been closed at all, as it couldn't safely be sent again
+        task = calendar.get_tasks().values()[0]
+        for connection in client.pool.idle:
+            connection.sock.close()
+        writer = BatchWriter(client)
+        writer.delete(task)
+        assert writer.run()[0].ok and not dav_calendar.resources
+    finally:
+        server.stop()
+
+def test_dropped_write_not_retried():
+    server, dav_calendar = make_server(2)
+    try:
+        client = TaskDAVClient(server.url)
+        calendar = client.get_calendar("Tasks")
+        tasks = calendar.get_tasks().values()
+        # a report on a reused connection that drops is sent again
+        server.fail_next("REPORT", 0)
+        assert len(calendar.tasks()) == 2
+        assert [method for method, path, size in server.requests].count("REPORT") == 3
+        # but a write might have been carried out before the connection dropped, so it isn't
+        server.fail_next("DELETE", 0)
+        writer = BatchWriter(client)
+        writer.delete(tasks[0])
+        assert writer.run()[0].exception is not None
+        assert [method for method, path, size in server.requests].count("DELETE") == 1
+    finally:
+        server.stop()
+
+def test_concurrent_use():
+    server, dav_calendar = make_server(20, latency=0.02)
+    try:
+        client = TaskDAVClient(server.url, pool_size=4)
+        calendar = client.get_calendar("Tasks")
+        writer = BatchWriter(client, workers=10)
+        for task in calendar.get_tasks().values():
+            writer.delete(task)
+        assert all(result.ok for result in writer.run())
+        assert not dav_calendar.resources
+        stats = client.pool.stats()
+        assert stats["opened"] <= 4
+        assert stats["opened"] + stats["reused"] == len(server.requests)
+    finally:
+        server.stop()
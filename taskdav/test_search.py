@@ -0,0 +1,43 @@
+#!/usr/bin/env python
+
+import random
+import search
+from test_store import make_task, make_store
+
+SUMMARIES = ["walk the dog @home", "buy dog food @shop +pets", "pay bills @home +money", "call the bank +money", "Book holiday", "go"]
+TERMS = [[], ["dog"], ["dog", "food"], ["dog-"], ["@home"], ["a"], ["bo"], ["+money", "bank-"], ["b"], ["x-"], ["-"], ["holiday"], ["DOG"]]
+
+def make_tasks():
+    return dict(("%02d%s" % (n, summary[0]), make_task(summary, status="COMPLETED" if n == 1 else None, uid="%02d%s" % (n, summary[0])))
+                for n, summary in enumerate(SUMMARIES))
+
+def test_search_matches_terms():
+    tasks = make_tasks()
+    index = search.TaskIndex(tasks)
+    random.seed(3)
+    for terms in TERMS + [random.sample(["dog", "0", "the", "@home-", "+money", "go", "k"], 2) for n in range(20)]:
+        expected = {task_id for task_id, task in tasks.items() if search.matches_terms(task_id, task.summary, [t.lower() for t in terms])}
+        assert index.search(terms) == expected, terms
+
+def test_index_changes():
+    tasks = make_tasks()
+    index = search.TaskIndex(tasks)
+    assert index.tags(search.CONTEXT) == ["@home"]
+    assert index.tags(search.PROJECT) == ["+money"]
+    index.add("01b", make_task("buy cat food @shop +pets", uid="01b"))
+    assert index.search(["cat"]) == {"01b"}
+    assert index.search(["dog"]) == {"00w"}
+    assert index.tags(search.CONTEXT) == ["@home", "@shop"]
+    index.remove("02p")
+    index.remove("03c")
+    assert index.tags(search.PROJECT) == ["+pets"]
+    assert index.search(["+money"]) == set()
+    assert "ban" not in index.postings
+
+def test_store_query_terms():
+    tasks = make_tasks()
+    task_store = make_store(*tasks.values())
+    for terms in TERMS:
+        expected = sorted(task_id for task_id, task in tasks.items() if search.matches_terms(task_id, task.summary, [t.lower() for t in terms]))
+        assert sorted(task.id for task in task_store.query(terms=terms)) == expected, terms
+    assert [task.id for task in task_store.query(incomplete=True, terms=["dog"])] == ["00w"]
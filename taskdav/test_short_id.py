@@ -26,7 +26,43 @@ def test_simple():
     assert raises(KeyError, indict.unique, "e")
     assert raises(ValueError, indict.unique, "t")
     assert indict.unique("teach") == "you"
+    assert indict.unique_key("teac") == "teach"
     assert indict.shortest("teach") == "tea"
     assert indict.shortest("pumpkin") == "pumpkin"
 
+def test_prefix_of_other_key():
+    indict = short_id.prefix_dict()
+    indict["te"] = 1
+    indict["test"] = 2
+    indict[3] = "not a string"
+    assert indict.search("te") == ["te", "test"]
+    assert indict.shortest("te") == "te"
+    assert indict.shortest("test") == "tes"
+    assert indict.shortest("tx") == "tx"
+    assert indict.unique("tes") == 2
+
+def test_changes_after_lookup():
+    indict = short_id.prefix_dict(abc=1, abd=2)
+    assert indict.shortest("abc") == "abc"
+    del indict["abd"]
+    assert indict.shortest("abc") == "a"
+    indict["b"] = 3
+    indict.setdefault("bcd", 4)
+    assert indict.search("b") == ["b", "bcd"]
+    assert indict.pop("b") == 3
+    assert indict.unique("b") == 4
+    indict.update({"bce": 5})
+    assert indict.search("bc") == ["bcd", "bce"]
+    indict.clear()
+    assert indict.search("") == []
 
+def test_shortest_all():
+    indict = short_id.prefix_dict()
+    for key in ["test", "teach", "te", "pumpkin", "pump", "zebra", ""]:
+        indict[key] = key.upper()
+    shortest = indict.shortest_all()
+    assert sorted(shortest) == sorted(indict)
+    for key in indict:
+        assert shortest[key] == indict.shortest(key)
+    assert shortest["zebra"] == "z"
+    assert shortest["teach"] == "tea"
@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+
+"""Guards the startup of tdtc for commands that read from the cache store, which shouldn't import caldav; their times are kept by benchmark.py,
+and a cached listing is checked to start in under STARTUP_LIMIT seconds if STARTUP_CHECK_ENV is set"""
+
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import cache
+from task import Task
+
+PACKAGE_PARENT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+CALDAV_MODULES = ("caldav", "lxml", "vobject")
+# the startup time limit is only checked when asked for, as a busy machine can't be relied on to meet it
+STARTUP_LIMIT = 0.1
+STARTUP_CHECK_ENV = "TASKDAV_STARTUP_CHECK"
+
+CHECK_MODULES = """
+import sys
+sys.argv = ["tdtc"] + sys.argv[1:]
+from taskdav import tdtc
+tdtc.app.run()
+print sorted(set(name.split(".")[0] for name in sys.modules if sys.modules[name] is not None) & set(%r))
+""" % (CALDAV_MODULES,)
+
+def make_home(count):
+    """makes a home directory with a config using a cache store of count tasks, and a server that isn't there"""
+    home = tempfile.mkdtemp()
+    cache_dir = os.path.join(home, "cache")
+    os.mkdir(cache_dir)
+    with open(os.path.join(home, ".taskdav"), "w") as f:
+        f.write("[server]\nurl = http://127.0.0.1:9/\nusername = user\npassword = password\n[cache]\ndir = %s\n" % cache_dir)
+    task_store = cache.open_store(cache_dir)
+    for n in range(count):
+        task_store.put(Task.new_task(None, None, "task %d @home +garden" % n, uid="task-%d" % n))
+    task_store.close()
+    return home
+
+def run_tdtc(home, *args):
+    """runs tdtc with the given args in a new interpreter, returning its output"""
+    return subprocess.check_output([sys.executable] + list(args), env=dict(os.environ, HOME=home), cwd=PACKAGE_PARENT)
+
+def test_cached_list_imports():
+    home = make_home(10)
+    try:
+        for command in (["ls", "-C"], ["lsp", "-C", "A-C"], ["lsc", "-C"], ["report", "-C"]):
+            output = run_tdtc(home, "-c", CHECK_MODULES, *command)
+            assert output.strip().splitlines()[-1] == "[]"
+    finally:
+        shutil.rmtree(home)
+
+def test_cached_list():
+    home = make_home(100)
+    try:
+        output = run_tdtc(home, "-m", "taskdav.tdtc", "-m", "ls", "-C")
+        assert len(output.splitlines()) == 100
+    finally:
+        shutil.rmtree(home)
+
+def test_cached_list_time():
+    if not os.environ.get(STARTUP_CHECK_ENV):
+        return
+    home = make_home(100)
+    try:
+        run_tdtc(home, "-m", "taskdav.tdtc", "-m", "ls", "-C")
+        elapsed = []
+        for n in range(5):
+            start = time.time()
+            run_tdtc(home, "-m", "taskdav.tdtc", "-m", "ls", "-C")
+            elapsed.append(time.time() - start)
+        # the best of a few runs, to allow for a busy machine
+        assert min(elapsed) < STARTUP_LIMIT
+    finally:
+        shutil.rmtree(home)
@@ -0,0 +1,170 @@
+#!/usr/bin/env python
+
+import os
+import shutil
+import tempfile
+import cache
+from store import TaskStore, CONTEXT, PROJECT
+from task import Priority, Task, TaskDAVClient
+from test_sync import make_server, add_task
+
+def make_task(summary, priority=None, status=None, uid=None):
+    task = Task.new_task(None, None, summary, **({"uid": uid} if uid else {}))
+    if priority is not None:
+        task.priority = priority
+    if status is not None:
+        task.status = status
+    return task
+
+def make_store(*tasks):
+    task_store = TaskStore(":memory:")
+    for task in tasks:
+        task_store.put(task)
+    return task_store
+
+def test_query():
+    task_store = make_store(make_task("walk the dog @home", "B", uid="a1"),
+                            make_task("buy milk @shop +food", uid="a2"),
+                            make_task("eat cake +food", "A", "COMPLETED", uid="b1"),
+                            make_task("pay bills @home", "A", "IN-PROCESS", uid="b2"))
+    assert [t.id for t in task_store.query()] == ["b2", "b1", "a1", "a2"]
+    assert [t.id for t in task_store.query(incomplete=True)] == ["b2", "a1", "a2"]
+    assert [t.id for t in task_store.query(incomplete=True, priorities=Task.parse_priority_range("A-B"))] == ["b2", "a1"]
+    assert [t.id for t in task_store.query(limit=2)] == ["b2", "b1"]
+    assert [t.id for t in task_store.query(incomplete=True, terms=["@home"], limit=1)] == ["b2"]
+    assert task_store.status_counts() == {"NEEDS-ACTION": 2, "IN-PROCESS": 1, "COMPLETED": 1}
+    assert task_store.tags(CONTEXT) == ["@home", "@shop"]
+    assert task_store.tags(PROJECT) == ["+food"]
+    assert task_store.tags(PROJECT, incomplete=False) == ["+food"]
+    task = task_store.get_task("b2")
+    assert task.priority == Priority.A
+    assert task.format() == "A pay bills @home"
+    assert "SUMMARY:pay bills @home" in task.data
+    task_store.delete("a2")
+    assert task_store.tags(CONTEXT) == ["@home"]
+    assert task_store.tags(PROJECT) == []
+    assert sorted(task_store.get_tasks()) == ["a1", "b1", "b2"]
+
+def test_import_dir():
+    cache_dir = tempfile.mkdtemp()
+    try:
+        for uid in ["x1", "x2"]:
+            with open(os.path.join(cache_dir, uid + ".ics"), "w") as f:
+                f.write(make_task("task %s" % uid, uid=uid).data)
+        task_store = cache.open_store(cache_dir)
+        assert sorted(task_store.get_tasks()) == ["x1", "x2"]
+        os.remove(os.path.join(cache_dir, "x1.ics"))
+        task_store.import_dir(cache_dir)
+        assert sorted(task_store.get_tasks()) == ["x2"]
+        # a file rewritten in place, which doesn't change the directory's modification time
+        dir_mtime = os.stat(cache_dir).st_mtime
+        with open(os.path.join(cache_dir, "x2.ics"), "w") as f:
+            f.write(make_task("changed x2", uid="x2").data)
+        os.utime(os.path.join(cache_dir, "x2.ics"), (dir_mtime + 10, dir_mtime + 10))
+        assert os.stat(cache_dir).st_mtime == dir_mtime
+        task_store.import_dir(cache_dir)
+        assert task_store.get_task("x2").summary == "changed x2"
+    finally:
+        shutil.rmtree(cache_dir)
+
+def test_sync():
+    server, dav_calendar = make_server(2)
+    cache_dir = tempfile.mkdtemp()
+    try:
+        calendar = TaskDAVClient(server.url).get_calendar("Tasks")
+        task_store = cache.open_store(cache_dir)
+        task_store.sync(calendar)
+        names = sorted(dav_calendar.resources)
+        assert sorted(task_store.get_tasks()) == sorted(name.replace(".ics", "") for name in names)
+        dav_calendar.delete(names[0])
+        add_task(dav_calendar, "task 2", uid="new")
+        assert len(task_store.sync(calendar)[0]) == 1
+        assert sorted(task_store.get_tasks()) == sorted([names[1].replace(".ics", ""), "new"])
+        assert task_store.get_sync_state().sync_token == dav_calendar.sync_token
+        assert os.listdir(cache_dir) == [cache.STORE_DIRNAME]
+    finally:
+        shutil.rmtree(cache_dir)
+        server.stop()
+
+def test_write_through():
+    server, dav_calendar = make_server(2, sync_collection=False)
+    cache_dir = tempfile.mkdtemp()
+    try:
+        calendar = TaskDAVClient(server.url).get_calendar("Tasks")
+        task_store = cache.open_store(cache_dir)
+        task_store.sync(calendar)
+        task = calendar.get_task(sorted(task_store.get_tasks())[0])
+        task.summary = "changed task"
+        task.save()
+        task_store.record_saved(task, cache_dir)
+        assert task_store.get_task(task.id).summary == "changed task"
+        new_task = Task.new_task(calendar.client, calendar, "new task", uid="new")
+        new_task.save()
+        task_store.record_saved(new_task, cache_dir)
+        assert task_store.get_task("new").etag == new_task.etag
+        # the store already has the saved tasks, so syncing doesn't fetch them again
+        assert task_store.sync(calendar) == ([], [])
+        new_task.delete()
+        task_store.record_deleted(new_task, cache_dir)
+        assert sorted(task_store.get_tasks()) == sorted(name.replace(".ics", "") for name in dav_calendar.resources)
+        assert task_store.sync(calendar) == ([], [])
+    finally:
+        shutil.rmtree(cache_dir)
+        server.stop()
+
+def test_write_through_imported_file():
+    server, dav_calendar = make_server(0)
+    cache_dir = tempfile.mkdtemp()
+    try:
+        add_task(dav_calendar, "task x1", uid="x1")
+        with open(os.path.join(cache_dir, "x1.ics"), "w") as f:
+            f.write(dav_calendar.resources["x1.ics"][1])
+        task_store = cache.open_store(cache_dir)
+        calendar = TaskDAVClient(server.url).get_calendar("Tasks")
+        task = calendar.get_task("x1")
+        task.summary = "changed x1"
+        task.save()
+        task_store.record_saved(task, cache_dir)
+        with open(os.path.join(cache_dir, "x1.ics")) as f:
+            assert "SUMMARY:changed x1" in f.read()
+        task_store.import_dir(cache_dir)
+        assert [t.summary for t in task_store.get_tasks().values()] == ["changed x1"]
+        task.delete()
+        task_store.record_deleted(task, cache_dir)
+        assert not os.path.exists(os.path.join(cache_dir, "x1.ics"))
+        task_store.import_dir(cache_dir)
+        assert task_store.get_tasks() == {}
+    finally:
+        shutil.rmtree(cache_dir)
+        server.stop()
+
+def test_write_through_other_calendar():
+    server, dav_calendar = make_server(1)
+    work_calendar = server.add_calendar("Work")
+    add_task(work_calendar, "work task", uid="w1")
+    cache_dir = tempfile.mkdtemp()
+    try:
+        client = TaskDAVClient(server.url)
+        with open(os.path.join(cache_dir, "x1.ics"), "w") as f:
+            f.write(dav_calendar.resources.values()[0][1])
+        task_store = cache.open_store(cache_dir)
+        # the store has only been imported, so it doesn't know which calendar it is of, and new tasks aren't written through
+        new_task = Task.new_task(client, client.get_calendar("Work"), "new work task", uid="new")
+        new_task.save()
+        task_store.record_saved(new_task, cache_dir)
+        work_task = client.get_calendar("Work").get_task("w1")
+        work_task.summary = "changed work task"
+        work_task.save()
+        task_store.record_saved(work_task, cache_dir)
+        assert task_store.get_tasks().keys() == ["x1"]
+        # once synced, the store knows its calendar, and tasks of any other are left out
+        task_store.sync(client.get_calendar("Tasks"))
+        work_task.summary = "changed again"
+        work_task.save()
+        task_store.record_saved(work_task, cache_dir)
+        new_task.delete()
+        task_store.record_deleted(new_task, cache_dir)
+        assert set(t.summary for t in task_store.get_tasks().values()) == set(["task 0"])
+    finally:
+        shutil.rmtree(cache_dir)
+        server.stop()
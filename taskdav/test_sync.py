@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+
+import davserver
+from caldav.lib import error
+from helpers import raises
+from task import SyncState, Task, TaskDAVClient
+
+def make_server(count, **kwargs):
+    server = davserver.CalDAVServer(**kwargs).start()
+    calendar = server.add_calendar("Tasks")
+    for n in range(count):
+        add_task(calendar, "task %d" % n)
+    return server, calendar
+
+def add_task(calendar, summary, uid=None, priority=None, status=None):
+    task = Task.new_task(None, None, summary, **({"uid": uid} if uid else {}))
+    if priority is not None:
+        task.priority = priority
+    if status is not None:
+        task.status = status
+    calendar.put(task.id + ".ics", task.instance.serialize().encode("utf-8"))
+    return task.id
+
+def check_incremental_sync(**kwargs):
+    server, dav_calendar = make_server(3, **kwargs)
+    try:
+        calendar = TaskDAVClient(server.url).get_calendar("Tasks")
+        state = SyncState()
+        changed, deleted = calendar.sync_changes(state)
+        assert sorted(task.summary for task in changed) == ["task 0", "task 1", "task 2"]
+        assert deleted == []
+        assert len(state.etags) == 3
+        del server.requests[:]
+        assert calendar.sync_changes(state) == ([], [])
+        assert len(server.requests) == 1
+        names = sorted(dav_calendar.resources)
+        dav_calendar.delete(names[0])
+        dav_calendar.put(names[1], dav_calendar.resources[names[1]][1].replace("SUMMARY:task", "SUMMARY:changed task"))
+        add_task(dav_calendar, "task 3")
+        changed, deleted = calendar.sync_changes(state)
+        assert sorted(task.summary[:7] for task in changed) == ["changed", "task 3"]
+        assert [href.rsplit("/", 1)[-1] for href in deleted] == [names[0]]
+        assert len(state.etags) == 3
+        return state
+    finally:
+        server.stop()
+
+def test_sync_collection():
+    state = check_incremental_sync()
+    assert state.sync_collection is True
+    assert state.sync_token
+
+def test_ctag_etag_fallback():
+    state = check_incremental_sync(sync_collection=False)
+    assert state.sync_collection is False
+    assert state.ctag
+
+def test_sync_failure():
+    server, dav_calendar = make_server(2)
+    try:
+        calendar = TaskDAVClient(server.url).get_calendar("Tasks")
+        state = SyncState()
+        calendar.sync_changes(state)
+        add_task(dav_calendar, "task 2")
+        # a server error doesn't mean that sync-collection isn't supported
+        server.fail_next("REPORT", 500)
+        assert raises(error.ReportError, calendar.sync_changes, state)
+        assert state.sync_collection is True
+        changed, deleted = calendar.sync_changes(state)
+        assert [task.summary for task in changed] == ["task 2"]
+        assert state.sync_collection is True
+    finally:
+        server.stop()
+
+def test_invalid_sync_token():
+    server, dav_calendar = make_server(2)
+    try:
+        calendar = TaskDAVClient(server.url).get_calendar("Tasks")
+        state = SyncState()
+        calendar.sync_changes(state)
+        gone = sorted(dav_calendar.resources)[0]
+        dav_calendar.delete(gone)
+        state.sync_token = "http://example.com/expired-token"
+        changed, deleted = calendar.sync_changes(state)
+        assert changed == []
+        assert [href.rsplit("/", 1)[-1] for href in deleted] == [gone]
+    finally:
+        server.stop()
@@ -0,0 +1,224 @@
+#!/usr/bin/env python
+
+import datetime
+from task import BatchWriter, Priority, Task, TaskDAVClient, TaskFilter, get_object_urlname
+from test_sync import make_server, add_task
+
+def add_tasks(dav_calendar):
+    add_task(dav_calendar, "walk the dog @home", uid="t1")
+    add_task(dav_calendar, "Buy milk @shop", uid="t2", priority="B")
+    add_task(dav_calendar, "buy bread", uid="t3", priority="A", status="COMPLETED")
+    add_task(dav_calendar, "pay bills", uid="t4", priority="A")
+
+def add_task_without_status(dav_calendar, summary, uid, priority=None):
+    add_task(dav_calendar, summary, uid=uid, priority=priority)
+    etag, data = dav_calendar.resources[uid + ".ics"]
+    dav_calendar.put(uid + ".ics", data.replace("STATUS:NEEDS-ACTION\r\n", ""))
+
+def check_filters(**kwargs):
+    server, dav_calendar = make_server(0, **kwargs)
+    add_tasks(dav_calendar)
+    try:
+        calendar = TaskDAVClient(server.url).get_calendar("Tasks")
+        def uids(task_filter):
+            return sorted(task.todo_getattr("uid") for task in calendar.tasks(task_filter))
+        assert uids(None) == ["t1", "t2", "t3", "t4"]
+        assert uids(TaskFilter()) == ["t1", "t2", "t3", "t4"]
+        assert uids(TaskFilter(incomplete=True)) == ["t1", "t2", "t4"]
+        assert uids(TaskFilter(priorities=Task.parse_priority_range("A"))) == ["t3", "t4"]
+        assert uids(TaskFilter(incomplete=True, priorities=Task.parse_priority_range("A-B"))) == ["t2", "t4"]
+        assert uids(TaskFilter(priorities=Task.parse_priority_range("A-E"))) == ["t1", "t2", "t3", "t4"]
+        assert uids(TaskFilter(summary_terms=["BUY"])) == ["t2", "t3"]
+        assert uids(TaskFilter(summary_terms=["buy"], summary_excludes=["milk"])) == ["t3"]
+        assert sorted(calendar.get_ids()) == ["t1", "t2", "t3", "t4"]
+        # a task without a STATUS isn't complete
+        add_task_without_status(dav_calendar, "water plants", "t5", priority="A")
+        assert uids(TaskFilter(incomplete=True)) == ["t1", "t2", "t4", "t5"]
+        assert uids(TaskFilter(incomplete=True, priorities=Task.parse_priority_range("A"))) == ["t4", "t5"]
+        return server
+    finally:
+        server.stop()
+
+def test_server_filters():
+    server = check_filters()
+    report_bytes = [size for method, path, size in server.requests if method == "REPORT"]
+    # the incomplete tasks are sent without the completed one
+    assert report_bytes[2] < report_bytes[0]
+
+def test_client_side_filters():
+    check_filters(filters=False)
+
+def test_non_ascii_loaded_task():
+    server, dav_calendar = make_server(0)
+    add_task(dav_calendar, "cafe visit @town", uid="aa")
+    etag, data = dav_calendar.resources["aa.ics"]
+    dav_calendar.put("aa.ics", data.replace("SUMMARY:cafe", "SUMMARY:caf\xc3\xa9"))
+    try:
+        calendar = TaskDAVClient(server.url).get_calendar("Tasks")
+        del server.requests[:]
+        task = calendar.get_task("aa")
+        assert "GET" in [method for method, path, size in server.requests]
+        # the summary of a task loaded with a GET is unicode, as it is from a report, so it can be joined to a unicode id
+        assert task.summary == u"caf\xe9 visit @town" and isinstance(task.summary, unicode)
+        assert u"aa " + task.format() == u"aa caf\xe9 visit @town"
+    finally:
+        server.stop()
+
+def add_detailed_task(dav_calendar, n):
+    """adds a task with the sort of description and alarm that list commands don't need"""
+    task = Task.new_task(None, None, "detailed task %d" % n)
+    task.todo_setattr("description", "A long description of the task, with lots of notes about it. " * 10)
+    alarm = task.instance.vtodo.add("valarm")
+    alarm.add("action").value = "DISPLAY"
+    alarm.add("description").value = "Reminder"
+    alarm.add("trigger").value = -datetime.timedelta(minutes=15)
+    dav_calendar.put(task.id + ".ics", task.instance.serialize().encode("utf-8"))
+
+def test_partial_data():
+    server, dav_calendar = make_server(0)
+    for n in range(20):
+        add_detailed_task(dav_calendar, n)
+    try:
+        calendar = TaskDAVClient(server.url).get_calendar("Tasks")
+        full_tasks = calendar.tasks()
+        partial_tasks = calendar.tasks(props=Task.LIST_PROPS)
+        full_bytes, partial_bytes = [size for method, path, size in server.requests if method == "REPORT"]
+        assert partial_bytes * 2 < full_bytes
+        assert [t.summary for t in partial_tasks] == [t.summary for t in full_tasks]
+        task = partial_tasks[0]
+        assert task.partial
+        assert "DESCRIPTION" not in task.data
+        assert task.format() == "detailed task %d" % int(task.summary.split()[-1])
+        del server.requests[:]
+        task.priority = "B"
+        assert [method for method, path, size in server.requests] == ["GET"]
+        assert not task.partial
+        assert task.instance.vtodo.description.value.startswith("A long description")
+        task.save()
+        etag, data = dav_calendar.resources[get_object_urlname(task)]
+        assert "BEGIN:VALARM" in data and "PRIORITY:2" in data
+    finally:
+        server.stop()
+
+def check_load_many(**kwargs):
+    server, dav_calendar = make_server(0, **kwargs)
+    for n in range(5):
+        add_detailed_task(dav_calendar, n)
+    try:
+        calendar = TaskDAVClient(server.url, multiget_batch_size=2).get_calendar("Tasks")
+        tasks = calendar.tasks(props=Task.LIST_PROPS)
+        del server.requests[:]
+        assert calendar.load_many(tasks) == tasks
+        assert not any(task.partial for task in tasks)
+        assert all(task.instance.vtodo.description.value.startswith("A long description") for task in tasks)
+        assert all(task.etag == dav_calendar.resources[get_object_urlname(task)][0] for task in tasks)
+        return [method for method, path, size in server.requests]
+    finally:
+        server.stop()
+
+def test_load_many():
+    assert check_load_many() == ["REPORT"] * 3
+
+def test_load_many_without_multiget():
+    assert check_load_many(multiget=False) == ["REPORT"] + ["GET"] * 5
+
+def check_iter_tasks(**kwargs):
+    server, dav_calendar = make_server(0, **kwargs)
+    add_tasks(dav_calendar)
+    try:
+        calendar = TaskDAVClient(server.url).get_calendar("Tasks")
+        def uids(tasks):
+            return sorted(task.todo_getattr("uid") for task in tasks)
+        assert uids(calendar.iter_tasks()) == uids(calendar.tasks()) == ["t1", "t2", "t3", "t4"]
+        task_filter = TaskFilter(incomplete=True, priorities=Task.parse_priority_range("A-B"))
+        assert uids(calendar.iter_tasks(task_filter)) == ["t2", "t4"]
+        add_task_without_status(dav_calendar, "water plants", "t5", priority="A")
+        assert uids(calendar.iter_tasks(task_filter)) == uids(calendar.tasks(task_filter)) == ["t2", "t4", "t5"]
+        partial = list(calendar.iter_tasks(props=Task.LIST_PROPS))
+        assert all(task.partial and task.etag for task in partial)
+        # stopping early still leaves the connection ready for the next request
+        tasks = calendar.iter_tasks()
+        first = next(tasks)
+        tasks.close()
+        assert first.summary
+        assert sorted(calendar.get_ids()) == ["t1", "t2", "t3", "t4", "t5"]
+    finally:
+        server.stop()
+
+def test_iter_tasks():
+    check_iter_tasks()
+
+def test_iter_tasks_client_side_filters():
+    check_iter_tasks(filters=False)
+
+def test_batch_writer():
+    server, dav_calendar = make_server(20, latency=0.05)
+    try:
+        client = TaskDAVClient(server.url)
+        calendar = client.get_calendar("Tasks")
+        tasks = sorted(calendar.get_tasks().values(), key=lambda task: task.summary)
+        writer = BatchWriter(client, workers=10)
+        for task in tasks[:18]:
+            task.status = "COMPLETED"
+            writer.save(task)
+        # changed on the server since it was loaded
+        add_task(dav_calendar, "changed elsewhere", uid=tasks[0].todo_getattr("uid"))
+        writer.delete(tasks[18])
+        new_task = Task.new_task(client, calendar, "new task")
+        writer.save(new_task)
+        server.most_in_flight = 0
+        results = writer.run()
+        # the writes are sent at once, as many as the client's connection pool allows
+        assert server.most_in_flight == client.pool.size
+        assert [result.task for result in results] == tasks[:19] + [new_task]
+        assert results[0].conflict and not results[0].ok
+        assert all(result.ok for result in results[1:])
+        etag, data = dav_calendar.resources[get_object_urlname(tasks[1])]
+        assert tasks[1].etag == etag and "STATUS:COMPLETED" in data
+        assert get_object_urlname(tasks[18]) not in dav_calendar.resources
+        assert get_object_urlname(new_task) in dav_calendar.resources
+        # the same write again is now out of date
+        writer.delete(tasks[18])
+        writer.save(new_task)
+        new_task.etag = '"stale"'
+        writer.save(new_task)
+        assert [result.status for result in writer.run()] == [404, 204, 412]
+    finally:
+        server.stop()
+
+def test_get_all_tasks():
+    server, dav_calendar = make_server(2, latency=0.1)
+    for name in ("Work", "Home", "Garden"):
+        add_task(server.add_calendar(name), "%s task" % name, uid=name.lower())
+    try:
+        client = TaskDAVClient(server.url)
+        client.load_calendars()
+        server.most_in_flight = 0
+        all_tasks = client.get_all_tasks()
+        # one report for each calendar, all at once
+        assert server.most_in_flight == 4
+        assert sorted(all_tasks) == ["Garden", "Home", "Tasks", "Work"]
+        assert len(all_tasks["Tasks"]) == 2
+        assert all_tasks["Work"].unique("w").summary == "Work task"
+        assert all_tasks["Home"] is client.get_calendar("Home").get_tasks()
+    finally:
+        server.stop()
+
+def test_top():
+    server, dav_calendar = make_server(0)
+    for n in range(12):
+        add_task(dav_calendar, "task %02d" % n, uid="t%02d" % n, priority="ABC"[n % 3], status="COMPLETED" if n % 4 == 0 else None)
+    try:
+        calendar = TaskDAVClient(server.url).get_calendar("Tasks")
+        task_filter = TaskFilter(incomplete=True)
+        expected = sorted(calendar.tasks(task_filter), key=lambda task: task.sort_key)[:4]
+        del server.requests[:]
+        top = calendar.top(4, task_filter)
+        assert [task.summary for task in top] == [task.summary for task in expected] == ["task 03", "task 06", "task 09", "task 01"]
+        # one report for the tasks with an incomplete STATUS, and one for those without a STATUS
+        assert [method for method, path, size in server.requests] == ["REPORT", "REPORT"]
+        calendar.load_tasks()
+        assert [task.summary for task in calendar.top(4, task_filter)] == [task.summary for task in expected]
+        assert [task.summary for task in calendar.top(4)] == ["task 03", "task 06", "task 09", "task 00"]
+    finally:
+        server.stop()
@@ -0,0 +1,31 @@
+#!/usr/bin/env python
+
+import StringIO
+import timings
+from task import TaskDAVClient
+from test_sync import make_server
+
+def test_recorder():
+    server, dav_calendar = make_server(5)
+    try:
+        assert timings.recorder is None
+        recorder = timings.start()
+        try:
+            calendar = TaskDAVClient(server.url).get_calendar("Tasks")
+            tasks = calendar.get_tasks()
+            calendar.get_task(sorted(tasks)[0]).instance
+        finally:
+            assert timings.stop() is recorder
+        assert [name for name in recorder.phase_order] == ["discovery", "fetch tasks", "parse fields", "load task", "parse vobject"]
+        assert recorder.phases["parse vobject"][1] == 1
+        methods = [method for method, path, size in server.requests]
+        assert {method: totals[0] for method, totals in recorder.requests.items()} == {method: methods.count(method) for method in set(methods)}
+        assert recorder.requests["REPORT"][2] == sum(size for method, path, size in server.requests if method == "REPORT")
+        output = StringIO.StringIO()
+        recorder.report(output)
+        assert "fetch tasks" in output.getvalue() and "REPORT" in output.getvalue()
+        # nothing is recorded once stopped
+        calendar.load_tasks()
+        assert recorder.phases["fetch tasks"][1] == 1
+    finally:
+        server.stop()
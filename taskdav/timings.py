@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+
+"""Optional instrumentation of where a command spends its time: the wall time and number of calls of each phase,
+and the number of HTTP requests of each method with the bytes they sent and received
+
+Nothing is recorded until start() installs a Recorder; until then each hook only finds that recorder is None.
+Phases can nest, and can run in several threads at once, so their times overlap rather than adding up to the total."""
+
+import functools
+import threading
+import time
+
+recorder = None
+
+class Recorder(object):
+    """Accumulates the timings of one command"""
+    def __init__(self):
+        self.started = time.time()
+        self.lock = threading.Lock()
+        # phase name: [seconds, calls], and the names in the order they were first entered
+        self.phases = {}
+        self.phase_order = []
+        # method: [requests, bytes sent, bytes received]
+        self.requests = {}
+
+    def add_phase(self, name, seconds):
+        with self.lock:
+            totals = self.phases.get(name)
+            if totals is None:
+                totals = self.phases[name] = [0.0, 0]
+                self.phase_order.append(name)
+            totals[0] += seconds
+            totals[1] += 1
+
+    def add_request(self, method, sent=0, received=0, count=1):
+        with self.lock:
+            totals = self.requests.setdefault(method, [0, 0, 0])
+            totals[0] += count
+            totals[1] += sent
+            totals[2] += received
+
+    def report(self, out):
+        """prints the phases in the order they were first entered, then the requests of each method"""
+        print >>out, "timings (phases nest and overlap):"
+        for name in self.phase_order:
+            seconds, calls = self.phases[name]
+            print >>out, "  %-16s %9.3fs %8d call%s" % (name, seconds, calls, "" if calls == 1 else "s")
+        print >>out, "  %-16s %9.3fs" % ("total", time.time() - self.started)
+        print >>out, "requests:"
+        for method in sorted(self.requests):
+            count, sent, received = self.requests[method]
+            print >>out, "  %-16s %9d %10d bytes sent %10d bytes received" % (method, count, sent, received)
+        if not self.requests:
+            print >>out, "  none"
+
+class Phase(object):
+    __slots__ = ("name", "start")
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.time()
+
+    def __exit__(self, *exc_info):
+        if recorder is not None:
+            recorder.add_phase(self.name, time.time() - self.start)
+
+class NullPhase(object):
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *exc_info):
+        pass
+
+NULL_PHASE = NullPhase()
+
+def phase(name):
+    """returns a context manager that records the time spent within it as the named phase"""
+    return NULL_PHASE if recorder is None else Phase(name)
+
+def timed(name):
+    """decorator that records the time spent in each call of the function as the named phase"""
+    def decorator(f):
+        @functools.wraps(f)
+        def g(*args, **kwargs):
+            if recorder is None:
+                return f(*args, **kwargs)
+            with Phase(name):
+                return f(*args, **kwargs)
+        return g
+    return decorator
+
+def start():
+    """installs a new Recorder, and returns it"""
+    global recorder
+    recorder = Recorder()
+    return recorder
+
+def stop():
+    """removes the Recorder, and returns it"""
+    global recorder
+    stopped, recorder = recorder, None
+    return stopped
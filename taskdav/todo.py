@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+
+"""The todo.txt conventions for task priorities, statuses and tags, which don't need anything from CalDAV"""
+
+import re
+from flufl import enum
+
+class PriorityValue(enum._enum.EnumValue):
+    """Implements priority comparisons"""
+
+    def __eq__(self, other):
+        return type(self) == type(other) and self.value == other.value
+
+    def __ne__(self, other):
+        return type(self) != type(other) or self.value != other.value
+
+    def __lt__(self, other):
+        if type(self) != type(other):
+            return type(self) < type(other)
+        return self.sort_key < other.sort_key
+
+    def __le__(self, other):
+        if type(self) != type(other):
+            return type(self) < type(other)
+        return self.sort_key <= other.sort_key
+
+    def __gt__(self, other):
+        if type(self) != type(other):
+            return type(self) > type(other)
+        return self.sort_key > other.sort_key
+
+    def __ge__(self, other):
+        if type(self) != type(other):
+            return type(self) > type(other)
+        return self.sort_key >= other.sort_key
+
+    @property
+    def sort_key(self):
+        return self.value if self.value != 0 else 5
+
+    @property
+    def str_value(self):
+        return str(self.value)
+
+    @property
+    def display_name(self):
+        return self.name if len(self.name) == 1 else ""
+
+class Priority(enum.Enum):
+    unspecified = 0
+    A = 1
+    B = 2
+    C = 3
+    D = 4
+    default = 5
+    E = 6
+    F = 7
+    W = 8
+    H = 9
+
+    __value_factory__ = PriorityValue
+
+Priority.__all__ = set(Priority)
+Priority.__named__ = {p for p in Priority if len(p.name) == 1}
+Priority.__range_re__ = re.compile(r'([A-FHWa-fhw]|[A-FHWa-fhw]-[A-FHWa-fhw])')
+
+# looking priorities up by value here avoids constructing them through the enum, which is much slower
+PRIORITY_BY_VALUE = {p.value: p for p in Priority}
+
+STATUS_KEY = {"NEEDS-ACTION": 0, "IN-PROCESS": 1, "COMPLETED": 2, "CANCELLED": 3}
+
+CONTEXT_RE = re.compile(r'(?:^|\s)(@\w*\b)')
+PROJ_RE = re.compile(r'(?:^|\s)(\+\w*\b)')
+
+class TaskRecord(object):
+    """The decoded priority, status and summary of a task, which commands sort, filter and print tasks by,
+    with the key to sort tasks by priority, then status, then summary"""
+    __slots__ = ("priority", "status", "summary", "sort_key")
+
+    def __init__(self, priority, status, summary):
+        self.priority = PRIORITY_BY_VALUE[priority] if isinstance(priority, int) else priority
+        self.status = status
+        self.summary = summary
+        self.sort_key = (self.priority.sort_key, STATUS_KEY.get(status.upper(), status) if status else status, summary)
+
+    def format(self):
+        return format_task(self)
+
+def format_task(task):
+    """Formats a task (or anything else with priority, status and summary attributes) for output"""
+    priority = task.priority.display_name
+    status_str = ("x " if task.status == "COMPLETED" else "") + (priority + " " if priority else "")
+    return "%s%s" % (status_str, task.summary)
+
+def parse_priority_range(priority_str):
+    """Parses the given priority_str which can be either a single priority `C` or a range `B-E`, and return a set of PriorityValues"""
+    if priority_str:
+        if not Priority.__range_re__.match(priority_str):
+            raise ValueError("Priority range expression is not valid: %s" % priority_str)
+        priority_str = priority_str.upper()
+        if "-" in priority_str:
+            start_p, stop_p = Priority(priority_str[0]), Priority(priority_str[2])
+            return {p for p in Priority if start_p <= p <= stop_p}
+        else:
+            return {Priority(priority_str)}
+    else:
+        return Priority.__named__
+
+def parse_priority(priority_str):
+    """Parses the given priority_str which must be a single priority `C`, and return a PriorityValue"""
+    if priority_str:
+        priority_str = priority_str.upper()
+        return Priority(priority_str)
+    else:
+        return None